@@ -0,0 +1,133 @@
+"""asyncio interface for wiki2beamer.
+
+Files are read in an executor and the conversion itself runs in an
+executor as well, so the event loop stays responsive while decks are
+converted. Cancelling a conversion stops waiting for it at once; work
+already handed to the executor finishes in the background and is
+discarded.
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+from pathlib import Path
+from typing import List, Optional
+
+from .main import (
+    IncludeWalk,
+    convert2beamer,
+    get_lines_from_cache,
+    get_resource_limits,
+    joinLines,
+    munge_input_lines,
+    read_lines,
+    resolve_include,
+)
+
+
+def _convert(lines: List[str]) -> str:
+    limits = get_resource_limits()
+    if limits is not None:
+        limits.start()
+        limits.check_lines(lines)
+    lines = convert2beamer(munge_input_lines(lines))
+    return "".join(line + "\n" for line in lines)
+
+
+def _read_lines(filename: str) -> List[str]:
+    limits = get_resource_limits()
+    if limits is not None:
+        # the bytes of the conversions run by this thread before do not count,
+        # the include walk adds up the files of its own conversion
+        limits.start()
+    return get_lines_from_cache(filename, reader=read_lines)
+
+
+class AsyncConverter:
+    """converts decks on an event loop, at most max_concurrency at a time
+
+    executor runs the file reads and the conversion, None uses the default
+    executor of the loop. A ProcessPoolExecutor moves the conversion out of
+    the process, file reads then still happen in the loop's default
+    executor.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        executor: Optional[concurrent.futures.Executor] = None,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.executor = executor
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_semaphore(self) -> Optional[asyncio.Semaphore]:
+        if self.max_concurrency is not None and self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _read(self, filename: str) -> List[str]:
+        executor = self.executor
+        if not isinstance(executor, concurrent.futures.ThreadPoolExecutor):
+            executor = None
+        return await asyncio.get_running_loop().run_in_executor(executor, _read_lines, filename)
+
+    async def _include_recursive(
+        self, base: Optional[str], lines: Optional[List[str]], include_root: Optional[str]
+    ) -> List[str]:
+        def resolve(including: str, filename: str) -> str:
+            if include_root is None:
+                return resolve_include(including, filename)
+            return str(Path(include_root, filename))
+
+        # counted apart from the conversions sharing the thread of the loop
+        limits = get_resource_limits()
+        if limits is not None:
+            limits = limits.remaining()
+            limits.start()
+        walk = IncludeWalk(resolve, limits)
+        steps = walk.walk(base or "<text>")
+        with contextlib.suppress(StopIteration):
+            filename = next(steps)
+            file_lines = (lines or []) if base is None else await self._read(filename)
+            while True:
+                filename = steps.send(file_lines)
+                file_lines = await self._read(filename)
+        return walk.output
+
+    async def _run(
+        self, base: Optional[str], lines: Optional[List[str]], include_root: Optional[str]
+    ) -> str:
+        semaphore = self._get_semaphore()
+        if semaphore is not None:
+            async with semaphore:
+                return await self._run_unlimited(base, lines, include_root)
+        return await self._run_unlimited(base, lines, include_root)
+
+    async def _run_unlimited(
+        self, base: Optional[str], lines: Optional[List[str]], include_root: Optional[str]
+    ) -> str:
+        included = await self._include_recursive(base, lines, include_root)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, _convert, included)
+
+    async def convert_file(self, path: str, include_root: Optional[str] = None) -> str:
+        """convert the file at path, includes are relative to include_root or the cwd"""
+        return await self._run(path, None, include_root)
+
+    async def convert_text(self, text: str, include_root: Optional[str] = None) -> str:
+        """convert text, includes are relative to include_root or the cwd"""
+        return await self._run(None, joinLines(text.splitlines(keepends=True)), include_root)
+
+
+_default_converter = AsyncConverter()
+
+
+async def convert_file_async(path: str, include_root: Optional[str] = None) -> str:
+    """convert the file at path to LaTeX beamer code without blocking the event loop"""
+    return await _default_converter.convert_file(path, include_root)
+
+
+async def convert_text_async(text: str, include_root: Optional[str] = None) -> str:
+    """convert text to LaTeX beamer code without blocking the event loop"""
+    return await _default_converter.convert_text(text, include_root)
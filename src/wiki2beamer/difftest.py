@@ -0,0 +1,427 @@
+"""differential testing of the fast paths of the converter.
+
+Every optimization of the conversion (parallel sections, the include cache,
+the asyncio interface, ...) has to produce byte for byte the output of the
+plain sequential pipeline, which is the reference here. Decks are taken
+from a corpus of files or generated at random from a grammar of the wiki
+syntax, converted by every engine and compared. A deck some engine gets
+wrong is shrunk to a minimal one showing the difference.
+
+    python -m wiki2beamer.difftest --count 200 doc/examples/*.wiki
+
+The reference shares the code of the engines, a change of the conversion
+itself changes both alike. The outputs of the reference can be stored
+with --write-golden and later runs compare the reference with them
+(--golden), so such a change shows as a mismatch of the engine reference.
+
+Engines change the module settings of wiki2beamer.main while they run,
+the harness must not be used concurrently with other conversions.
+"""
+
+import asyncio
+import contextlib
+import difflib
+import io
+import json
+import optparse
+import random
+import sys
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+from .aio import AsyncConverter
+from .main import (
+    add_lines_to_cache,
+    clear_file_cache,
+    clear_include_cache,
+    convert2beamer,
+    convert_files,
+    disable_include_cache,
+    enable_include_cache,
+    include_file_recursive,
+    joinLines,
+    munge_input_lines,
+)
+
+# a deck maps file names to their text, the first file is the one converted
+Deck = Dict[str, str]
+
+
+def _text(lines: List[str]) -> str:
+    return "".join(line + "\n" for line in lines)
+
+
+def reference_engine(filename: str) -> str:
+    """the sequential pipeline without any of the fast paths"""
+    return _text(convert2beamer(munge_input_lines(include_file_recursive(filename))))
+
+
+def files_engine(filename: str) -> str:
+    return _text(convert_files([filename]))
+
+
+def parallel_engine(filename: str) -> str:
+    return _text(convert_files([filename], jobs=2))
+
+
+def include_cache_engine(filename: str) -> str:
+    """convert twice with the include cache, the second run uses the cached blocks"""
+    enable_include_cache()
+    try:
+        cold = _text(convert_files([filename]))
+        warm = _text(convert_files([filename]))
+    finally:
+        disable_include_cache()
+        clear_include_cache()
+    if cold != warm:
+        return f"{warm}% cold cache output differs:\n{cold}"
+    return warm
+
+
+def aio_engine(filename: str) -> str:
+    return asyncio.run(AsyncConverter().convert_file(filename))
+
+
+ENGINES: Dict[str, Callable[[str], str]] = {
+    "files": files_engine,
+    "parallel": parallel_engine,
+    "include-cache": include_cache_engine,
+    "aio": aio_engine,
+}
+
+
+def run_engine(engine: Callable[[str], str], filename: str) -> str:
+    """the output of engine, or a description of the error it ended in"""
+    try:
+        with contextlib.redirect_stderr(io.StringIO()):
+            return engine(filename)
+    except Exception as e:  # noqa: BLE001 # errors are compared like output
+        return f"error: {type(e).__name__}: {e}\n"
+
+
+@contextlib.contextmanager
+def registered(deck: Deck) -> Iterator[str]:
+    """put the files of deck into the file cache, yields the name of the first"""
+    for name, text in deck.items():
+        clear_file_cache(name)
+        add_lines_to_cache(name, joinLines(text.splitlines(keepends=True)))
+    try:
+        yield next(iter(deck))
+    finally:
+        for name in deck:
+            clear_file_cache(name)
+
+
+class Mismatch:
+    """an engine whose output for deck differs from the reference"""
+
+    def __init__(self, deck: Deck, engine: str, expected: str, actual: str) -> None:
+        self.deck = deck
+        self.engine = engine
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self) -> str:
+        out = [f"engine {self.engine} differs from the reference for:"]
+        for name, text in self.deck.items():
+            out.extend((f"--- {name}", text.rstrip("\n")))
+        out.append("--- diff")
+        out.extend(
+            difflib.unified_diff(
+                self.expected.splitlines(),
+                self.actual.splitlines(),
+                "reference",
+                self.engine,
+                lineterm="",
+            )
+        )
+        return "\n".join(out)
+
+
+def compare(
+    deck: Deck, engines: Optional[List[str]] = None, golden: Optional[str] = None
+) -> Optional[Mismatch]:
+    """the first engine with an output different from the reference, None if all agree
+
+    golden is the stored output of the reference for deck, if any.
+    """
+    with registered(deck) as filename:
+        expected = run_engine(reference_engine, filename)
+        if golden is not None and expected != golden:
+            return Mismatch(deck, "reference", golden, expected)
+        for name in engines if engines is not None else list(ENGINES):
+            actual = run_engine(ENGINES[name], filename)
+            if actual != expected:
+                return Mismatch(deck, name, expected, actual)
+    return None
+
+
+def shrink(mismatch: Mismatch) -> Mismatch:
+    """a mismatch of the same engine for a deck with as few lines as possible
+
+    Chunks of lines are removed from every file as long as the outputs still
+    differ, halving the chunk size down to single lines, then files that
+    are no longer needed are dropped.
+    """
+    engines = [mismatch.engine]
+    best = mismatch
+
+    def attempt(deck: Deck) -> bool:
+        nonlocal best
+        found = compare(deck, engines)
+        if found is None:
+            return False
+        best = found
+        return True
+
+    changed = True
+    while changed:
+        changed = False
+        for name in list(best.deck):
+            lines = best.deck[name].splitlines(keepends=True)
+            size = max(len(lines) // 2, 1)
+            while size >= 1 and lines:
+                i = 0
+                while i < len(lines):
+                    candidate = lines[:i] + lines[i + size :]
+                    if attempt(dict(best.deck, **{name: "".join(candidate)})):
+                        lines = candidate
+                        changed = True
+                    else:
+                        i += size
+                size //= 2
+        for name in list(best.deck)[1:]:
+            deck = dict(best.deck)
+            del deck[name]
+            changed = attempt(deck) or changed
+    return best
+
+
+# the grammar of random_deck, {w} is replaced by a word and {i} by inline markup
+_words = ["foo", "bar", "baz", "x_1", "a-b", "{}", "$x^2$", "50%", "\\LaTeX", "C++"]
+
+_inline = [
+    "'''{w}'''",
+    "''{w}''",
+    "'''''{w}'''''",
+    "@{w}@",
+    "!{w}!",
+    "\\@{w}\\!",
+    "@{w}\\@{w}@",
+    "_red_{w}_",
+    "_blue_{w} {w}_",
+    "((({w})))",
+    "<<<{w}.png>>>",
+    "<<<a_b_c.png,width=0.5\\textwidth>>>",
+    "<<<x.png>>> _red_{w}_",
+    " --> ",
+    " <== ",
+    " :-) ",
+    "+<2->{{w}}",
+    "-<1>{{w}}",
+    "{w}",
+    "{w}",
+]
+
+_body = [
+    "{i} {i}",
+    "* {i}",
+    "** {i}",
+    "# {i}",
+    "*# {i}",
+    "*[<+->] {i}",
+    "--3em--",
+    "--*1ex--",
+    "@FRAMEHEADER={i}",
+    "@FRAMEFOOTER={w}",
+    "<---FRAMEHEADER--->",
+    "",
+]
+
+_blocks = [
+    ["{i} \\", "{i}"],
+    ["<[block]{{w}}", "{i}", "[block]>"],
+    ["<[center]", "{i}", "[center]>"],
+    ["<[columns]", "[[[0.5\\textwidth]]]", "* {i}", "[[[0.5\\textwidth]]]", "{i}", "[columns]>"],
+    ["<[nowiki]", "== {w} ==", "'''{w}'''", "[nowiki]>"],
+    ["<[equation]", "_a_b_", "[equation]>"],
+    ["<[code][style=basic]", "int {w};", "[<2-3>{w}]", "[[<1>a][<3>b]]", "[code]>"],
+    ["<[code]", "\\[<2>{w}\\]", "<<<{w}>>>", "[code]>"],
+    ["<[code][language=C]", "{w}", "[code]>"],
+]
+
+_autotemplate = [
+    "<[autotemplate]",
+    "title={{w}}",
+    "usetheme={Warsaw}",
+    "titleframe=True",
+    "[autotemplate]>",
+]
+
+
+def _fill(rng: random.Random, template: str) -> str:
+    def word() -> str:
+        return rng.choice(_words)
+
+    def inline() -> str:
+        return "".join(rng.choice(_inline).replace("{w}", word()) for _ in range(rng.randint(1, 3)))
+
+    # one field at a time, so every field gets its own choice
+    while "{i}" in template or "{w}" in template:
+        template = template.replace("{i}", inline(), 1).replace("{w}", word(), 1)
+    return template
+
+
+def random_file(rng: random.Random, frames: int) -> List[str]:
+    """the lines of sections, subsections and frames with random content"""
+    lines: List[str] = []
+    for _ in range(frames):
+        heading = rng.random()
+        if heading < 0.2:
+            lines.append("== {w} ==")
+        elif heading < 0.35:
+            lines.append("=== {w} ===")
+        elif heading < 0.4:
+            lines.append("=! {i} !=")
+        lines.append(rng.choice(["==== {i} ====", "==== {w} ====[fragile]"]))
+        for _ in range(rng.randint(0, 6)):
+            if rng.random() < 0.25:
+                lines.extend(rng.choice(_blocks))
+            else:
+                lines.append(rng.choice(_body))
+        if rng.random() < 0.1:
+            lines.append("[frame]>")
+    return [_fill(rng, line) for line in lines]
+
+
+def random_deck(rng: random.Random, frames: int = 8) -> Deck:
+    """a deck with random content, possibly an autotemplate and includes"""
+    prefix = f"difftest-{uuid.UUID(int=rng.getrandbits(128)).hex[:8]}"
+    deck: Deck = {}
+    lines: List[str] = []
+    if rng.random() < 0.3:
+        lines += [_fill(rng, line) for line in _autotemplate]
+    includes: Dict[str, List[str]] = {}
+    for _ in range(rng.randint(1, 4)):
+        if rng.random() < 0.3:
+            name = f"{prefix}-include{len(includes)}.txt"
+            includes[name] = random_file(rng, rng.randint(1, 3))
+            lines.append(f">>>{name}<<<")
+        else:
+            lines += random_file(rng, max(1, frames // 4))
+    if rng.random() < 0.05:
+        lines.append("!==== selected ====")
+    deck[f"{prefix}.txt"] = "".join(line + "\n" for line in lines)
+    for name, include_lines in includes.items():
+        deck[name] = "".join(line + "\n" for line in include_lines)
+    return deck
+
+
+def corpus_deck(path: str) -> Deck:
+    """a deck of the file at path, its includes are read from the disk as usual"""
+    return {path: Path(path).read_text(encoding="utf-8")}
+
+
+def decks(count: int, seed: int = 0, corpus: Optional[List[str]] = None) -> List[Deck]:
+    """the decks of the corpus followed by count random decks"""
+    rng = random.Random(seed)
+    result = [corpus_deck(path) for path in corpus or []]
+    result += [random_deck(rng) for _ in range(count)]
+    return result
+
+
+def run(
+    count: int,
+    seed: int = 0,
+    engines: Optional[List[str]] = None,
+    corpus: Optional[List[str]] = None,
+    golden: Optional[Dict[str, str]] = None,
+) -> List[Mismatch]:
+    """compare the corpus and count random decks, returns the shrunk mismatches
+
+    golden maps the names of decks to the stored outputs of the reference,
+    see write_golden. A mismatch of the reference itself is not shrunk,
+    there is no stored output for the smaller decks.
+    """
+    mismatches: List[Mismatch] = []
+    for deck in decks(count, seed, corpus):
+        mismatch = compare(deck, engines, (golden or {}).get(next(iter(deck))))
+        if mismatch is not None:
+            mismatches.append(mismatch if mismatch.engine == "reference" else shrink(mismatch))
+    return mismatches
+
+
+def write_golden(path: str, count: int, seed: int = 0, corpus: Optional[List[str]] = None) -> None:
+    """store the outputs of the reference for the decks of run(count, seed, corpus=corpus)"""
+    golden = {}
+    for deck in decks(count, seed, corpus):
+        with registered(deck) as filename:
+            golden[filename] = run_engine(reference_engine, filename)
+    text = json.dumps(golden, indent=1, sort_keys=True, ensure_ascii=False)
+    Path(path).write_text(text + "\n", encoding="utf-8")
+
+
+def read_golden(path: str) -> Dict[str, str]:
+    """the outputs stored by write_golden"""
+    golden: Dict[str, str] = json.loads(Path(path).read_text(encoding="utf-8"))
+    return golden
+
+
+def main() -> None:
+    usage = "%prog [options] [corpus1.wiki [corpus2.wiki ...]]"
+    parser = optparse.OptionParser(usage="\n  " + usage)
+    parser.add_option(
+        "-n",
+        "--count",
+        dest="count",
+        metavar="N",
+        type="int",
+        default=100,
+        help="compare N random decks besides the corpus",
+    )
+    parser.add_option(
+        "-s",
+        "--seed",
+        dest="seed",
+        metavar="SEED",
+        type="int",
+        default=0,
+        help="seed of the random decks",
+    )
+    parser.add_option(
+        "-e",
+        "--engine",
+        dest="engines",
+        metavar="ENGINE",
+        action="append",
+        choices=list(ENGINES),
+        type="choice",
+        help="compare only ENGINE, one of " + ", ".join(ENGINES),
+    )
+    parser.add_option(
+        "--golden",
+        dest="golden",
+        metavar="FILE",
+        help="compare the reference with the outputs stored in FILE",
+    )
+    parser.add_option(
+        "--write-golden",
+        dest="write_golden",
+        metavar="FILE",
+        help="store the outputs of the reference in FILE instead of comparing",
+    )
+    opts, args = parser.parse_args()
+
+    if opts.write_golden is not None:
+        write_golden(opts.write_golden, opts.count, opts.seed, args)
+        return
+    golden = read_golden(opts.golden) if opts.golden is not None else None
+    mismatches = run(opts.count, opts.seed, opts.engines, args, golden)
+    for mismatch in mismatches:
+        sys.stderr.write(f"{mismatch}\n")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
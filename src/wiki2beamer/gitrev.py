@@ -0,0 +1,158 @@
+"""reading input files from a revision of a git repository.
+
+The files are read as blobs by a single `git cat-file --batch` process
+that lives as long as the GitRevision, so converting a deck at some commit
+needs neither a checkout nor a git process per file. Several blobs are
+requested at once before their contents are read, the includes of a file
+cost one round trip to git together. Blobs read are kept in a small LRU
+cache.
+"""
+
+import contextlib
+import shutil
+import subprocess  # noqa: S404 # git is run with fixed arguments, never a shell
+import threading
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+from typing import IO, Iterable, List, Optional, Tuple, Union
+
+# requests written before reading the answers, git stops reading requests
+# while the pipe of its answers is full
+BATCH_SIZE = 64
+
+
+class GitRevision:
+    """the files of revision rev of the repository containing directory
+
+    Raises OSError if there is no such repository or revision.
+    """
+
+    def __init__(self, rev: str, directory: str = ".", max_bytes: int = 16 * 1024 * 1024) -> None:
+        self.directory = directory
+        # the full path, a partial one would be looked up again by every start
+        executable = shutil.which("git")
+        if executable is None:
+            message = "cannot run git: not found in PATH"
+            raise OSError(message)
+        self.executable = executable
+        self.toplevel = self._git("rev-parse", "--show-toplevel")
+        try:
+            self.commit = self._git("rev-parse", "--verify", "--quiet", rev + "^{commit}")
+        except OSError:
+            message = f"not a revision of {self.toplevel}: {rev}"
+            raise OSError(message) from None
+        self.rev = rev
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.round_trips = 0  # batches of requests to git, for tests
+        self._blobs: OrderedDict[str, Union[bytes, OSError]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._process: Optional[subprocess.Popen[bytes]] = None
+
+    def _git(self, *args: str) -> str:
+        try:
+            result = subprocess.run(  # noqa: S603 # the arguments are our own
+                [self.executable, *args],
+                cwd=self.directory,
+                capture_output=True,
+                check=False,
+            )
+        except OSError as e:
+            message = f"cannot run git: {e}"
+            raise OSError(message) from e
+        if result.returncode != 0 or not result.stdout.strip():
+            message = result.stderr.decode("utf-8", "replace").strip()
+            raise OSError(message or f"git {' '.join(args)} failed")
+        return result.stdout.decode("utf-8").strip()
+
+    def _start(self) -> Tuple[IO[bytes], IO[bytes]]:
+        if self._process is None:
+            self._process = subprocess.Popen(  # noqa: S603 # the arguments are our own
+                [self.executable, "cat-file", "--batch"],
+                cwd=self.toplevel,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+            self._finalizer = weakref.finalize(self, _stop, self._process)
+        (stdin, stdout) = (self._process.stdin, self._process.stdout)
+        if stdin is None or stdout is None:
+            message = "git cat-file was started without pipes"
+            raise OSError(message)
+        return (stdin, stdout)
+
+    def path(self, filename: str) -> str:
+        """the path of filename in the repository"""
+        absolute = Path(filename).absolute()
+        try:
+            path = (absolute.parent.resolve() / absolute.name).relative_to(self.toplevel)
+        except ValueError:
+            message = f"{filename} is not in the repository {self.toplevel}"
+            raise OSError(message) from None
+        return path.as_posix()
+
+    def prefetch(self, filenames: Iterable[str]) -> None:
+        """read the blobs of filenames from git that are not cached yet"""
+        paths: List[str] = []
+        for filename in filenames:
+            with contextlib.suppress(OSError):
+                paths.append(self.path(filename))
+        with self._lock:
+            paths = [p for p in dict.fromkeys(paths) if p not in self._blobs]
+            for i in range(0, len(paths), BATCH_SIZE):
+                self._fetch(paths[i : i + BATCH_SIZE])
+
+    def read(self, filename: str) -> bytes:
+        """the content of filename at the revision, raises OSError if there is none"""
+        path = self.path(filename)
+        with self._lock:
+            if path not in self._blobs:
+                self._fetch([path])
+            blob = self._blobs[path]
+            self._blobs.move_to_end(path)
+        if isinstance(blob, OSError):
+            raise blob
+        return blob
+
+    def _fetch(self, paths: List[str]) -> None:
+        (stdin, stdout) = self._start()
+        stdin.write("".join(f"{self.commit}:{path}\n" for path in paths).encode("utf-8"))
+        stdin.flush()
+        self.round_trips += 1
+        for path in paths:
+            header = stdout.readline().split()
+            if not header:
+                message = "git cat-file ended unexpectedly"
+                raise OSError(message)
+            if header[-1] in {b"missing", b"ambiguous"}:
+                self._add(path, OSError(f"{path} not found in {self.rev}"))
+                continue
+            (kind, size) = (header[1].decode("ascii"), int(header[2]))
+            data = stdout.read(size + 1)[:-1]
+            if kind != "blob":
+                self._add(path, OSError(f"{path} is a {kind} in {self.rev}"))
+            else:
+                self._add(path, data)
+
+    def _add(self, path: str, blob: Union[bytes, OSError]) -> None:
+        if isinstance(blob, bytes):
+            self.bytes += len(blob)
+        self._blobs[path] = blob
+        while self.bytes > self.max_bytes and len(self._blobs) > 1:
+            (_, evicted) = self._blobs.popitem(last=False)
+            if isinstance(evicted, bytes):
+                self.bytes -= len(evicted)
+
+    def close(self) -> None:
+        """end the git process, it is started again when needed"""
+        if self._process is not None:
+            self._finalizer()
+            self._process = None
+
+
+def _stop(process: "subprocess.Popen[bytes]") -> None:
+    if process.stdin is not None:
+        process.stdin.close()
+    process.wait()
+    if process.stdout is not None:
+        process.stdout.close()
@@ -0,0 +1,164 @@
+"""pre-highlighted code listings for wiki2beamer.
+
+Instead of an lstlisting, which the listings package has to lex on every
+LaTeX run and for every overlay of an animation again, code is tokenized
+here and written as a fancyvrb Verbatim environment. Keywords, comments
+and strings are wrapped in the macros of PREAMBLE, LaTeX only has to
+typeset them.
+
+The lexers are deliberately simple: comments, strings, numbers and
+keywords of a few common languages. Code in any other language is
+written without highlighting.
+"""
+
+import functools
+import re
+from typing import Dict, FrozenSet, List, Optional, Pattern, Tuple
+
+# colors as in the basic style of the autotemplate
+PREAMBLE = (
+    "\\providecommand{\\wbcodekw}[1]{\\textcolor{blue}{#1}}\n"
+    "\\providecommand{\\wbcodecm}[1]{\\textcolor{gray}{#1}}\n"
+    "\\providecommand{\\wbcodest}[1]{\\textcolor{magenta}{#1}}\n"
+)
+
+_macros = {"keyword": "wbcodekw", "comment": "wbcodecm", "string": "wbcodest"}
+
+_c_comments = [r"//[^\n]*", r"/\*[\s\S]*?\*/"]
+_c_strings = [r'"(?:\\.|[^"\\\n])*"', r"'(?:\\.|[^'\\\n])*'"]
+
+_c_keywords = """auto break case char const continue default do double else enum extern
+float for goto if inline int long register restrict return short signed sizeof static
+struct switch typedef union unsigned void volatile while"""
+
+_cpp_keywords = (
+    _c_keywords
+    + """ bool catch class constexpr delete explicit false friend mutable namespace new
+    noexcept nullptr operator private protected public template this throw true try
+    typename using virtual"""
+)
+
+_java_keywords = """abstract assert boolean break byte case catch char class const continue
+default do double else enum extends false final finally float for goto if implements
+import instanceof int interface long native new null package private protected public
+return short static strictfp super switch synchronized this throw throws transient true
+try var void volatile while"""
+
+_javascript_keywords = """async await break case catch class const continue debugger
+default delete do else export extends false finally for function if import in
+instanceof let new null return super switch this throw true try typeof undefined var
+void while with yield"""
+
+_python_keywords = """False None True and as assert async await break class continue def
+del elif else except finally for from global if import in is lambda nonlocal not or pass
+raise return try while with yield"""
+
+_sh_keywords = """case do done elif else esac export fi for function if in local return
+select then until while"""
+
+# language: (comments, strings, keywords)
+LANGUAGES: Dict[str, Tuple[List[str], List[str], str]] = {
+    "c": (_c_comments, _c_strings, _c_keywords),
+    "c++": (_c_comments, _c_strings, _cpp_keywords),
+    "java": (_c_comments, _c_strings, _java_keywords),
+    "javascript": (_c_comments, [*_c_strings, r"`[^`]*`"], _javascript_keywords),
+    "python": (
+        [r"#[^\n]*"],
+        [r'"""[\s\S]*?"""', r"'''[\s\S]*?'''", *_c_strings],
+        _python_keywords,
+    ),
+    "sh": ([r"#[^\n]*"], [r'"(?:\\.|[^"\\])*"', r"'[^']*'"], _sh_keywords),
+}
+
+ALIASES = {"bash": "sh", "cpp": "c++", "js": "javascript", "py": "python"}
+
+
+def normalize_language(language: str) -> str:
+    """map a listings language name like {[GNU]C++} to a key of LANGUAGES"""
+    language = re.sub(r"^\{?(?:\[[^\]]*\])?", "", language.strip()).rstrip("}").lower()
+    return ALIASES.get(language, language)
+
+
+@functools.lru_cache(maxsize=None)
+def get_lexer(language: str) -> Optional[Tuple[Pattern[str], FrozenSet[str]]]:
+    """the token pattern and keywords of language, compiled on first use"""
+    if language not in LANGUAGES:
+        return None
+    comments, strings, keywords = LANGUAGES[language]
+    pattern = re.compile(
+        "(?P<comment>{})|(?P<string>{})|(?P<word>[A-Za-z_][A-Za-z0-9_]*)".format(
+            "|".join(comments), "|".join(strings)
+        )
+    )
+    return (pattern, frozenset(keywords.split()))
+
+
+def tokenize(code: str, language: str) -> List[Tuple[Optional[str], str]]:
+    """split code into (kind, text), kind is None for text that is not highlighted"""
+    lexer = get_lexer(normalize_language(language))
+    if lexer is None:
+        return [(None, code)]
+    (pattern, keywords) = lexer
+
+    tokens: List[Tuple[Optional[str], str]] = []
+    pos = 0
+    for m in pattern.finditer(code):
+        kind = m.lastgroup
+        if kind == "word":
+            if m.group() not in keywords:
+                continue
+            kind = "keyword"
+        if m.start() > pos:
+            tokens.append((None, code[pos : m.start()]))
+        tokens.append((kind, m.group()))
+        pos = m.end()
+    if pos < len(code):
+        tokens.append((None, code[pos:]))
+    return tokens
+
+
+def escape(text: str) -> str:
+    """escape the command characters of the Verbatim environment"""
+    return re.sub(r"[\\{}]", lambda m: "\\char%d{}" % ord(m.group()), text)
+
+
+def highlight(code: str, language: str) -> str:
+    """code with its tokens wrapped in the macros of PREAMBLE"""
+    out: List[str] = []
+    for kind, text in tokenize(code.expandtabs(8), language):
+        if kind is None:
+            out.append(escape(text))
+            continue
+        # the arguments of commands must not span lines in Verbatim
+        macro = _macros[kind]
+        out.append(
+            "\n".join(f"\\{macro}{{{escape(part)}}}" if part else "" for part in text.split("\n"))
+        )
+    return "".join(out)
+
+
+def parse_options(options: str) -> Dict[str, str]:
+    """the key=value pairs of an lstlisting option string like [style=basic,language=C]"""
+    m = re.match(r"\s*\[(.*)\]", options, re.DOTALL)
+    if m is None:
+        return {}
+    parsed: Dict[str, str] = {}
+    for item in re.findall(r"(?:[^,{}]|\{[^{}]*\})+", m.group(1)):
+        key, _, value = item.partition("=")
+        parsed[key.strip()] = value.strip()
+    return parsed
+
+
+def make_verbatim(content: str, options: str) -> str:
+    """the Verbatim environment replacing expand_code_make_lstlisting(content, options)"""
+    parsed = parse_options(options)
+    verbatim_options = ["commandchars=\\\\\\{\\}", "fontsize=\\footnotesize"]
+    if parsed.get("numbers") in {"left", "right"}:
+        verbatim_options.append("numbers=" + parsed["numbers"])
+    if parsed.get("frame") in {"single", "lines", "leftline", "topline", "bottomline"}:
+        verbatim_options.append("frame=" + parsed["frame"])
+
+    code = highlight(content, parsed.get("language", ""))
+    if not code.endswith("\n"):
+        code += "\n"
+    return "\\begin{{Verbatim}}[{}]\n{}\\end{{Verbatim}}".format(",".join(verbatim_options), code)
@@ -0,0 +1,575 @@
+"""a language server for wiki2beamer decks, speaking LSP over stdio.
+
+Open documents are kept in memory as lines, split into chunks that start
+at a heading outside of any nowiki, code or autotemplate block, usually
+one frame each. A chunk is checked on its own, the results are kept until
+the chunk changes. An edit only rescans the lines from the chunk it
+touches up to the next chunk boundary that did not move, so typing in one
+frame does not check the others again. Environments may span chunks, they
+are matched over the events collected from all chunks.
+
+Besides the diagnostics of --check, the server provides the outline as
+document symbols and answers the wiki2beamer/frameLatex request with the
+LaTeX generated for the frame at a position. Includes are resolved from
+the files on disk, relative to the working directory like the command
+line does. Their lines are kept in a FileCache and read again only when
+the file_signature of a file changes.
+"""
+
+import bisect
+import json
+import re
+import sys
+import urllib.parse
+import urllib.request
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+from .main import (
+    VERSIONTAG,
+    Diagnostic,
+    FileCache,
+    OutlineEntry,
+    Wiki2BeamerException,
+    check_blocks,
+    convert2beamer_finish,
+    convert2beamer_lines,
+    copy_entry_state,
+    file_signature,
+    get_autotemplatemode,
+    get_codemode,
+    get_entry_state,
+    get_environment_event,
+    get_nowikimode,
+    get_outline_entry,
+    include_file,
+    iter_source_lines,
+    join_numbered_lines,
+    munge_input_lines,
+    munge_numbered_lines,
+    pprint,
+    read_file_to_numbered_lines,
+    read_source,
+    w2bstate,
+)
+
+# LSP constants
+SEVERITY_ERROR = 1
+SYNC_INCREMENTAL = 2
+SYMBOL_KINDS = {"section": 2, "subsection": 2, "titleslide": 5, "frame": 5}  # Module, Class
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+REQUEST_FAILED = -32803
+
+_headingre = re.compile(r"^(?:=!|!?==)")
+_newlinere = re.compile(r"\r\n|\r|\n")
+
+# the lines of included files as read_source returns them
+_include_cache = FileCache(64 * 1024 * 1024)
+
+
+def read_include(filename: str) -> List[Tuple[int, str]]:
+    """read_file_to_numbered_lines, but from _include_cache while the file does not change"""
+    lines = _include_cache.get(filename)
+    if lines is None:
+        # taken before reading, a change while reading is noticed by the next lookup
+        signature = file_signature(filename)
+        if signature is None:
+            return read_file_to_numbered_lines(filename)
+        lines = read_source(filename)
+        _include_cache.add(filename, lines, signature)
+    return join_numbered_lines(lines)
+
+
+class ChunkScanner:
+    """follows the line joining, munging and block modes of a conversion line by line
+
+    A chunk may start at a line if the scanner is at_boundary before it:
+    no line is waiting to be joined and no block is open.
+    """
+
+    def __init__(self) -> None:
+        self.join_nowikimode = False
+        self.join_codemode = False
+        self.joined = ""
+        self.joining = False
+        self.munged = ""
+        self.munging = False
+        self.nowikimode = False
+        self.codemode = False
+        self.autotemplatemode = False
+
+    def at_boundary(self) -> bool:
+        pending = self.joining or self.munging
+        return not (pending or self.nowikimode or self.codemode or self.autotemplatemode)
+
+    def feed(self, line: str) -> None:
+        # as in join_numbered_lines
+        (_, self.join_nowikimode) = get_nowikimode(line, self.join_nowikimode)
+        if not self.join_nowikimode:
+            (_, self.join_codemode) = get_codemode(line, self.join_codemode)
+        if not self.join_codemode:
+            line = line.rstrip()
+        if not (self.join_nowikimode or self.join_codemode) and (
+            line == "%" or (line.endswith("%") and not line.endswith("\\%"))
+        ):
+            self.joined += line[:-1]
+            self.joining = True
+            return
+        line = self.joined + line
+        self.joined = ""
+        self.joining = False
+
+        # as in munge_numbered_lines
+        if self.munging:
+            if line.endswith("\\"):
+                self.munged += line[:-1]
+                return
+            line = self.munged + line
+            self.munged = ""
+            self.munging = False
+        elif line.endswith("\\") and not line.endswith("\\\\"):
+            self.munged = line[:-1]
+            self.munging = True
+            return
+
+        # as in check_blocks
+        (line, self.nowikimode) = get_nowikimode(line, self.nowikimode)
+        if self.nowikimode:
+            return
+        (line, _codemode) = get_codemode(line, self.codemode)
+        if self.codemode or _codemode:
+            self.codemode = _codemode
+            return
+        (line, self.autotemplatemode) = get_autotemplatemode(line, self.autotemplatemode)
+
+
+class ChunkResult:
+    """what checking one chunk found, line numbers are relative to the chunk
+
+    Problems in included files are reported at the include line, the
+    environment events are (opened, name, line) in the order of the input.
+    """
+
+    def __init__(self) -> None:
+        self.diagnostics: List[Tuple[int, str]] = []
+        self.events: List[Tuple[bool, str, int]] = []
+        self.outline: List[Tuple[int, OutlineEntry]] = []
+        self.has_includes = False
+
+
+def check_chunk(filename: str, lines: List[str]) -> ChunkResult:
+    """check the lines of a chunk of filename"""
+    result = ChunkResult()
+    numbered = join_numbered_lines(lines)
+    directives = [number for number, line in numbered if include_file(line) is not None]
+    result.has_includes = bool(directives)
+    include_lines: Dict[str, int] = {}
+    last = 1
+
+    def locate(file_: str, number: int) -> int:
+        return number if file_ == filename else include_lines.get(file_, last)
+
+    diagnostics: List[Diagnostic] = []
+    sources = iter_source_lines(filename, diagnostics, numbered, read_include)
+    for file_, number, line in check_blocks(munge_numbered_lines(sources), diagnostics):
+        if file_ == filename:
+            last = number
+        elif file_ not in include_lines:
+            # the first include line after the last line seen brought it in
+            include_lines[file_] = next((n for n in directives if n > last), last)
+        event = get_environment_event(line)
+        if event is not None:
+            result.events.append((event[0], event[1], locate(file_, number)))
+        entry = get_outline_entry(file_, number, line)
+        if entry is not None:
+            result.outline.append((locate(file_, number), entry))
+
+    for diagnostic in diagnostics:
+        message = diagnostic.message
+        if diagnostic.filename != filename:
+            message = str(diagnostic)
+        result.diagnostics.append((locate(diagnostic.filename, diagnostic.line) or 1, message))
+    return result
+
+
+class Document:
+    """an open document, its lines and their chunks"""
+
+    def __init__(self, uri: str, text: str) -> None:
+        self.uri = uri
+        self.filename = uri_to_filename(uri)
+        self.lines = _newlinere.split(text)
+        self.starts: List[int] = []
+        self.results: List[Optional[ChunkResult]] = []
+        # the state of a conversion at the start of the first chunks, for frame_latex
+        self.entry_states: List[w2bstate] = [w2bstate()]
+        self.rescanned = 0  # lines scanned by the last update, for tests
+        self._rescan(0, 0, 0, 0)
+
+    def _rescan(self, chunk: int, changed_end: int, delta: int, old_chunks: int) -> None:
+        """split the lines from chunk on again, until a chunk boundary after
+        changed_end is found where one was before, shifted by delta"""
+        old_starts = {start + delta: i for i, start in enumerate(self.starts)}
+        start = self.starts[chunk] if chunk < len(self.starts) else 0
+        starts = [start]
+        scanner = ChunkScanner()
+        resume = None
+        i = start
+        for i in range(start, len(self.lines)):
+            line = self.lines[i]
+            if i > start and scanner.at_boundary() and _headingre.match(line):
+                if i > changed_end and old_starts.get(i, -1) >= old_chunks:
+                    resume = old_starts[i]
+                    break
+                starts.append(i)
+            scanner.feed(line)
+        self.rescanned = i - start
+
+        if resume is None:
+            self.starts = self.starts[:chunk] + starts
+            self.results = self.results[:chunk] + [None] * len(starts)
+        else:
+            kept = [s + delta for s in self.starts[resume:]]
+            self.starts = self.starts[:chunk] + starts + kept
+            self.results = self.results[:chunk] + [None] * len(starts) + self.results[resume:]
+
+    def apply_change(self, change: Dict[str, Any]) -> None:
+        """apply a TextDocumentContentChangeEvent"""
+        if "range" not in change:
+            self.lines = _newlinere.split(change["text"])
+            self.starts = []
+            self.results = []
+            del self.entry_states[1:]
+            self._rescan(0, 0, 0, 0)
+            return
+        (start, end) = (change["range"]["start"], change["range"]["end"])
+        first = self.lines[start["line"]] if start["line"] < len(self.lines) else ""
+        last = self.lines[end["line"]] if end["line"] < len(self.lines) else ""
+        text = (
+            first[: utf16_to_index(first, start["character"])]
+            + change["text"]
+            + last[utf16_to_index(last, end["character"]) :]
+        )
+        new_lines = _newlinere.split(text)
+        self.lines[start["line"] : end["line"] + 1] = new_lines
+
+        # the chunk before the one changed, a heading may have been removed
+        chunk = max(0, bisect.bisect_right(self.starts, start["line"]) - 1)
+        if chunk > 0 and self.starts[chunk] == start["line"]:
+            chunk -= 1
+        delta = len(new_lines) - (end["line"] - start["line"] + 1)
+        old_chunks = bisect.bisect_right(self.starts, end["line"])
+        # the chunks before chunk did not change, nor did the state at its start
+        del self.entry_states[chunk + 1 :]
+        self._rescan(chunk, start["line"] + len(new_lines) - 1, delta, old_chunks)
+
+    def chunk_lines(self, chunk: int) -> List[str]:
+        end = self.starts[chunk + 1] if chunk + 1 < len(self.starts) else len(self.lines)
+        return self.lines[self.starts[chunk] : end]
+
+    def check(self) -> List[ChunkResult]:
+        """the results of all chunks, checking those that changed"""
+        for i, result in enumerate(self.results):
+            # included files may have changed on disk
+            if result is None or result.has_includes:
+                self.results[i] = check_chunk(self.filename, self.chunk_lines(i))
+        return [r for r in self.results if r is not None]
+
+    def diagnostics(self) -> List[Tuple[int, str]]:
+        """(line index, message) of all problems found"""
+        found: List[Tuple[int, str]] = []
+        active_envs: Dict[str, int] = {}
+        for start, result in zip(self.starts, self.check()):
+            found += [(start + number - 1, message) for number, message in result.diagnostics]
+            for opened, name, number in result.events:
+                if opened:
+                    active_envs[name] = start + number - 1
+                elif name in active_envs:
+                    del active_envs[name]
+                else:
+                    found.append((start + number - 1, f"environment '{name}' is not open"))
+        for env, index in active_envs.items():
+            found.append((index, f"environment '{env}' is not closed"))
+        return found
+
+    def outline(self) -> List[Tuple[int, OutlineEntry]]:
+        """(line index, entry) of all headings"""
+        return [
+            (start + number - 1, entry)
+            for start, result in zip(self.starts, self.check())
+            for number, entry in result.outline
+        ]
+
+    def entry_state(self, chunk: int) -> w2bstate:
+        """the state of a conversion at the start of chunk, kept until the chunks before change"""
+        while len(self.entry_states) <= chunk:
+            i = len(self.entry_states) - 1
+            state = copy_entry_state(self.entry_states[i])
+            self.entry_states.append(get_entry_state(self.resolve(self.chunk_lines(i)), state))
+        return self.entry_states[chunk]
+
+    def frame_latex(self, line: int) -> str:
+        """the LaTeX generated for the chunk containing line"""
+        chunk = max(0, bisect.bisect_right(self.starts, line) - 1)
+        state = copy_entry_state(self.entry_state(chunk))
+        # the frame before is closed by the heading, that is not part of this frame
+        state.frame_opened = False
+        result: List[str] = []
+        convert2beamer_lines(self.resolve(self.chunk_lines(chunk)), result, state)
+        convert2beamer_finish(result, state)
+        return "\n".join(result).strip("\n") + "\n"
+
+    def resolve(self, lines: List[str]) -> List[str]:
+        """join, include and munge lines like a conversion of the document does"""
+        diagnostics: List[Diagnostic] = []
+        numbered = join_numbered_lines(lines)
+        sources = iter_source_lines(self.filename, diagnostics, numbered, read_include)
+        return munge_input_lines([line for _, _, line in sources])
+
+
+def uri_to_filename(uri: str) -> str:
+    parsed = urllib.parse.urlparse(uri)
+    if parsed.scheme != "file":
+        return uri
+    return urllib.request.url2pathname(parsed.path)
+
+
+def utf16_to_index(line: str, character: int) -> int:
+    """the index into line of an LSP character offset, counted in UTF-16 code units"""
+    if line.isascii():
+        return min(character, len(line))
+    units = 0
+    for i, c in enumerate(line):
+        if units >= character:
+            return i
+        units += 2 if ord(c) > 0xFFFF else 1
+    return len(line)
+
+
+def utf16_length(line: str) -> int:
+    if line.isascii():
+        return len(line)
+    return sum(2 if ord(c) > 0xFFFF else 1 for c in line)
+
+
+def line_range(document: Document, index: int) -> Dict[str, Any]:
+    """the LSP range of line index of document"""
+    line = document.lines[index] if index < len(document.lines) else ""
+    return {
+        "start": {"line": index, "character": 0},
+        "end": {"line": index, "character": utf16_length(line)},
+    }
+
+
+def document_symbols(document: Document) -> List[Dict[str, Any]]:
+    """the outline as nested DocumentSymbols: sections, subsections, frames"""
+    levels = {"section": 0, "subsection": 1, "titleslide": 2, "frame": 2}
+    roots: List[Dict[str, Any]] = []
+    stack: List[Tuple[int, Dict[str, Any]]] = []
+    for index, entry in document.outline():
+        symbol = {
+            "name": entry.title or "(untitled)",
+            "detail": entry.kind,
+            "kind": SYMBOL_KINDS[entry.kind],
+            "range": line_range(document, index),
+            "selectionRange": line_range(document, index),
+            "children": [],
+        }
+        level = levels[entry.kind]
+        while stack and stack[-1][0] >= level:
+            stack.pop()
+        (stack[-1][1]["children"] if stack else roots).append(symbol)
+        stack.append((level, symbol))
+    return roots
+
+
+class Server:
+    """the state of the language server, handle() takes one message at a time"""
+
+    def __init__(self, output: BinaryIO) -> None:
+        self.output = output
+        self.documents: Dict[str, Document] = {}
+        self.shutdown = False
+
+    def send(self, message: Dict[str, Any]) -> None:
+        body = json.dumps(dict(message, jsonrpc="2.0"), ensure_ascii=False).encode("utf-8")
+        self.output.write(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+        self.output.flush()
+
+    def send_error(self, message: Dict[str, Any], code: int, text: str) -> None:
+        """answer a request with an error, for a notification it goes to stderr"""
+        if "id" in message:
+            self.send({"id": message["id"], "error": {"code": code, "message": text}})
+        else:
+            pprint(f"{message.get('method')}: {text}", file=sys.stderr)
+
+    def publish(self, document: Document) -> None:
+        diagnostics = [
+            {
+                "range": line_range(document, index),
+                "severity": SEVERITY_ERROR,
+                "source": "wiki2beamer",
+                "message": message,
+            }
+            for index, message in document.diagnostics()
+        ]
+        self.send(
+            {
+                "method": "textDocument/publishDiagnostics",
+                "params": {"uri": document.uri, "diagnostics": diagnostics},
+            }
+        )
+
+    def handle(self, message: Dict[str, Any]) -> Optional[int]:
+        """handle a request or notification, returns the exit code after exit"""
+        method = message.get("method")
+        params = message.get("params") or {}
+        if method == "exit":
+            return 0 if self.shutdown else 1
+        try:
+            result = self.dispatch(method, params)
+        except _MethodNotFound:
+            self.send_error(message, METHOD_NOT_FOUND, f"unknown method: {method}")
+            return None
+        except Exception as e:  # noqa: BLE001 # the server has to keep running
+            if isinstance(e, Wiki2BeamerException):
+                self.send_error(message, REQUEST_FAILED, e.describe())
+            else:
+                self.send_error(message, REQUEST_FAILED, f"{type(e).__name__}: {e}")
+            return None
+        if "id" in message:
+            self.send({"id": message["id"], "result": result})
+        return None
+
+    def dispatch(self, method: Optional[str], params: Dict[str, Any]) -> Any:
+        if method == "initialize":
+            return {
+                "capabilities": {
+                    "positionEncoding": "utf-16",
+                    "textDocumentSync": {"openClose": True, "change": SYNC_INCREMENTAL},
+                    "documentSymbolProvider": True,
+                },
+                "serverInfo": {"name": "wiki2beamer", "version": VERSIONTAG},
+            }
+        if method == "shutdown":
+            self.shutdown = True
+            return None
+        handlers: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+            "textDocument/didOpen": self.did_open,
+            "textDocument/didChange": self.did_change,
+            "textDocument/didClose": self.did_close,
+            "textDocument/documentSymbol": self.document_symbol,
+            "wiki2beamer/frameLatex": self.frame_latex,
+        }
+        if method in handlers:
+            return handlers[method](params)
+        if method is None or method.startswith("$/") or method == "initialized":
+            return None
+        raise _MethodNotFound
+
+    def did_open(self, params: Dict[str, Any]) -> None:
+        item = params["textDocument"]
+        self.documents[item["uri"]] = Document(item["uri"], item["text"])
+        self.publish(self.documents[item["uri"]])
+
+    def did_change(self, params: Dict[str, Any]) -> None:
+        document = self.documents[params["textDocument"]["uri"]]
+        for change in params["contentChanges"]:
+            document.apply_change(change)
+        self.publish(document)
+
+    def did_close(self, params: Dict[str, Any]) -> None:
+        uri = params["textDocument"]["uri"]
+        self.documents.pop(uri, None)
+        self.send(
+            {
+                "method": "textDocument/publishDiagnostics",
+                "params": {"uri": uri, "diagnostics": []},
+            }
+        )
+
+    def document_symbol(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return document_symbols(self.documents[params["textDocument"]["uri"]])
+
+    def frame_latex(self, params: Dict[str, Any]) -> Dict[str, str]:
+        document = self.documents[params["textDocument"]["uri"]]
+        return {"latex": document.frame_latex(params["position"]["line"])}
+
+
+class _MethodNotFound(Exception):
+    pass
+
+
+class _InvalidRequest(Exception):
+    pass
+
+
+class _BrokenHeader(Exception):
+    pass
+
+
+def read_message(stream: BinaryIO) -> Optional[Dict[str, Any]]:
+    """the next message of stream, None at its end
+
+    The whole header block is read before its Content-Length is looked at.
+    Without a valid one the end of the body is unknown, the stream cannot be
+    synced again and _BrokenHeader is raised. A body that is not a JSON
+    object raises ValueError or _InvalidRequest, the next message is intact.
+    """
+    headers: List[str] = []
+    while True:
+        line = stream.readline()
+        if not line:
+            if headers:
+                error = "end of input in the header"
+                raise _BrokenHeader(error)
+            return None
+        line = line.strip()
+        if line:
+            headers.append(line.decode("ascii", "replace"))
+        elif headers:
+            break
+    lengths = [
+        value.strip()
+        for name, _, value in (header.partition(":") for header in headers)
+        if name.strip().lower() == "content-length"
+    ]
+    if len(lengths) != 1 or not lengths[0].isdigit():
+        error = f"no valid Content-Length in the header: {headers!r}"
+        raise _BrokenHeader(error)
+    body = stream.read(int(lengths[0]))
+    if len(body) < int(lengths[0]):
+        return None
+    message = json.loads(body.decode("utf-8"))
+    if not isinstance(message, dict):
+        raise _InvalidRequest
+    return message
+
+
+def serve(input_: BinaryIO, output: BinaryIO) -> int:
+    """run the server until exit or the end of input_, returns the exit code"""
+    server = Server(output)
+    while True:
+        try:
+            message = read_message(input_)
+        except _BrokenHeader as e:
+            # where the next message starts is unknown, give up
+            server.send_error({"id": None}, PARSE_ERROR, f"parse error: {e}")
+            return 1
+        except ValueError as e:
+            # not JSON, the id of the request is unknown
+            server.send_error({"id": None}, PARSE_ERROR, f"parse error: {e}")
+            continue
+        except _InvalidRequest:
+            server.send_error({"id": None}, INVALID_REQUEST, "a message must be a JSON object")
+            continue
+        if message is None:
+            return 0 if server.shutdown else 1
+        code = server.handle(message)
+        if code is not None:
+            return code
+
+
+if __name__ == "__main__":
+    sys.exit(serve(sys.stdin.buffer, sys.stdout.buffer))
@@ -29,15 +29,55 @@
 #     Julius Plenz <julius@plenz.com>
 
 
-import codecs
+# Modules only some features need (zip bundles, parallel jobs, the highlighter,
+# ...) are imported by the functions using them, the CLI is started for every
+# keystroke by editor integrations. banned-module-level-imports in
+# pyproject.toml lists them.
+import bz2
+import contextlib
+import functools
 import hashlib
+import importlib
+import io
+import itertools
+import json
+import lzma
 import optparse
 import os
+import pickle  # noqa: S403 # only to check that settings can reach spawned workers
 import random
 import re
+import struct
 import sys
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Dict, List, Match, Optional, Pattern, Tuple, Type, TypeVar
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    Optional,
+    Pattern,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
+
+if TYPE_CHECKING:
+    import zipfile
+
+    from .gitrev import GitRevision
+
+T = TypeVar("T")
 
 VERSIONTAG = "0.10.0"
 __version__ = VERSIONTAG
@@ -51,22 +91,27 @@ def md5hex(string: str) -> str:
 
 _redirected_stdout: Optional[Any] = None
 _redirected_stderr: Optional[Any] = None
+# write stdout as UTF-8 bytes, whatever the encoding of the locale is
+_bytes_stdout = False
 
 
 def pprint(string: str, file: Any = sys.stdout, eol: bool = True) -> None:  # noqa: FBT001, FBT002 # TODO: Fix this
     """portable version of print which directly writes into the given stream"""
     if file == sys.stdout and _redirected_stdout is not None:
         file = _redirected_stdout
+    elif file == sys.stdout and _bytes_stdout:
+        file = sys.stdout.buffer
     if file == sys.stderr and _redirected_stderr is not None:
         file = _redirected_stderr
 
     if file in {sys.stderr, sys.stdout}:
         file.write(string)
+        if eol:
+            file.write(os.linesep)
     else:
         file.write(string.encode("utf-8"))
-
-    if eol:
-        file.write(os.linesep)
+        if eol:
+            file.write(os.linesep.encode("utf-8"))
     file.flush()
 
 
@@ -75,14 +120,239 @@ def mydebug(message: str) -> None:
     pprint(message, file=sys.stderr)
 
 
+class Wiki2BeamerException(Exception):
+    """base of the errors of a conversion, located in the input if possible
+
+    The library raises these instead of exiting, main() turns them into
+    exit_code. diagnostics are further problems found in the same input.
+    """
+
+    exit_code = 1
+
+    def __init__(
+        self, message: str, filename: Optional[str] = None, line: Optional[int] = None
+    ) -> None:
+        super().__init__(message)
+        self.message = message
+        self.filename = filename
+        self.line = line
+        self.diagnostics: List[Diagnostic] = []
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # keep it picklable, it is raised in the workers of parallel conversions
+        return (_rebuild_exception, (type(self), self.__dict__))
+
+    def location(self) -> str:
+        """FILE:LINE: or FILE: of the error, empty if it is unknown"""
+        if self.filename is None:
+            return ""
+        if self.line:
+            return f"{self.filename}:{self.line}: "
+        return f"{self.filename}: "
+
+    def describe(self) -> str:
+        """the error as reported by the command line interface"""
+        return self.location() + self.message
+
+
+def _rebuild_exception(cls: Type[Wiki2BeamerException], fields: Dict[str, Any]) -> Any:
+    e = cls.__new__(cls)
+    e.args = (fields["message"],)
+    e.__dict__.update(fields)
+    return e
+
+
+class SyntaxErrorException(Wiki2BeamerException):
+    """invalid wiki syntax, code is the part of the input it was found in"""
+
+    exit_code = -3
+
+    def __init__(
+        self, message: str, code: str, filename: Optional[str] = None, line: Optional[int] = None
+    ) -> None:
+        super().__init__(message, filename, line)
+        self.code = code
+
+    def describe(self) -> str:
+        return f"{self.location()}syntax error: {self.message}\n\tcode:\n{self.code}"
+
+
 def syntax_error(message: str, code: str) -> None:
-    pprint(f"syntax error: {message}", file=sys.stderr)
-    pprint(f"\tcode:\n{code}", file=sys.stderr)
-    sys.exit(-3)
+    raise SyntaxErrorException(message, code)
+
+
+class InputFileException(Wiki2BeamerException):
+    """an input or included file cannot be read"""
+
+    exit_code = -2
+
+
+class IncludeLoopException(Wiki2BeamerException):
+    exit_code = -2
+
+
+class ResourceLimitException(Wiki2BeamerException):
+    exit_code = -4
+
+    def __init__(self, limit: str, message: str) -> None:
+        super().__init__(message)
+        self.limit = limit
+
+    def describe(self) -> str:
+        return f"resource limit exceeded: {self.message}"
+
+
+# the limits of ResourceLimits, the dest of their command line options as well
+RESOURCE_LIMITS = (
+    "max_include_depth",
+    "max_include_bytes",
+    "max_overlays",
+    "max_output_bytes",
+    "max_line_length",
+    "timeout",
+)
+
+
+class ResourceLimits:
+    """limits for a single conversion, None means unlimited
 
+    The clock and the byte counters are reset by start(), they are kept per
+    thread so conversions running in different threads do not mix.
+    """
+
+    # checked against totals of the conversion, record() does not keep them
+    TOTALS = ("max_include_bytes", "max_output_bytes")
+
+    def __init__(  # noqa: PLR0913 # one argument per limit
+        self,
+        *,
+        max_include_depth: Optional[int] = None,
+        max_include_bytes: Optional[int] = None,
+        max_overlays: Optional[int] = None,
+        max_output_bytes: Optional[int] = None,
+        max_line_length: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.max_include_depth = max_include_depth
+        self.max_include_bytes = max_include_bytes
+        self.max_overlays = max_overlays
+        self.max_output_bytes = max_output_bytes
+        self.max_line_length = max_line_length
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def start(self) -> None:
+        """start a conversion"""
+        self._local.deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        self._local.include_bytes = 0
+        self._local.output_bytes = 0
+
+    def check(self, limit: str, value: int) -> None:
+        usage = getattr(self._local, "usage", None)
+        if usage is not None and limit not in self.TOTALS:
+            usage[limit] = max(usage.get(limit, 0), value)
+        maximum = getattr(self, limit)
+        if maximum is not None and value > maximum:
+            raise ResourceLimitException(limit, f"{limit} of {maximum} exceeded: {value}")
+
+    def check_deadline(self) -> None:
+        deadline = getattr(self._local, "deadline", None)
+        if deadline is not None and time.monotonic() > deadline:
+            raise ResourceLimitException("timeout", f"timeout of {self.timeout}s exceeded")
+
+    def check_lines(self, lines: List[str]) -> None:
+        """account for lines read from an input file, their length in characters, size in bytes"""
+        size = 0
+        for line in lines:
+            self.check("max_line_length", len(line))
+            size += len(line.encode("utf-8"))
+        self._local.include_bytes = getattr(self._local, "include_bytes", 0) + size
+        self.check("max_include_bytes", self._local.include_bytes)
+
+    def read_limit(self) -> Optional[int]:
+        """the most bytes the next input file may have, None if there is no limit"""
+        if self.max_include_bytes is None:
+            return None
+        return max(self.max_include_bytes - getattr(self._local, "include_bytes", 0), 0)
+
+    def check_read(self, filename: str, size: int) -> None:
+        """fail if an input file of size bytes is larger than read_limit()"""
+        limit = self.read_limit()
+        if limit is not None and size > limit:
+            raise ResourceLimitException(
+                "max_include_bytes",
+                f"max_include_bytes of {self.max_include_bytes} exceeded: "
+                f"{filename} is larger than the {limit} bytes left",
+            )
+
+    def add_output(self, size: int) -> None:
+        """account for size bytes of UTF-8 output"""
+        usage = getattr(self._local, "usage", None)
+        if usage is not None:
+            usage["output_bytes"] = usage.get("output_bytes", 0) + size
+        self._local.output_bytes = getattr(self._local, "output_bytes", 0) + size
+        self.check("max_output_bytes", self._local.output_bytes)
+
+    @contextlib.contextmanager
+    def record(self) -> Iterator[Dict[str, int]]:
+        """the usage of the limits within the with block in this thread, see replay()
+
+        That is the largest value checked of every limit that is not one of
+        the TOTALS, and the output bytes added.
+        """
+        outer = getattr(self._local, "usage", None)
+        usage: Dict[str, int] = {}
+        self._local.usage = usage
+        try:
+            yield usage
+        finally:
+            self._local.usage = outer
+            if outer is not None:
+                for limit, value in usage.items():
+                    if limit == "output_bytes":
+                        outer[limit] = outer.get(limit, 0) + value
+                    else:
+                        outer[limit] = max(outer.get(limit, 0), value)
+
+    def replay(self, usage: Dict[str, int]) -> None:
+        """account for the usage recorded by record() again, for output reused"""
+        self.check_deadline()
+        for limit, value in usage.items():
+            if limit == "output_bytes":
+                self.add_output(value)
+            else:
+                self.check(limit, value)
+
+    def remaining(self) -> "ResourceLimits":
+        """the limits of the rest of the current conversion, the time left as timeout"""
+        deadline = getattr(self._local, "deadline", None)
+        timeout = self.timeout if deadline is None else deadline - time.monotonic()
+        return ResourceLimits(**dict(self.limits(), timeout=timeout))
+
+    def limits(self) -> Dict[str, Any]:
+        """the limits by name, the keyword arguments of ResourceLimits"""
+        return {name: getattr(self, name) for name in RESOURCE_LIMITS}
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # the counters are per thread and not pickled, start() sets them
+        return (_rebuild_resource_limits, (self.limits(),))
+
+
+def _rebuild_resource_limits(limits: Dict[str, Any]) -> ResourceLimits:
+    return ResourceLimits(**limits)
 
-class IncludeLoopException(Exception):
-    pass
+
+_resource_limits: Optional[ResourceLimits] = None
+
+
+def set_resource_limits(limits: Optional[ResourceLimits]) -> None:
+    """enforce limits on all following conversions, None to remove them"""
+    global _resource_limits  # noqa: PLW0603
+    _resource_limits = limits
+
+
+def get_resource_limits() -> Optional[ResourceLimits]:
+    return _resource_limits
 
 
 lstbasicstyle: str = r"""{basic}{
@@ -112,19 +382,18 @@ class IncludeLoopException(Exception):
     ("titleframe", "True"),
 ]
 
+
+@functools.lru_cache(maxsize=None)
+def _regex(pattern: str, flags: int = 0) -> Pattern[str]:
+    """pattern compiled once, for the patterns of functions called for every line"""
+    return re.compile(pattern, flags)
+
+
 nowikistartre: Pattern[str] = re.compile(r"^<\[\s*nowiki\s*\]")
 nowikiendre: Pattern[str] = re.compile(r"^\[\s*nowiki\s*\]>")
 codestartre: Pattern[str] = re.compile(r"^<\[\s*code\s*\]")
 codeendre: Pattern[str] = re.compile(r"^\[\s*code\s*\]>")
 
-# lazy initialisation cache for file content
-_file_cache: Dict[str, List[str]] = {}
-
-
-def add_lines_to_cache(filename: str, lines: List[str]) -> None:
-    if filename not in _file_cache:
-        _file_cache[filename] = lines
-
 
 def get_nowikimode(line: str, nowikimode: bool) -> Tuple[str, bool]:  # noqa: FBT001 # TODO: Fix this
     if not nowikimode and nowikistartre.match(line) is not None:
@@ -148,11 +417,17 @@ def get_codemode(line: str, codemode: bool) -> Tuple[str, bool]:  # noqa: FBT001
 
 def joinLines(lines: List[str]) -> List[str]:  # noqa: N802 # TODO: Fix this
     """join lines ending with unescaped percent signs, unless inside codemode or nowiki mode"""
+    return [line for _, line in join_numbered_lines(lines)]
+
+
+def join_numbered_lines(lines: List[str]) -> List[Tuple[int, str]]:
+    """like joinLines, but also returns the number of the first input line of each result"""
     nowikimode = False
     codemode = False
     r = []  # result array
     s = ""  # new line
-    for _l in lines:
+    first = 0  # number of the first line joined into s
+    for number, _l in enumerate(lines, 1):
         (_, nowikimode) = get_nowikimode(_l, nowikimode)
         if not nowikimode:
             (_, codemode) = get_codemode(_l, codemode)
@@ -162,48 +437,518 @@ def joinLines(lines: List[str]) -> List[str]:  # noqa: N802 # TODO: Fix this
         if (
             not (nowikimode or codemode) and (len(l) > 1) and (l[-1] == "%") and (l[-2] != "\\")
         ) or (not (nowikimode or codemode) and (len(l) == 1) and (l[-1] == "%")):
+            first = first or number
             s += l[:-1]
         else:
             s += l
-            r.append(s)
+            r.append((first or number, s))
             s = ""
+            first = 0
 
     return r
 
 
-def read_file_to_lines(filename: str) -> List[str]:
-    """read file"""
+# files are read from this git revision instead of the disk, see set_git_rev
+_git_revision: Optional["GitRevision"] = None
+
+
+def set_git_rev(rev: Optional[str], directory: str = ".") -> None:
+    """read all files from revision rev of the git repository containing directory
+
+    File names are relative to the working directory as usual, None reads
+    files from the disk again. Raises OSError if there is no such revision.
+    """
+    global _git_revision  # noqa: PLW0603
+    if _git_revision is not None:
+        _git_revision.close()
+        _git_revision = None
+    if rev is not None:
+        from .gitrev import GitRevision
+
+        _git_revision = GitRevision(rev, directory)
+    # the cached files are from the other source
+    clear_file_cache()
+    with _bundles_lock:
+        _bundles.clear()
+
+
+def read_file_bytes(filename: str) -> bytes:
+    """the content of filename, from the revision set by set_git_rev if any"""
+    if _git_revision is not None:
+        return _git_revision.read(filename)
+    return Path(filename).read_bytes()
+
+
+# a member of a zip bundle is named bundle.zip::member, bundle.zip alone is
+# its first member
+BUNDLE_SEPARATOR = "::"
+
+# what a file read is checked against, see file_signature
+FileSignature = Tuple[Union[int, str], ...]
+
+# the zip bundles read last, by file name
+_bundles: Dict[str, Tuple[Optional[FileSignature], "zipfile.ZipFile"]] = {}
+_bundles_max = 4
+_bundles_lock = threading.Lock()
+
+
+def split_bundle_path(filename: str) -> Optional[Tuple[str, Optional[str]]]:
+    """(bundle, member) if filename is in a zip bundle, member None for the first one"""
+    (bundle, separator, member) = filename.partition(BUNDLE_SEPARATOR)
+    if separator:
+        return (bundle, member)
+    if filename.lower().endswith(".zip"):
+        return (filename, None)
+    return None
+
+
+def resolve_include(including: str, include: str) -> str:
+    """the file name of include when included by the file including
+
+    Includes of files in a zip bundle are members of the same bundle, all
+    others are relative to the working directory as always.
+    """
+    bundle = split_bundle_path(including)
+    if bundle is None or BUNDLE_SEPARATOR in include:
+        return include
+    return bundle[0] + BUNDLE_SEPARATOR + include
+
+
+def read_bundle(bundle: str) -> "zipfile.ZipFile":
+    """the zip file bundle, read with a single read of the file
+
+    The members are decompressed when they are read, see read_bundle_member.
+    """
+    import zipfile
+
+    signature = file_signature(bundle)
+    with _bundles_lock:
+        entry = _bundles.get(bundle)
+        if entry is not None and entry[0] == signature:
+            _bundles[bundle] = _bundles.pop(bundle)
+            return entry[1]
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(read_file_bytes(bundle)))
+    except (zipfile.BadZipFile, EOFError) as e:
+        message = f"cannot read bundle {bundle}: {e}"
+        raise OSError(message) from e
+    with _bundles_lock:
+        _bundles[bundle] = (signature, archive)
+        while len(_bundles) > _bundles_max:
+            del _bundles[next(iter(_bundles))]
+    return archive
+
+
+def read_bundle_member(bundle: str, member: Optional[str]) -> Tuple[str, bytes]:
+    """(member, content) of member of the zip file bundle, None for the first one"""
+    import zipfile
+
+    archive = read_bundle(bundle)
+    members = [info for info in archive.infolist() if not info.is_dir()]
+    if member is None:
+        if not members:
+            message = f"empty bundle: {bundle}"
+            raise OSError(message)
+        member = members[0].filename
+    info = next((info for info in members if info.filename == member), None)
+    if info is None:
+        message = f"no {member} in bundle {bundle}"
+        raise OSError(message)
     try:
-        f = codecs.open(filename, "r", encoding="UTF-8")
-        lines = joinLines(f.readlines())
-        f.close()
-    except Exception:  # noqa: BLE001 # TODO: Fix this
-        pprint(f"Cannot read file: {filename}", sys.stderr)
-        sys.exit(-2)
+        with archive.open(info) as f:
+            return (member, read_input(member, f, info.file_size))
+    except (zipfile.BadZipFile, EOFError) as e:
+        message = f"cannot read {member} from bundle {bundle}: {e}"
+        raise OSError(message) from e
+
+
+def _open_decompressed(filename: str, f: IO[bytes]) -> Optional[io.BufferedIOBase]:
+    """f decompressed according to the .gz, .xz or .bz2 suffix of filename, if it has one"""
+    suffix = Path(filename).suffix.lower()
+    if suffix == ".gz":
+        import gzip
+
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    if suffix == ".xz":
+        return lzma.LZMAFile(f)
+    if suffix == ".bz2":
+        return bz2.BZ2File(f)
+    return None
 
-    return lines
 
+def read_input(filename: str, f: IO[bytes], size: Optional[int] = None) -> bytes:
+    """the content of the input file filename, read from f and decompressed
 
-def get_lines_from_cache(filename: str) -> List[str]:
-    if filename in _file_cache:
-        return _file_cache[filename]
-    lines = read_file_to_lines(filename)
-    _file_cache[filename] = lines
+    size is the size of the file if it is known before reading it. The read
+    stops as soon as the content is larger than the include bytes left under
+    the resource limits: a file too large is not read in full, a compressed
+    one is not inflated in full.
+    """
+    limits = _resource_limits
+    limit = None if limits is None else limits.read_limit()
+    decompressed = _open_decompressed(filename, f)
+    if decompressed is None and limits is not None and size is not None:
+        limits.check_read(filename, size)
+    reader: Union[IO[bytes], io.BufferedIOBase] = f if decompressed is None else decompressed
+    try:
+        data = reader.read() if limit is None else reader.read(limit + 1)
+    except OSError:
+        raise
+    except Exception as e:  # lzma and bz2 have their own errors
+        message = f"cannot decompress {filename}: {e}"
+        raise OSError(message) from e
+    finally:
+        if decompressed is not None:
+            decompressed.close()
+    if limits is not None:
+        limits.check_read(filename, len(data))
+    return data
+
+
+def read_source(filename: str) -> List[str]:
+    """the lines of file, a member of a zip bundle or compressed, ends of line kept
+
+    Raises OSError or UnicodeError if it cannot be read, ResourceLimitException
+    if it is larger than the resource limits allow.
+    """
+    filename = os.fspath(filename)
+    bundle = split_bundle_path(filename)
+    if bundle is not None:
+        (filename, data) = read_bundle_member(*bundle)
+    elif _git_revision is not None:
+        blob = _git_revision.read(filename)
+        data = read_input(filename, io.BytesIO(blob), len(blob))
+    else:
+        with Path(filename).open("rb") as f:
+            data = read_input(filename, f, os.fstat(f.fileno()).st_size)
+    lines = data.decode("utf-8").splitlines(keepends=True)
+    if _git_revision is not None and bundle is None:
+        # ask git for all includes of the file at once, not one after the other
+        includes = (include_file(line.rstrip()) for line in lines)
+        _git_revision.prefetch(resolve_include(filename, i) for i in includes if i is not None)
     return lines
 
 
-def clear_file_cache() -> None:
-    _file_cache.clear()
+def read_lines(filename: str) -> List[str]:
+    """read file, raises OSError or UnicodeError if it cannot be read"""
+    return joinLines(read_source(filename))
 
 
-try:
-    from collections import OrderedDict
+def read_file_to_lines(filename: str) -> List[str]:
+    """read file"""
+    try:
+        lines = read_lines(filename)
+    except (OSError, UnicodeError) as e:
+        message = f"cannot read file: {filename}"
+        raise InputFileException(message) from e
+
+    return lines
 
+
+try:
     maybe_odict: Type[Dict[str, str]] = OrderedDict
 except ImportError:
     maybe_odict = dict
 
 
+def file_signature(filename: str) -> Optional[FileSignature]:
+    """(mtime, size, inode) of a file, None if it does not exist
+
+    The members of a zip bundle have the signature of the bundle. Files read
+    from git have the commit of the revision, their content never changes.
+    """
+    if _git_revision is not None:
+        return (_git_revision.commit,)
+    bundle = split_bundle_path(os.fspath(filename))
+    if bundle is not None:
+        filename = bundle[0]
+    try:
+        st = Path(filename).stat()
+    except (OSError, ValueError):
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class FileCache:
+    """thread safe LRU cache for the lines of files, limited to max_bytes of UTF-8
+
+    Entries read from a file are checked against its file_signature on every
+    lookup and dropped if it changed. Entries added
+    without a signature (stdin, content set up by the caller) cannot be read
+    again, they are never evicted or invalidated.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None) -> None:
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: OrderedDict[Any, Tuple[List[str], Optional[FileSignature], int]] = (
+            OrderedDict()
+        )
+        self._lock = threading.RLock()
+
+    def __contains__(self, filename: Any) -> bool:
+        with self._lock:
+            return filename in self._entries
+
+    def get(self, filename: Any) -> Optional[List[str]]:
+        """cached lines of filename, None if they are not cached or outdated"""
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry[1] is not None and file_signature(filename) != entry[1]:
+                self._remove(filename)
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(filename)
+            self.hits += 1
+            return entry[0]
+
+    def get_pinned(self, filename: Any) -> Optional[List[str]]:
+        """lines added without a signature, None for anything else"""
+        with self._lock:
+            entry = self._entries.get(filename)
+            return entry[0] if entry is not None and entry[1] is None else None
+
+    def add(
+        self,
+        filename: Any,
+        lines: List[str],
+        signature: Optional[FileSignature] = None,
+    ) -> None:
+        size = sum(len(line.encode("utf-8")) for line in lines)
+        with self._lock:
+            if filename in self._entries:
+                self._remove(filename)
+            if signature is not None and self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[filename] = (lines, signature, size)
+            self.bytes += size
+            self._evict()
+
+    def remove(self, filename: Any) -> None:
+        with self._lock:
+            if filename in self._entries:
+                self._remove(filename)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def set_max_bytes(self, max_bytes: Optional[int]) -> None:
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def _remove(self, filename: Any) -> None:
+        self.bytes -= self._entries.pop(filename)[2]
+
+    def _evict(self) -> None:
+        if self.max_bytes is None:
+            return
+        for filename in list(self._entries):
+            if self.bytes <= self.max_bytes:
+                break
+            if self._entries[filename][1] is not None:
+                self._remove(filename)
+                self.evictions += 1
+
+
+class SharedFileCache:
+    """cache for the lines of files shared between processes, in a directory
+
+    Every file read has a subdirectory named by the hash of its path, with
+    an entry named by the file_signature of the version read, holding its
+    lines after joinLines(). Entries are written once, atomically, and read
+    through mmap, so the content of a file is in memory once, in the page
+    cache, however many processes read it. What is shared is the work of
+    reading, decompressing and joining the file and the memory of its
+    content, not that of its lines: every process decodes an entry into
+    lines of its own.
+
+    A changed file gets a new entry, the entries of its old versions are
+    removed. After every max_bytes / 16 written, the least recently used
+    entries are removed while the directory holds more than max_bytes.
+    """
+
+    MAGIC = b"w2blines1\n"
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._written = 0  # bytes of entries added since the last collect()
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _key(filename: str) -> str:
+        path = str(Path(filename).resolve())
+        return hashlib.sha256(path.encode("utf-8")).hexdigest()
+
+    def _entry(self, filename: str, signature: FileSignature) -> str:
+        version = "-".join(str(x) for x in signature)
+        return str(Path(self.directory, self._key(filename), version))
+
+    def get(self, filename: str, signature: FileSignature) -> Optional[List[str]]:
+        """the lines stored for filename with signature, None if there are none"""
+        import mmap
+
+        entry = self._entry(filename, signature)
+        try:
+            with Path(entry).open("rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with data:
+                # the mtime of an entry is when it was used last
+                os.utime(entry)
+                if data[: len(self.MAGIC)] != self.MAGIC:
+                    return None
+                offset = len(self.MAGIC)
+                (count,) = struct.unpack_from("<Q", data, offset)
+                offset += 8
+                lengths = struct.unpack_from(f"<{count}Q", data, offset)
+                with memoryview(data) as view, view[offset + 8 * count :] as content:
+                    text = str(content, "utf-8")
+        except (OSError, ValueError, struct.error):
+            # missing, empty, or truncated by something else than wiki2beamer
+            return None
+        lines = []
+        start = 0
+        for length in lengths:
+            lines.append(text[start : start + length])
+            start += length
+        return lines if start == len(text) else None
+
+    def add(self, filename: str, signature: FileSignature, lines: List[str]) -> None:
+        data = b"".join(
+            [
+                self.MAGIC,
+                struct.pack(f"<Q{len(lines)}Q", len(lines), *(len(line) for line in lines)),
+                "".join(lines).encode("utf-8"),
+            ]
+        )
+        entry = Path(self._entry(filename, signature))
+        entry.parent.mkdir(exist_ok=True)
+        try:
+            write_file_if_changed(str(entry), data)
+        except FileNotFoundError:
+            # collect() of another process removed the directory while it was empty
+            entry.parent.mkdir(exist_ok=True)
+            write_file_if_changed(str(entry), data)
+        # the other entries of the file are of the versions it had before,
+        # temporary files of write_file_if_changed start with a dot
+        with contextlib.suppress(OSError):
+            for old in entry.parent.iterdir():
+                if old != entry and not old.name.startswith("."):
+                    self._remove(str(old))
+        # collect() looks at every entry, not at every add
+        self._written += len(data)
+        if self._written >= self.max_bytes // 16:
+            self.collect(keep=str(entry))
+
+    def collect(self, keep: Optional[str] = None) -> None:
+        """remove the least recently used entries while there are more than max_bytes
+
+        keep is an entry just written, it is not removed.
+        """
+        self._written = 0
+        entries = []
+        try:
+            directories = [path for path in Path(self.directory).iterdir() if path.is_dir()]
+        except OSError:
+            return
+        for directory in directories:
+            with contextlib.suppress(OSError):
+                for item in directory.iterdir():
+                    if item.name.startswith("."):
+                        continue
+                    with contextlib.suppress(OSError):
+                        st = item.stat()
+                        entries.append((st.st_mtime_ns, st.st_size, str(item)))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            if path != keep:
+                self._remove(path)
+                # only removed once the last entry of the file is
+                with contextlib.suppress(OSError):
+                    Path(path).parent.rmdir()
+                size -= entry_size
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        # another process may have removed it, or still read it on Windows
+        with contextlib.suppress(OSError):
+            Path(path).unlink()
+
+
+# lazy initialisation cache for file content
+_file_cache = FileCache(64 * 1024 * 1024)
+_shared_file_cache: Optional[SharedFileCache] = None
+
+
+def set_shared_cache(directory: Optional[str]) -> None:
+    """share the lines of the files read with other processes through directory"""
+    global _shared_file_cache  # noqa: PLW0603
+    _shared_file_cache = SharedFileCache(directory) if directory is not None else None
+
+
+def add_lines_to_cache(filename: str, lines: List[str]) -> None:
+    if filename not in _file_cache:
+        _file_cache.add(filename, lines)
+
+
+def get_lines_from_cache(
+    filename: str, reader: Callable[[str], List[str]] = read_file_to_lines
+) -> List[str]:
+    lines = _file_cache.get(filename)
+    if lines is None:
+        signature = file_signature(filename)
+        shared = _shared_file_cache
+        if shared is not None and signature is not None:
+            lines = shared.get(filename, signature)
+        if lines is None:
+            lines = reader(filename)
+            if shared is not None and signature is not None:
+                shared.add(filename, signature, lines)
+        _file_cache.add(filename, lines, signature)
+    return lines
+
+
+def clear_file_cache(filename: Optional[str] = None) -> None:
+    """drop filename or, by default, everything from the file cache"""
+    if filename is None:
+        _file_cache.clear()
+    else:
+        _file_cache.remove(filename)
+
+
+def set_file_cache_limit(max_bytes: Optional[int]) -> None:
+    """limit the file cache to max_bytes, the UTF-8 size of the lines, None for no limit"""
+    _file_cache.set_max_bytes(max_bytes)
+
+
+def file_cache_stats() -> Dict[str, int]:
+    """entries, bytes, hits, misses, evictions and invalidations of the file cache"""
+    return _file_cache.stats()
+
+
 class w2bstate:  # noqa: N801 # TODO: Fix this
     def __init__(self) -> None:
         self.frame_opened = False
@@ -217,14 +962,21 @@ def __init__(self) -> None:
         self.defverbs: Dict[str, str] = maybe_odict()
         self.code_pos = 0
         self.active_envs: Dict[str, int] = dict()
+        self.counters: Dict[str, int] = {}
+        # the index in the result of every opening generated, with its autotemplate
+        self.openings: Dict[int, List[Tuple[str, str]]] = {}
 
     def switch_to_next_frame(self) -> None:
         self.frame_header = self.next_frame_header
         self.frame_footer = self.next_frame_footer
 
+    def count(self, counter: str, n: int = 1) -> None:
+        """add n to one of the counters reported by --stats"""
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
 
 def escape_resub(string: str) -> str:
-    p = re.compile(r"\\")
+    p = _regex(r"\\")
     return p.sub(r"\\\\", string)
 
 
@@ -233,7 +985,7 @@ def transform_itemenums(string: str, state: w2bstate) -> str:
     preamble = ""  # for enumeration/itemize environment commands
 
     # handle itemizing/enumerations
-    p = re.compile(r"^([\*\#]+).*$")
+    p = _regex(r"^([\*\#]+).*$")
     m = p.match(string)
     my_enum_item_level = "" if m is None else m.group(1)
 
@@ -266,20 +1018,32 @@ def transform_itemenums(string: str, state: w2bstate) -> str:
     state.enum_item_level = my_enum_item_level
 
     # now, substitute item markers
-    p = re.compile(r"^([\*\#]+)((?:\[[^\]*]\])?)\s*(.*)$")
+    p = _regex(r"^([\*\#]+)((?:\[[^\]*]\])?)\s*(.*)$")
     _string = p.sub(r"  \\item\2 \3", string)
     return preamble + _string
 
 
+# the patterns of the lines that change the state of a conversion, shared by
+# the transforms and advance_state
+_frameheaderre: Pattern[str] = re.compile("^@FRAMEHEADER=(.*)$", re.VERBOSE)
+_framefooterre: Pattern[str] = re.compile("^@FRAMEFOOTER=(.*)$", re.VERBOSE)
+_frameclosere: Pattern[str] = re.compile(r"\[\s*frame\s*\]>")
+_titleslidere: Pattern[str] = re.compile(r"^=!\s*(.*?)\s*!=(.*)", re.VERBOSE)
+_h4re: Pattern[str] = re.compile(r"^!?====\s*(.*?)\s*====(.*)", re.VERBOSE)
+_h3re: Pattern[str] = re.compile(r"^===\s*(.*?)\s*===(.*)", re.VERBOSE)
+_h2re: Pattern[str] = re.compile(r"^==\s*(.*?)\s*==(.*)", re.VERBOSE)
+_envopenre: Pattern[str] = re.compile(r"^<\[([^{}]*?)\]", re.VERBOSE)
+_envclosere: Pattern[str] = re.compile(r"^\[([^{}]*?)\]>", re.VERBOSE)
+_itemenumre: Pattern[str] = re.compile(r"^([\*\#]+).*$")
+
+
 def transform_define_foothead(string: str, state: w2bstate) -> str:
     """header and footer definitions"""
-    p = re.compile("^@FRAMEHEADER=(.*)$", re.VERBOSE)
-    m = p.match(string)
+    m = _frameheaderre.match(string)
     if m is not None:
         state.next_frame_header = m.group(1)
         string = ""
-    p = re.compile("^@FRAMEFOOTER=(.*)$", re.VERBOSE)
-    m = p.match(string)
+    m = _framefooterre.match(string)
     if m is not None:
         state.next_frame_footer = m.group(1)
         string = ""
@@ -288,8 +1052,7 @@ def transform_define_foothead(string: str, state: w2bstate) -> str:
 
 def transform_detect_manual_frameclose(string: str, state: w2bstate) -> str:
     """detect manual closing of frames"""
-    p = re.compile(r"\[\s*frame\s*\]>")
-    if state.frame_opened and p.match(string) is not None:
+    if state.frame_opened and _frameclosere.match(string) is not None:
         state.frame_opened = False
     return string
 
@@ -304,16 +1067,15 @@ def transform_spec_to_title_slide(string: str, state: w2bstate) -> str:
     )
     frame_closing = escape_resub(get_frame_closing(state))
 
-    p = re.compile(r"^=!\s*(.*?)\s*!=(.*)", re.VERBOSE)
-
     if not state.frame_opened:
-        _string = p.sub(frame_opening, string)
+        _string = _titleslidere.sub(frame_opening, string)
     else:
-        _string = p.sub(frame_closing + frame_opening, string)
+        _string = _titleslidere.sub(frame_closing + frame_opening, string)
 
     if string != _string:
         state.frame_opened = True
         state.switch_to_next_frame()
+        state.count("frames")
 
     return _string
 
@@ -325,15 +1087,15 @@ def transform_h4_to_frame(string: str, state: w2bstate) -> str:
     )
     frame_closing = escape_resub(get_frame_closing(state))
 
-    p = re.compile(r"^!?====\s*(.*?)\s*====(.*)", re.VERBOSE)
     if not state.frame_opened:
-        _string = p.sub(frame_opening, string)
+        _string = _h4re.sub(frame_opening, string)
     else:
-        _string = p.sub(frame_closing + frame_opening, string)
+        _string = _h4re.sub(frame_closing + frame_opening, string)
 
     if string != _string:
         state.frame_opened = True
         state.switch_to_next_frame()
+        state.count("frames")
 
     return _string
 
@@ -343,13 +1105,13 @@ def transform_h3_to_subsec(string: str, state: w2bstate) -> str:
     frame_closing = escape_resub(get_frame_closing(state))
     subsec_opening = r"\n\\subsection\2{\1}\n\n"
 
-    p = re.compile(r"^===\s*(.*?)\s*===(.*)", re.VERBOSE)
     if state.frame_opened:
-        _string = p.sub(frame_closing + subsec_opening, string)
+        _string = _h3re.sub(frame_closing + subsec_opening, string)
     else:
-        _string = p.sub(subsec_opening, string)
+        _string = _h3re.sub(subsec_opening, string)
     if string != _string:
         state.frame_opened = False
+        state.count("subsections")
 
     return _string
 
@@ -358,13 +1120,13 @@ def transform_h2_to_sec(string: str, state: w2bstate) -> str:
     """headings (1) to sections"""
     frame_closing = escape_resub(get_frame_closing(state))
     sec_opening = r"\n\\section\2{\1}\n\n"
-    p = re.compile(r"^==\s*(.*?)\s*==(.*)", re.VERBOSE)
     if state.frame_opened:
-        _string = p.sub(frame_closing + sec_opening, string)
+        _string = _h2re.sub(frame_closing + sec_opening, string)
     else:
-        _string = p.sub(sec_opening, string)
+        _string = _h2re.sub(sec_opening, string)
     if string != _string:
         state.frame_opened = False
+        state.count("sections")
 
     return _string
 
@@ -384,35 +1146,33 @@ def transform_environments(string: str, state: w2bstate) -> str:
     [block]>
     """
     # -> open
-    p = re.compile(r"^<\[([^{}]*?)\]", re.VERBOSE)
-    m = re.match(p, string)
+    m = _envopenre.match(string)
     if m is not None and m.group(1).strip() != "frame":
         state.active_envs[m.group(1).strip()] = 1
-    string = p.sub(r"\\begin{\1}", string)
+    string = _envopenre.sub(r"\\begin{\1}", string)
 
     # -> close
-    p = re.compile(r"^\[([^{}]*?)\]>", re.VERBOSE)
-    m = re.match(p, string)
+    m = _envclosere.match(string)
     if m is not None and m.group(1).strip() != "frame":
         del state.active_envs[m.group(1).strip()]
-    return p.sub(r"\\end{\1}", string)
+    return _envclosere.sub(r"\\end{\1}", string)
 
 
 def transform_columns(string: str) -> str:
     """columns"""
-    p = re.compile(r"^\[\[\[(.*?)\]\]\]", re.VERBOSE)
+    p = _regex(r"^\[\[\[(.*?)\]\]\]", re.VERBOSE)
     return p.sub(r"\\column{\1}", string)
 
 
 def transform_boldfont(string: str) -> str:
     """bold font"""
-    p = re.compile("'''(.*?)'''", re.VERBOSE)
+    p = _regex("'''(.*?)'''", re.VERBOSE)
     return p.sub(r"\\textbf{\1}", string)
 
 
 def transform_italicfont(string: str) -> str:
     """italic font"""
-    p = re.compile("''(.*?)''", re.VERBOSE)
+    p = _regex("''(.*?)''", re.VERBOSE)
     return p.sub(r"\\emph{\1}", string)
 
 
@@ -475,63 +1235,63 @@ def maybe_replace(m: Match[str]) -> str:
     if "equation" in state.active_envs:
         return string
 
-    p = re.compile(r"(\<\<\<)(.*?)\>\>\>", re.VERBOSE)
+    p = _regex(r"(\<\<\<)(.*?)\>\>\>", re.VERBOSE)
     graphics = list(p.finditer(string))
-    p = re.compile("_([^_\\\\{}]*?)_([^_]*?[^_\\\\{}])_", re.VERBOSE)
+    p = _regex("_([^_\\\\{}]*?)_([^_]*?[^_\\\\{}])_", re.VERBOSE)
     return p.sub(maybe_replace, string)
 
 
 def transform_footnotes(string: str) -> str:
     """footnotes"""
-    p = re.compile(r"\(\(\((.*?)\)\)\)", re.VERBOSE)
+    p = _regex(r"\(\(\((.*?)\)\)\)", re.VERBOSE)
     return p.sub(r"\\footnote{\1}", string)
 
 
 def transform_graphics(string: str) -> str:
     """figures/images"""
-    p = re.compile(r"\<\<\<(.*?),(.*?)\>\>\>", re.VERBOSE)
+    p = _regex(r"\<\<\<(.*?),(.*?)\>\>\>", re.VERBOSE)
     string = p.sub(r"\\includegraphics[\2]{\1}", string)
-    p = re.compile(r"\<\<\<(.*?)\>\>\>", re.VERBOSE)
+    p = _regex(r"\<\<\<(.*?)\>\>\>", re.VERBOSE)
     return p.sub(r"\\includegraphics{\1}", string)
 
 
 def transform_substitutions(string: str) -> str:
     """substitutions"""
-    p = re.compile(r"(\s)-->(\s)", re.VERBOSE)
+    p = _regex(r"(\s)-->(\s)", re.VERBOSE)
     string = p.sub(r"\1$\\rightarrow$\2", string)
-    p = re.compile(r"(\s)<--(\s)", re.VERBOSE)
+    p = _regex(r"(\s)<--(\s)", re.VERBOSE)
     string = p.sub(r"\1$\\leftarrow$\2", string)
-    p = re.compile(r"(\s)==>(\s)", re.VERBOSE)
+    p = _regex(r"(\s)==>(\s)", re.VERBOSE)
     string = p.sub(r"\1$\\Rightarrow$\2", string)
-    p = re.compile(r"(\s)<==(\s)", re.VERBOSE)
+    p = _regex(r"(\s)<==(\s)", re.VERBOSE)
     string = p.sub(r"\1$\\Leftarrow$\2", string)
-    p = re.compile(r"(\s):-\)(\s)", re.VERBOSE)
+    p = _regex(r"(\s):-\)(\s)", re.VERBOSE)
     string = p.sub(r"\1\\smiley\2", string)
-    p = re.compile(r"(\s):-\((\s)", re.VERBOSE)
+    p = _regex(r"(\s):-\((\s)", re.VERBOSE)
     return p.sub(r"\1\\frownie\2", string)
 
 
 def transform_vspace(string: str) -> str:
     """vspace"""
-    p = re.compile(r"^\s*--(.*)--\s*$")
+    p = _regex(r"^\s*--(.*)--\s*$")
     return p.sub(r"\n\\vspace{\1}\n", string)
 
 
 def transform_vspacestar(string: str) -> str:
     """vspace*"""
-    p = re.compile(r"^\s*--\*(.*)--\s*$")
+    p = _regex(r"^\s*--\*(.*)--\s*$")
     return p.sub(r"\n\\vspace*{\1}\n", string)
 
 
 def transform_uncover(string: str) -> str:
     """uncover"""
-    p = re.compile(r"\+<(.*)>\s*{(.*)")  # +<1-2>{.... -> \uncover<1-2>{....
+    p = _regex(r"\+<(.*)>\s*{(.*)")  # +<1-2>{.... -> \uncover<1-2>{....
     return p.sub(r"\\uncover<\1>{\2", string)
 
 
 def transform_only(string: str) -> str:
     """only"""
-    p = re.compile(r"-<(.*)>\s*{(.*)")  # -<1-2>{.... -> \only<1-2>{....
+    p = _regex(r"-<(.*)>\s*{(.*)")  # -<1-2>{.... -> \only<1-2>{....
     return p.sub(r"\\only<\1>{\2", string)
 
 
@@ -547,6 +1307,8 @@ def transform(string: str, state: w2bstate) -> str:
     string = transform_h2_to_sec(string, state)
     string = transform_replace_headfoot(string, state)
 
+    if _line_plugins:
+        string = run_plugins(_line_plugins, string, state)
     string = transform_environments(string, state)
     string = transform_columns(string)
     string = transform_boldfont(string)
@@ -561,10 +1323,95 @@ def transform(string: str, state: w2bstate) -> str:
     string = transform_vspace(string)
     string = transform_uncover(string)
     string = transform_only(string)
+    if _inline_plugins:
+        string = run_plugins(_inline_plugins, string, state)
 
     return transform_itemenums(string, state)
 
 
+class Plugin:
+    """a transform of lines added to transform() by register_plugin
+
+    function gets the line, and the w2bstate if needs_state is set, and
+    returns it transformed. It only runs on lines containing one of the
+    triggers, never on nowiki or code content. Line plugins see the wiki
+    line after headings and frame headers are done, inline plugins the
+    LaTeX after the built-in inline markup.
+    """
+
+    def __init__(  # noqa: PLR0913 # the options of a plugin are keyword arguments
+        self,
+        name: str,
+        function: Callable[..., str],
+        triggers: Iterable[str],
+        *,
+        stage: str = "inline",
+        needs_state: bool = False,
+        version: str = "",
+    ) -> None:
+        self.name = name
+        self.function = function
+        self.triggers = tuple(triggers)
+        self.stage = stage
+        self.needs_state = needs_state
+        self.version = version
+        if not self.triggers or "" in self.triggers:
+            message = f"plugin {name} needs non-empty trigger substrings"
+            raise ValueError(message)
+        if stage not in {"line", "inline"}:
+            message = f"unknown plugin stage: {stage}"
+            raise ValueError(message)
+
+    def key(self) -> str:
+        """what the output depends on, change version when function changes its output"""
+        return f"{self.name}:{self.version}:{self.stage}:{','.join(self.triggers)}"
+
+
+# registered plugins by stage, in the order they run
+_line_plugins: List[Plugin] = []
+_inline_plugins: List[Plugin] = []
+
+
+def register_plugin(  # noqa: PLR0913 # the arguments of Plugin
+    name: str,
+    function: Callable[..., str],
+    triggers: Iterable[str],
+    *,
+    stage: str = "inline",
+    needs_state: bool = False,
+    version: str = "",
+) -> Plugin:
+    """add a transform to transform(), see Plugin, a plugin of the same name is replaced"""
+    plugin = Plugin(name, function, triggers, stage=stage, needs_state=needs_state, version=version)
+    unregister_plugin(name)
+    (_line_plugins if stage == "line" else _inline_plugins).append(plugin)
+    return plugin
+
+
+def unregister_plugin(name: str) -> None:
+    for plugins in (_line_plugins, _inline_plugins):
+        plugins[:] = [plugin for plugin in plugins if plugin.name != name]
+
+
+def get_plugins() -> List[Plugin]:
+    return _line_plugins + _inline_plugins
+
+
+def load_plugin(module: str) -> None:
+    """import module, which registers its plugins when imported"""
+    importlib.import_module(module)
+
+
+def run_plugins(plugins: List[Plugin], string: str, state: w2bstate) -> str:
+    for plugin in plugins:
+        if any(trigger in string for trigger in plugin.triggers):
+            if plugin.needs_state:
+                string = plugin.function(string, state)
+            else:
+                string = plugin.function(string)
+    return string
+
+
 def expand_code_make_defverb(content: str, name: str) -> str:
     return f"\\defverbatim[colored]\\{name}{{\n{content}\n}}"
 
@@ -573,12 +1420,34 @@ def expand_code_make_lstlisting(content: str, options: str) -> str:
     return f"\\begin{{lstlisting}}{options}{content}\\end{{lstlisting}}"
 
 
+# how code blocks are written: "listings" or "verbatim", see highlight.py
+_code_backend = "listings"
+
+
+def set_code_backend(backend: str) -> None:
+    global _code_backend  # noqa: PLW0603
+    if backend not in {"listings", "verbatim"}:
+        message = f"unknown code backend: {backend}"
+        raise ValueError(message)
+    _code_backend = backend
+
+
+def expand_code_make_listing(content: str, options: str) -> str:
+    if _code_backend == "verbatim":
+        from .highlight import make_verbatim
+
+        return make_verbatim(content, options)
+    return expand_code_make_lstlisting(content, options)
+
+
 def expand_code_search_escape_sequences(code: str) -> Tuple[str, str]:
+    # seeded from the code, the result must not depend on the process doing the work
+    rng = random.Random(code)
     esc_open = "1"
     esc_close = "2"
     while code.find(esc_open) != -1 or code.find(esc_close) != -1:
-        esc_open += chr(random.randint(48, 57))
-        esc_close += chr(random.randint(48, 57))
+        esc_open += chr(rng.randint(48, 57))
+        esc_close += chr(rng.randint(48, 57))
 
     return (esc_open, esc_close)
 
@@ -589,7 +1458,7 @@ def expand_code_tokenize_anims(code: str) -> Tuple[List[str], List[str]]:
     code = code.replace("\\[", esc_open)
     code = code.replace("\\]", esc_close)
 
-    p = re.compile(r"\[\[(?:.|\s)*?\]\]|\[(?:.|\s)*?\]")
+    p = _regex(r"\[\[(?:.|\s)*?\]\]|\[(?:.|\s)*?\]")
     non_anim = p.split(code)
     anim = p.findall(code)
 
@@ -600,9 +1469,6 @@ def expand_code_tokenize_anims(code: str) -> Tuple[List[str], List[str]]:
     return (anim, non_anim)
 
 
-T = TypeVar("T")
-
-
 def make_unique(seq: List[T]) -> List[T]:
     """remove duplicate elements in a list, does not preserve order"""
     keys: Dict[T, int] = {}
@@ -631,6 +1497,8 @@ def expand_code_parse_overlayspec(overlayspec: str) -> List[int]:
                         overlayspec,
                     )
 
+                if _resource_limits is not None:
+                    _resource_limits.check("max_overlays", stop)
                 overlays.extend(list(range(start, stop + 1)))
         else:
             try:
@@ -639,6 +1507,8 @@ def expand_code_parse_overlayspec(overlayspec: str) -> List[int]:
                 syntax_error(
                     "not an int, overlay specs must be of the form <(%d-%d)|(%d), ...>", overlayspec
                 )
+            if _resource_limits is not None:
+                _resource_limits.check("max_overlays", num)
             overlays.append(num)
 
     # make unique
@@ -651,7 +1521,7 @@ def expand_code_parse_simpleanimspec(animspec: str) -> List[Tuple[int, str]]:
     animspec = animspec.replace("\\[", esc_open)
     animspec = animspec.replace("\\]", esc_close)
 
-    p = re.compile(r"^\[<([0-9,\-]+)>((?:.|\s)*)\]$")
+    p = _regex(r"^\[<([0-9,\-]+)>((?:.|\s)*)\]$")
     m = p.match(animspec)
     if m is not None:
         overlays = expand_code_parse_overlayspec(m.group(1))
@@ -674,7 +1544,7 @@ def expand_code_parse_animspec(animspec: str) -> Tuple[str, List[Tuple[int, str]
     animspec = animspec.replace("\\[", esc_open)
     animspec = animspec.replace("\\]", esc_close)
 
-    p = re.compile(r"\[|\]\[|\]")
+    p = _regex(r"\[|\]\[|\]")
     simple_specs = [f"[{s}]" for s in [s for s in p.split(animspec) if len(s.strip()) > 0]]
 
     # unescape
@@ -760,12 +1630,13 @@ def expand_code_get_unique_name(
 ) -> Tuple[str, str]:
     """generate a collision free entry in the defverbs-map and names-list"""
     name = expand_code_getname(code)
-    expanded_code = expand_code_make_defverb(expand_code_make_lstlisting(code, lstparams), name)
+    expanded_code = expand_code_make_defverb(expand_code_make_listing(code, lstparams), name)
+    rng = random.Random(expanded_code)
     rehash = ""
     while name in defverbs and defverbs[name] != expanded_code:
-        rehash += chr(random.randint(65, 90))  # append a character from A-Z to rehash value
+        rehash += chr(rng.randint(65, 90))  # append a character from A-Z to rehash value
         name = expand_code_getname(code + rehash)
-        expanded_code = expand_code_make_defverb(expand_code_make_lstlisting(code, lstparams), name)
+        expanded_code = expand_code_make_defverb(expand_code_make_listing(code, lstparams), name)
 
     return (name, expanded_code)
 
@@ -784,6 +1655,7 @@ def expand_code_segment(result: List[str], codebuffer: List[str], state: w2bstat
 
     # join lines into one string
     code = "".join(codebuffer)
+    state.count("code_blocks")
 
     # tokenize code into anim and non_anim parts
     (anim, non_anim) = expand_code_tokenize_anims(code)
@@ -814,6 +1686,10 @@ def expand_code_segment(result: List[str], codebuffer: List[str], state: w2bstat
             # now we have a collision free entry, append it
             names.append(name)
             state.defverbs[name] = expanded_code
+            if _resource_limits is not None:
+                _resource_limits.add_output(len(expanded_code.encode("utf-8")))
+
+        state.count("overlays", len(names))
 
         # append overprint area to result
         overprint = expand_code_makeoverprint(names, min_overlay)
@@ -824,13 +1700,71 @@ def expand_code_segment(result: List[str], codebuffer: List[str], state: w2bstat
         code = code.replace("\\[", "[").replace("\\]", "]")
         (name, expanded_code) = expand_code_get_unique_name(state.defverbs, code, lstparams)
         state.defverbs[name] = expanded_code
+        state.count("overlays")
         result.append(f"\n\\{name}\n")
 
 
+# directory shared by decks to store expanded listings in, see store_listing
+_listing_store: Optional[str] = None
+
+
+def set_listing_store(directory: Optional[str]) -> None:
+    """write expanded listings to directory and \\input them, None to inline them"""
+    global _listing_store  # noqa: PLW0603
+    _listing_store = directory
+    if directory is not None:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+
+_listingstorere: Pattern[str] = re.compile(r"\\input\{[^}]*?([0-9a-f]{64})\.tex\}")
+
+
+def store_listing(store: str, expanded_code: str) -> str:
+    """put expanded_code into the store, named by its hash, returns the \\input for it"""
+    digest = hashlib.sha256(expanded_code.encode("utf-8")).hexdigest()
+    path = Path(store, digest + ".tex")
+    try:
+        # mark the entry as used, listing_store_gc keeps recently used entries
+        os.utime(path)
+    except OSError:
+        write_file_if_changed(str(path), (expanded_code + "\n").encode("utf-8"))
+    return "\\input{" + path.as_posix() + "}"
+
+
+def listing_store_gc(store: str, tex_files: List[str], grace: float = 3600) -> List[str]:
+    """remove entries of the store no tex file references, returns the removed files
+
+    Entries used within the last grace seconds are kept, a deck that is
+    being converted right now may still reference them.
+    """
+    referenced = set()
+    for tex_file in tex_files:
+        with Path(tex_file).open(encoding="utf-8") as f:
+            referenced.update(_listingstorere.findall(f.read()))
+
+    removed: List[str] = []
+    deadline = time.time() - grace
+    for path in Path(store).iterdir():
+        if path.suffix == ".tex" and path.stem in referenced:
+            continue
+        if path.suffix not in {".tex", ".tmp"}:
+            continue
+        with contextlib.suppress(OSError):
+            if path.stat().st_mtime < deadline:
+                path.unlink()
+                removed.append(str(path))
+    return removed
+
+
 def expand_code_defverbs(result: List[str], state: w2bstate) -> None:
-    result[state.code_pos] = (
-        result[state.code_pos] + "\n".join(list(state.defverbs.values())) + "\n"
-    )
+    defverbs = list(state.defverbs.values())
+    if _listing_store is not None:
+        defverbs = [store_listing(_listing_store, defverb) for defverb in defverbs]
+    if _code_backend == "verbatim" and defverbs:
+        from .highlight import PREAMBLE
+
+        defverbs.insert(0, PREAMBLE)
+    result[state.code_pos] = result[state.code_pos] + "\n".join(defverbs) + "\n"
     state.defverbs.clear()
 
 
@@ -885,7 +1819,7 @@ def parse_usepackage(usepackage: str) -> Tuple[str, Optional[str]]:
         (name(str), options(str))
     """
 
-    p = re.compile(r"^\s*(\[.*\])?\s*\{(.*)\}\s*$")
+    p = _regex(r"^\s*(\[.*\])?\s*\{(.*)\}\s*$")
     m = p.match(usepackage)
     if m is None:
         syntax_error("usepackage specifications have to be of the form [%s]{%s}", usepackage)
@@ -938,6 +1872,26 @@ def unify_autotemplates(autotemplates: List[List[Tuple[str, str]]]) -> List[Tupl
     return autotemplate
 
 
+# directory for preambles split off the document, see expand_autotemplate_gen_opening
+_preamble_dir: Optional[str] = None
+
+
+def set_preamble_dir(directory: Optional[str]) -> None:
+    """write autotemplate preambles to files in directory, None to inline them"""
+    global _preamble_dir  # noqa: PLW0603
+    _preamble_dir = directory
+    if directory is not None:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+
+def write_preamble(directory: str, preamble: str) -> str:
+    """write preamble to a file named by its hash, returns the name without .tex"""
+    digest = hashlib.sha256(preamble.encode("utf-8")).hexdigest()[:16]
+    path = Path(directory, f"w2b-preamble-{digest}")
+    write_file_if_changed(str(path.with_suffix(".tex")), preamble.encode("utf-8"))
+    return path.as_posix()
+
+
 def expand_autotemplate_gen_opening(autotemplate: List[Tuple[str, str]]) -> str:
     """
     @param autotemplate (list)
@@ -947,15 +1901,21 @@ def expand_autotemplate_gen_opening(autotemplate: List[Tuple[str, str]]) -> str:
     """
     titleframe = False
     titleframeopts = ""
-    out: List[str] = []
+    preamble: List[str] = []
     for item in autotemplate:
         if item[0] == "titleframe":
             titleframe = parse_bool(item[1])
         elif item[0] == "titleframeopts":
             titleframeopts = item[1]
         else:
-            out.append("\\{}{}".format(*item))
+            preamble.append("\\{}{}".format(*item))
+
+    if _preamble_dir is not None:
+        # identical autotemplates share the file and a format precompiled from it
+        filename = write_preamble(_preamble_dir, "\n".join(preamble) + "\n")
+        preamble = [f"\\input{{{filename}}}"]
 
+    out = preamble
     out.append("\n\\begin{document}\n")
     if titleframe:
         out.append(f"\n\\frame{titleframeopts}{{\\titlepage}}\n")
@@ -967,17 +1927,88 @@ def expand_autotemplate_opening(
     result: List[str], templatebuffer: List[str], state: w2bstate
 ) -> None:
     my_autotemplate = parse_autotemplate(templatebuffer)
-    the_autotemplate = unify_autotemplates([autotemplate, my_autotemplate])
+    base_autotemplate = autotemplate
+    if _code_backend == "verbatim":
+        base_autotemplate = [*autotemplate, ("usepackage", "{fancyvrb}")]
+    the_autotemplate = unify_autotemplates([base_autotemplate, my_autotemplate])
 
-    opening = expand_autotemplate_gen_opening(the_autotemplate)
-    result.extend([opening, ""])
+    state.openings[len(result)] = the_autotemplate
+    result.extend([expand_autotemplate_gen_opening(the_autotemplate), ""])
     state.code_pos = len(result)
     state.autotemplate_opened = True
 
 
+def split_outside_braces(text: str, separator: str) -> List[str]:
+    """text split at separator where it is not inside {} or []"""
+    parts = [""]
+    depth = 0
+    for c in text:
+        if c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth = max(depth - 1, 0)
+        if c == separator and depth == 0:
+            parts.append("")
+        else:
+            parts[-1] += c
+    return parts
+
+
+def parse_variant(spec: str) -> Tuple[str, List[Tuple[str, str]], str]:
+    """parse NAME[:COMMAND=VALUE...]=FILE into (name, autotemplate, filename)
+
+    A : or = in a VALUE has to be inside {} or [], FILE cannot contain a =
+    but may contain a :. Specs that could be read in more than one way
+    raise ValueError.
+    """
+    parts = split_outside_braces(spec, "=")
+    filename = parts[-1]
+    if len(parts) < 2 or not filename:
+        message = f"variant without an output file: '{spec}'"
+        raise ValueError(message)
+    ambiguous = f"ambiguous variant: '{spec}', a = outside of {{}} or [] in a value or the file"
+    (name, *commands) = split_outside_braces("=".join(parts[:-1]), ":")
+    if "=" in name:
+        raise ValueError(ambiguous)
+    if not name:
+        message = f"variant without a name: '{spec}'"
+        raise ValueError(message)
+    overrides: List[Tuple[str, str]] = []
+    for command in commands:
+        fields = split_outside_braces(command, "=")
+        if len(fields) > 2:
+            raise ValueError(ambiguous)
+        if len(fields) < 2 or not fields[0].strip():
+            message = f"variant command is not COMMAND=VALUE: '{command}'"
+            raise ValueError(message)
+        overrides.append((fields[0].strip(), fields[1].strip()))
+    return (name, overrides, filename)
+
+
+def render_variant(
+    lines: List[str],
+    openings: Dict[int, List[Tuple[str, str]]],
+    overrides: List[Tuple[str, str]],
+) -> List[str]:
+    """converted lines with the openings re-rendered for the autotemplate overrides
+
+    openings are those reported by the conversion of lines, see convert2beamer.
+    The overrides are merged into the autotemplate of the document like a
+    second autotemplate, the body is shared by all variants.
+    """
+    if not overrides:
+        return lines
+    variant = list(lines)
+    for i, the_autotemplate in openings.items():
+        variant[i] = expand_autotemplate_gen_opening(
+            unify_autotemplates([the_autotemplate, overrides])
+        )
+    return variant
+
+
 def get_autotemplatemode(line: str, autotemplatemode: bool) -> Tuple[str, bool]:  # noqa: FBT001
-    autotemplatestart = re.compile(r"^<\[\s*autotemplate\s*\]")
-    autotemplateend = re.compile(r"^\[\s*autotemplate\s*\]>")
+    autotemplatestart = _regex(r"^<\[\s*autotemplate\s*\]")
+    autotemplateend = _regex(r"^\[\s*autotemplate\s*\]>")
     if not autotemplatemode and autotemplatestart.match(line) is not None:
         line = autotemplatestart.sub("", line)
         return (line, True)
@@ -987,9 +2018,45 @@ def get_autotemplatemode(line: str, autotemplatemode: bool) -> Tuple[str, bool]:
     return (line, autotemplatemode)
 
 
+# the blocks of iter_blocks whose lines go through transform
+_transformed_blocks = ("wiki", "autotemplate_end")
+
+
+def iter_blocks(lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """the lines with the block they are in, the block markers removed
+
+    The blocks are "nowiki", "code", "autotemplate" and "wiki" outside of
+    them. The line closing a code or autotemplate block comes as "code_end"
+    or "autotemplate_end" with the text after the closing marker.
+    """
+    nowikimode = False
+    codemode = False
+    autotemplatemode = False
+    for line in lines:
+        (line, nowikimode) = get_nowikimode(line, nowikimode)
+        if nowikimode:
+            yield ("nowiki", line)
+            continue
+        (line, _codemode) = get_codemode(line, codemode)
+        if codemode and not _codemode:
+            codemode = False
+            yield ("code_end", line)
+            continue
+        if _codemode:
+            codemode = True
+            yield ("code", line)
+            continue
+        (line, _autotemplatemode) = get_autotemplatemode(line, autotemplatemode)
+        if autotemplatemode and not _autotemplatemode:
+            yield ("autotemplate_end", line)
+        else:
+            yield ("autotemplate" if _autotemplatemode else "wiki", line)
+        autotemplatemode = _autotemplatemode
+
+
 def scan_for_selected_frames(lines: List[str]) -> bool:
     """scans for frames that should be rendered exclusively, returns true if such frames have been found"""
-    p = re.compile(r"^!====\s*(.*?)\s*====(.*)", re.VERBOSE)
+    p = _regex(r"^!====\s*(.*?)\s*====(.*)", re.VERBOSE)
     for line in lines:
         mo = p.match(line)
         if mo is not None:
@@ -998,17 +2065,17 @@ def scan_for_selected_frames(lines: List[str]) -> bool:
 
 
 def line_opens_unselected_frame(line: str) -> bool:
-    p = re.compile(r"^====\s*(.*?)\s*====(.*)", re.VERBOSE)
+    p = _regex(r"^====\s*(.*?)\s*====(.*)", re.VERBOSE)
     return p.match(line) is not None
 
 
 def line_opens_selected_frame(line: str) -> bool:
-    p = re.compile(r"^!====\s*(.*?)\s*====(.*)", re.VERBOSE)
+    p = _regex(r"^!====\s*(.*?)\s*====(.*)", re.VERBOSE)
     return p.match(line) is not None
 
 
 def line_closes_frame(line: str) -> bool:
-    p = re.compile(r"^\s*\[\s*frame\s*\]>", re.VERBOSE)
+    p = _regex(r"^\s*\[\s*frame\s*\]>", re.VERBOSE)
     return p.match(line) is not None
 
 
@@ -1038,14 +2105,31 @@ def filter_selected_lines(lines: List[str]) -> List[str]:
     return selected_lines
 
 
-def convert2beamer(lines: List[str]) -> List[str]:
+def convert2beamer(
+    lines: List[str],
+    jobs: int = 1,
+    counters: Optional[Dict[str, int]] = None,
+    openings: Optional[Dict[int, List[Tuple[str, str]]]] = None,
+) -> List[str]:
+    """convert to LaTeX beamer
+
+    If given, counters is updated with w2bstate.counters and openings with
+    w2bstate.openings, the autotemplate openings for render_variant.
+    """
     selectedframemode = scan_for_selected_frames(lines)
-    return convert2beamer_selected(lines) if selectedframemode else convert2beamer_full(lines)
+    if selectedframemode:
+        return convert2beamer_selected(lines, jobs, counters, openings)
+    return convert2beamer_full(lines, jobs, counters, openings)
 
 
-def convert2beamer_selected(lines: List[str]) -> List[str]:
+def convert2beamer_selected(
+    lines: List[str],
+    jobs: int = 1,
+    counters: Optional[Dict[str, int]] = None,
+    openings: Optional[Dict[int, List[Tuple[str, str]]]] = None,
+) -> List[str]:
     selected_lines = filter_selected_lines(lines)
-    return convert2beamer_full(selected_lines)
+    return convert2beamer_full(selected_lines, jobs, counters, openings)
 
 
 def include_file(line: str) -> Optional[str]:
@@ -1057,21 +2141,56 @@ def include_file(line: str) -> Optional[str]:
         if the line contains an inclusion, return the filename,
         otherwise return None
     """
-    p = re.compile(r"\>\>\>(.*?)\<\<\<", re.VERBOSE)
+    p = _regex(r"\>\>\>(.*?)\<\<\<", re.VERBOSE)
     if p.match(line):
         return p.sub(r"\1", line)
     return None
 
 
-def include_file_recursive(base: str) -> List[str]:
-    stack: List[str] = []
-    output: List[str] = []
+class IncludeWalk:
+    """resolves the includes of files, reading them is left to the caller
+
+    walk(base) yields the name of every file to read, its lines have to be
+    sent back. The lines of base with all includes resolved end up in
+    output. resolve gives the file name of an include, limits are checked
+    for every file read.
+    """
+
+    def __init__(
+        self,
+        resolve: Callable[[str, str], str] = resolve_include,
+        limits: Optional[ResourceLimits] = None,
+    ) -> None:
+        self.resolve = resolve
+        self.limits = limits
+        self.output: List[str] = []
+        # (filename, start, end) of every include done directly by base,
+        # start and end are indices into output
+        self.includes: List[Tuple[str, int, int]] = []
+        self._files: List[Tuple[str, List[str]]] = []
+        self._stack: List[str] = []
+
+    @property
+    def sources(self) -> List[Tuple[str, int, int]]:
+        """(filename, bytes, lines) of every file read, base included"""
+        return [
+            (file_, sum(len(x.encode("utf-8")) for x in lines), len(lines))
+            for file_, lines in self._files
+        ]
 
-    def recurse(file_: str) -> None:
+    def walk(self, file_: str) -> Generator[str, List[str], None]:
+        stack = self._stack
         stack.append(file_)
+        lines = yield file_
+        if self.limits is not None:
+            self.limits.check("max_include_depth", len(stack) - 1)
+            self.limits.check_lines(lines)
+            self.limits.check_deadline()
+        self._files.append((file_, lines))
+        output = self.output
         nowikimode = False
         codemode = False
-        for line in get_lines_from_cache(file_):
+        for line in lines:
             if nowikimode or codemode:
                 if nowikiendre.match(line):
                     nowikimode = False
@@ -1087,17 +2206,49 @@ def recurse(file_: str) -> None:
             else:
                 include = include_file(line)
                 if include is not None:
+                    include = self.resolve(file_, include)
                     if include in stack:
                         raise IncludeLoopException(
                             "Loop detected while trying "
-                            f"to include: '{include}'.\n" + "Stack: " + "->".join(stack)
+                            f"to include: '{include}'.\n" + "Stack: " + "->".join(stack),
+                            file_,
                         )
-                    recurse(include)
+                    start = len(output)
+                    yield from self.walk(include)
+                    if len(stack) == 1:
+                        self.includes.append((include, start, len(output)))
                 else:
                     output.append(line)
         stack.pop()
 
-    recurse(base)
+    def read(self, base: str, reader: Callable[[str], List[str]]) -> List[str]:
+        """walk base, reading the files with reader, returns output"""
+        walk = self.walk(base)
+        with contextlib.suppress(StopIteration):
+            filename = next(walk)
+            while True:
+                filename = walk.send(reader(filename))
+        return self.output
+
+
+def include_file_recursive(
+    base: str,
+    includes: Optional[List[Tuple[str, int, int]]] = None,
+    sources: Optional[List[Tuple[str, int, int]]] = None,
+) -> List[str]:
+    """read base with all includes resolved
+
+    If includes is given, (filename, start, end) is appended to it for every
+    include done directly by base, start and end are indices into the result.
+    If sources is given, (filename, bytes, lines) is appended to it for every
+    file read, base included.
+    """
+    walk = IncludeWalk(limits=_resource_limits)
+    output = walk.read(base, get_lines_from_cache)
+    if includes is not None:
+        includes += walk.includes
+    if sources is not None:
+        sources += walk.sources
     return output
 
 
@@ -1120,72 +2271,1108 @@ def munge_input_lines(lines: List[str]) -> List[str]:
     return new_lines
 
 
-def convert2beamer_full(lines: List[str]) -> List[str]:
-    """convert to LaTeX beamer"""
-    state = w2bstate()
-    result: List[str] = [""]  # start with one empty line as line 0
-    codebuffer: List[str] = []
-    autotemplatebuffer: List[str] = []
-
-    nowikimode = False
-    codemode = False
-    autotemplatemode = False
+class Diagnostic:
+    """a problem found in the input, located by file name and line number"""
 
-    for line in lines:
-        (line, nowikimode) = get_nowikimode(line, nowikimode)
-        if nowikimode:
-            result.append(line)
-        else:
-            (line, _codemode) = get_codemode(line, codemode)
-            if _codemode and not codemode:  # code mode was turned on
-                codebuffer = []
-            elif not _codemode and codemode:  # code mode was turned off
-                expand_code_segment(result, codebuffer, state)
-
-            if codemode or _codemode:
-                codebuffer.append(line)
-                codemode = _codemode
-            else:
-                (line, _autotemplatemode) = get_autotemplatemode(line, autotemplatemode)
-                if _autotemplatemode and not autotemplatemode:  # autotemplate mode was turned on
-                    autotemplatebuffer = []
-                elif not _autotemplatemode and autotemplatemode:  # autotemplate mode was turned off
-                    expand_autotemplate_opening(result, autotemplatebuffer, state)
-                autotemplatemode = _autotemplatemode
-
-                if autotemplatemode:
-                    autotemplatebuffer.append(line)
-                else:
-                    state.current_line = len(result)
-                    result.append(transform(line, state))
+    def __init__(self, filename: str, line: int, message: str) -> None:
+        self.filename = filename
+        self.line = line
+        self.message = message
 
-    result.append(transform("", state))  # close open environments
+    def __str__(self) -> str:
+        if self.line:
+            return f"{self.filename}:{self.line}: {self.message}"
+        return f"{self.filename}: {self.message}"
 
-    if state.frame_opened:
-        result.append(get_frame_closing(state))
-    if state.autotemplate_opened:
-        result.append(get_autotemplate_closing())
 
-    # insert defverbs somewhere at the beginning
-    expand_code_defverbs(result, state)
+def read_file_to_numbered_lines(filename: str) -> List[Tuple[int, str]]:
+    """read file like read_file_to_lines, but keep line numbers and raise OSError on failure"""
+    lines = _file_cache.get_pinned(filename)
+    if lines is not None:
+        return list(enumerate(lines, 1))
+    return join_numbered_lines(read_source(filename))
 
-    return result
 
+def iter_source_lines(
+    base: str,
+    diagnostics: List[Diagnostic],
+    lines: Optional[List[Tuple[int, str]]] = None,
+    reader: Callable[[str], List[Tuple[int, str]]] = read_file_to_numbered_lines,
+) -> Iterator[Tuple[str, int, str]]:
+    """yield (filename, line number, line) for base with includes resolved
 
-def print_result(lines: List[str]) -> None:
-    """print result to stdout"""
-    for line in lines:
-        pprint(line, file=sys.stdout)
+    Works like include_file_recursive, but reports unreadable files and
+    include loops to diagnostics and carries on. If given, the numbered
+    lines are used as the content of base instead of reading it. Files are
+    read with reader, which raises OSError or UnicodeError on failure.
+    """
+    stack: List[str] = []
 
+    def recurse(file_: str, origin: Tuple[str, int]) -> Iterator[Tuple[str, int, str]]:
+        try:
+            numbered = reader(file_) if stack or lines is None else lines
+        except (OSError, UnicodeError):
+            diagnostics.append(Diagnostic(origin[0], origin[1], f"cannot read file: {file_}"))
+            return
+        stack.append(file_)
+        nowikimode = False
+        codemode = False
+        for number, line in numbered:
+            if nowikimode or codemode:
+                if nowikiendre.match(line):
+                    nowikimode = False
+                elif codeendre.match(line):
+                    codemode = False
+                yield (file_, number, line)
+            elif nowikistartre.match(line):
+                yield (file_, number, line)
+                nowikimode = True
+            elif codestartre.match(line):
+                yield (file_, number, line)
+                codemode = True
+            else:
+                include = include_file(line)
+                if include is None:
+                    yield (file_, number, line)
+                    continue
+                include = resolve_include(file_, include)
+                if include in stack:
+                    diagnostics.append(
+                        Diagnostic(file_, number, "include loop: " + "->".join([*stack, include]))
+                    )
+                else:
+                    yield from recurse(include, (file_, number))
+        stack.pop()
 
-def redirect_stdout(outfilename: str) -> None:
-    global _redirected_stdout  # noqa: PLW0603
-    outfile = Path(outfilename).open("w", encoding="utf-8")  # noqa: SIM115
-    _redirected_stdout = outfile
+    yield from recurse(base, (base, 0))
 
 
-def main(argv: List[str]) -> None:  # noqa: ARG001
-    """check parameters, start file processing"""
+def munge_numbered_lines(
+    lines: Iterable[Tuple[str, int, str]],
+) -> Iterator[Tuple[str, int, str]]:
+    """munge_input_lines for (filename, line number, line) tuples"""
+    pending: Optional[Tuple[str, int, str]] = None
+    munge = False
+    for filename, number, line in lines:
+        if munge and pending is not None:
+            if not line.endswith("\\"):
+                munge = False
+            else:
+                line = line[:-1]
+            pending = (pending[0], pending[1], pending[2] + line)
+        else:
+            if pending is not None:
+                yield pending
+            if line.endswith("\\") and not line.endswith("\\\\"):
+                munge = True
+                line = line[:-1]
+            pending = (filename, number, line)
+    if pending is not None:
+        yield pending
+
+
+def check_code_segment(
+    codebuffer: List[str], origin: Tuple[str, int], diagnostics: List[Diagnostic]
+) -> None:
+    """parse the animation specs of a code block like expand_code_segment does"""
+    (anim, _) = expand_code_tokenize_anims("".join(codebuffer[1:]))
+    for animspec in anim:
+        message = animspec_error(animspec)
+        if message is not None:
+            diagnostics.append(Diagnostic(origin[0], origin[1], message))
+
+
+def animspec_error(animspec: str) -> Optional[str]:
+    """the syntax error of an animation spec, None if it is valid"""
+    try:
+        expand_code_parse_animspec(animspec)
+    except SyntaxErrorException as e:
+        return f"{e.message}: {e.code}"
+    return None
+
+
+def check_autotemplate_line(
+    line: str, origin: Tuple[str, int], diagnostics: List[Diagnostic]
+) -> None:
+    """parse one autotemplate line like unify_autotemplates does"""
+    try:
+        for key, value in parse_autotemplate([line]):
+            if key == "titleframe":
+                parse_bool(value)
+            elif key == "usepackage":
+                parse_usepackage(value)
+    except SyntaxErrorException as e:
+        diagnostics.append(Diagnostic(origin[0], origin[1], f"{e.message}: {e.code.strip()}"))
+
+
+def get_environment_event(line: str) -> Optional[Tuple[bool, str]]:
+    """(True, name) if line opens an environment like transform_environments does,
+    (False, name) if it closes one, None otherwise"""
+    if _frameheaderre.match(line) is not None or _framefooterre.match(line) is not None:
+        return None
+    for p in (_titleslidere, _h4re, _h3re, _h2re):
+        if p.match(line) is not None:
+            return None
+    m = _envopenre.match(line)
+    if m is not None:
+        return (True, m.group(1).strip()) if m.group(1).strip() != "frame" else None
+    m = _envclosere.match(line)
+    if m is not None and m.group(1).strip() != "frame":
+        return (False, m.group(1).strip())
+    return None
+
+
+def check_environments(
+    line: str,
+    origin: Tuple[str, int],
+    active_envs: Dict[str, Tuple[str, int]],
+    diagnostics: List[Diagnostic],
+) -> None:
+    """track environments like transform_environments does"""
+    event = get_environment_event(line)
+    if event is None:
+        return
+    (opened, name) = event
+    if opened:
+        active_envs[name] = origin
+    elif name in active_envs:
+        del active_envs[name]
+    else:
+        diagnostics.append(Diagnostic(origin[0], origin[1], f"environment '{name}' is not open"))
+
+
+def check_lines(lines: Iterable[Tuple[str, int, str]], diagnostics: List[Diagnostic]) -> None:
+    """validate lines without converting them, problems are added to diagnostics"""
+    active_envs: Dict[str, Tuple[str, int]] = {}
+    for filename, number, line in check_blocks(lines, diagnostics):
+        check_environments(line, (filename, number), active_envs, diagnostics)
+    for env, (filename, number) in active_envs.items():
+        diagnostics.append(Diagnostic(filename, number, f"environment '{env}' is not closed"))
+
+
+def check_blocks(
+    lines: Iterable[Tuple[str, int, str]], diagnostics: List[Diagnostic]
+) -> Iterator[Tuple[str, int, str]]:
+    """validate the nowiki, code and autotemplate blocks of lines, yield the other lines
+
+    Problems are added to diagnostics, blocks still open at the end included.
+    """
+    codebuffer: List[str] = []
+    block_start = ("", 0)
+
+    nowikimode = False
+    codemode = False
+    autotemplatemode = False
+
+    for filename, number, line in lines:
+        origin = (filename, number)
+        (line, _nowikimode) = get_nowikimode(line, nowikimode)
+        if _nowikimode and not nowikimode:
+            block_start = origin
+        nowikimode = _nowikimode
+        if nowikimode:
+            continue
+
+        (line, _codemode) = get_codemode(line, codemode)
+        if _codemode and not codemode:
+            codebuffer = []
+            block_start = origin
+        elif not _codemode and codemode:
+            check_code_segment(codebuffer, block_start, diagnostics)
+        if codemode or _codemode:
+            codebuffer.append(line)
+            codemode = _codemode
+            continue
+
+        (line, _autotemplatemode) = get_autotemplatemode(line, autotemplatemode)
+        if _autotemplatemode and not autotemplatemode:
+            block_start = origin
+        autotemplatemode = _autotemplatemode
+        if autotemplatemode:
+            check_autotemplate_line(line, origin, diagnostics)
+        else:
+            yield (filename, number, line)
+
+    modes = ((nowikimode, "nowiki"), (codemode, "code"), (autotemplatemode, "autotemplate"))
+    for mode, name in modes:
+        if mode:
+            message = f"{name} block is not closed"
+            diagnostics.append(Diagnostic(block_start[0], block_start[1], message))
+
+
+def check_files(input_files: List[str]) -> List[Diagnostic]:
+    """validate input files as one document, returns all problems found"""
+    diagnostics: List[Diagnostic] = []
+    sources = itertools.chain.from_iterable(
+        iter_source_lines(file_, diagnostics) for file_ in input_files
+    )
+    check_lines(munge_numbered_lines(sources), diagnostics)
+    return diagnostics
+
+
+class OutlineEntry:
+    """a section, subsection, frame or title slide heading of the input"""
+
+    def __init__(self, kind: str, title: str, filename: str, line: int) -> None:
+        self.kind = kind
+        self.title = title
+        self.filename = filename
+        self.line = line
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"kind": self.kind, "title": self.title, "file": self.filename, "line": self.line}
+
+
+def iter_outline(
+    input_files: List[str], diagnostics: Optional[List[Diagnostic]] = None
+) -> Iterator[OutlineEntry]:
+    """yield the headings of input_files as one document, without converting it
+
+    Headings in nowiki, code and autotemplate blocks are skipped like the
+    conversion does. Unreadable files and include loops are added to
+    diagnostics.
+    """
+    if diagnostics is None:
+        diagnostics = []
+    sources = itertools.chain.from_iterable(
+        iter_source_lines(file_, diagnostics) for file_ in input_files
+    )
+
+    (numbered, texts) = itertools.tee(munge_numbered_lines(sources))
+    blocks = iter_blocks(line for _, _, line in texts)
+    for (filename, number, _), (block, line) in zip(numbered, blocks):
+        if block not in _transformed_blocks:
+            continue
+        entry = get_outline_entry(filename, number, line)
+        if entry is not None:
+            yield entry
+
+
+def get_outline_entry(filename: str, number: int, line: str) -> Optional[OutlineEntry]:
+    """the heading of a line outside of any block, None if it is not one"""
+    patterns = (
+        ("titleslide", _titleslidere),
+        ("frame", _h4re),
+        ("subsection", _h3re),
+        ("section", _h2re),
+    )
+    for kind, p in patterns:
+        m = p.match(line)
+        if m is not None:
+            return OutlineEntry(kind, m.group(1), filename, number)
+    return None
+
+
+def print_outline(input_files: List[str]) -> List[Diagnostic]:
+    """print the outline of input_files as a JSON list, one entry per line"""
+    diagnostics: List[Diagnostic] = []
+    pprint("[", file=sys.stdout)
+    pending: Optional[str] = None
+    for entry in iter_outline(input_files, diagnostics):
+        if pending is not None:
+            pprint(pending + ",", file=sys.stdout)
+        pending = json.dumps(entry.to_dict(), ensure_ascii=False)
+    if pending is not None:
+        pprint(pending, file=sys.stdout)
+    pprint("]", file=sys.stdout)
+    return diagnostics
+
+
+def convert2beamer_lines(lines: List[str], result: List[str], state: w2bstate) -> None:
+    """convert lines and append them to result, starting outside nowiki/code/autotemplate"""
+    codebuffer: List[str] = []
+    autotemplatebuffer: List[str] = []
+
+    accounted = len(result)
+    for block, line in iter_blocks(lines):
+        if _resource_limits is not None:
+            _resource_limits.check("max_line_length", len(line))
+            _resource_limits.check_deadline()
+            _resource_limits.add_output(sum(len(x.encode("utf-8")) for x in result[accounted:]))
+            accounted = len(result)
+
+        if block == "nowiki":
+            result.append(line)
+        elif block == "code":
+            codebuffer.append(line)
+        elif block == "code_end":
+            expand_code_segment(result, codebuffer, state)
+            codebuffer = []
+        elif block == "autotemplate":
+            autotemplatebuffer.append(line)
+        else:
+            if block == "autotemplate_end":
+                expand_autotemplate_opening(result, autotemplatebuffer, state)
+                autotemplatebuffer = []
+            state.current_line = len(result)
+            result.append(transform(line, state))
+
+
+def convert2beamer_finish(result: List[str], state: w2bstate) -> None:
+    """close everything still open and insert the defverbs"""
+    result.append(transform("", state))  # close open environments
+
+    if state.frame_opened:
+        result.append(get_frame_closing(state))
+    if state.autotemplate_opened:
+        result.append(get_autotemplate_closing())
+
+    state.count("defverbs", len(state.defverbs))
+    state.count("defverb_bytes", sum(len(x.encode("utf-8")) for x in state.defverbs.values()))
+
+    # insert defverbs somewhere at the beginning
+    expand_code_defverbs(result, state)
+
+    if _resource_limits is not None:
+        _resource_limits.check("max_output_bytes", sum(len(x.encode("utf-8")) for x in result))
+
+
+def convert2beamer_full(
+    lines: List[str],
+    jobs: int = 1,
+    counters: Optional[Dict[str, int]] = None,
+    openings: Optional[Dict[int, List[Tuple[str, str]]]] = None,
+) -> List[str]:
+    """convert to LaTeX beamer"""
+    if jobs > 1:
+        return convert2beamer_parallel(lines, jobs, counters, openings)
+
+    state = w2bstate()
+    result: List[str] = [""]  # start with one empty line as line 0
+    convert2beamer_lines(lines, result, state)
+    convert2beamer_finish(result, state)
+    report_state(state, counters, openings)
+    return result
+
+
+def report_state(
+    state: w2bstate,
+    counters: Optional[Dict[str, int]],
+    openings: Optional[Dict[int, List[Tuple[str, str]]]],
+) -> None:
+    """update counters and openings, if given, from the state at the end of a conversion"""
+    if counters is not None:
+        counters.update(state.counters)
+    if openings is not None:
+        openings.update(state.openings)
+
+
+def advance_state(string: str, state: w2bstate) -> None:
+    """apply the state changes transform(string, state) would make, without generating output
+
+    Only the structural transforms and transform_itemenums touch the state,
+    the inline transforms in between never change the leading item markers.
+    Line plugins can open and close environments and plugins that need the
+    state can change it in any way, with one of them registered the line
+    is transformed.
+    """
+    if _line_plugins or any(plugin.needs_state for plugin in _inline_plugins):
+        transform(string, state)
+        return
+    m = _frameheaderre.match(string)
+    if m is not None:
+        state.next_frame_header = m.group(1)
+        string = ""
+    m = _framefooterre.match(string)
+    if m is not None:
+        state.next_frame_footer = m.group(1)
+        string = ""
+
+    if state.frame_opened and _frameclosere.match(string) is not None:
+        state.frame_opened = False
+
+    if _titleslidere.match(string) is not None or _h4re.match(string) is not None:
+        state.frame_opened = True
+        state.switch_to_next_frame()
+        string = ""
+    elif _h3re.match(string) is not None or _h2re.match(string) is not None:
+        state.frame_opened = False
+        string = ""
+
+    string = transform_replace_headfoot(string, state)
+    m = _envopenre.match(string)
+    if m is not None:
+        if m.group(1).strip() != "frame":
+            state.active_envs[m.group(1).strip()] = 1
+        string = ""
+    m = _envclosere.match(string)
+    if m is not None:
+        if m.group(1).strip() != "frame":
+            del state.active_envs[m.group(1).strip()]
+        string = ""
+
+    m = _itemenumre.match(string)
+    state.enum_item_level = "" if m is None else m.group(1)
+
+
+def get_entry_state(lines: List[str], state: Optional[w2bstate] = None) -> w2bstate:
+    """the state a serial conversion of munged lines has on reaching their end
+
+    The conversion starts from state if given, it is changed, outside of any
+    nowiki, code or autotemplate block.
+    """
+    if state is None:
+        state = w2bstate()
+    for block, line in iter_blocks(lines):
+        if block in _transformed_blocks:
+            advance_state(line, state)
+    return state
+
+
+def copy_entry_state(state: w2bstate) -> w2bstate:
+    """copy the part of the state that is carried from one line to the next"""
+    entry = w2bstate()
+    entry.frame_opened = state.frame_opened
+    entry.enum_item_level = state.enum_item_level
+    entry.frame_header = state.frame_header
+    entry.frame_footer = state.frame_footer
+    entry.next_frame_header = state.next_frame_header
+    entry.next_frame_footer = state.next_frame_footer
+    entry.active_envs = dict(state.active_envs)
+    return entry
+
+
+def split_sections(lines: List[str], chunks: int) -> List[Tuple[List[str], w2bstate]]:
+    """split lines at ==section== boundaries into about chunks parts
+
+    Every part comes with the state a serial conversion would have when
+    reaching its first line, so the parts can be converted independently.
+    """
+    state = w2bstate()
+    boundaries: List[Tuple[int, w2bstate]] = [(0, copy_entry_state(state))]
+    target = max(1, len(lines) // max(1, chunks))
+
+    inside = False  # of a nowiki, code or autotemplate block
+    for i, (line, (block, _line)) in enumerate(zip(lines, iter_blocks(lines))):
+        if (
+            not inside
+            and i - boundaries[-1][0] >= target
+            and _h2re.match(line) is not None
+            and _h3re.match(line) is None
+        ):
+            boundaries.append((i, copy_entry_state(state)))
+        if block in _transformed_blocks:
+            advance_state(_line, state)
+        inside = block in {"nowiki", "code", "autotemplate"}
+
+    ends = [b[0] for b in boundaries[1:]] + [len(lines)]
+    return [(lines[b[0] : end], b[1]) for b, end in zip(boundaries, ends)]
+
+
+def merge_defverbs(target: Dict[str, str], source: Dict[str, str]) -> bool:
+    """add source to target in order, returns False on a name collision"""
+    for name, expanded_code in source.items():
+        if name not in target:
+            target[name] = expanded_code
+        elif target[name] != expanded_code:
+            return False
+    return True
+
+
+class Settings:
+    """the module settings conversions depend on, taken from this process
+
+    Worker processes of parallel conversions only inherit them if they are
+    forked, Settings carries them to spawned ones as well.
+    """
+
+    def __init__(self) -> None:
+        self.code_backend = _code_backend
+        self.plugins = get_plugins()
+        self.listing_store = _listing_store
+        self.preamble_dir = _preamble_dir
+        self.resource_limits = None if _resource_limits is None else _resource_limits.remaining()
+
+    def install(self) -> None:
+        """make these the settings of this process"""
+        set_code_backend(self.code_backend)
+        _line_plugins[:] = [plugin for plugin in self.plugins if plugin.stage == "line"]
+        _inline_plugins[:] = [plugin for plugin in self.plugins if plugin.stage != "line"]
+        set_listing_store(self.listing_store)
+        set_preamble_dir(self.preamble_dir)
+        set_resource_limits(self.resource_limits)
+        if self.resource_limits is not None:
+            self.resource_limits.start()
+
+
+def _convert_chunk(
+    args: Tuple[List[str], w2bstate, bool],
+) -> Tuple[List[str], w2bstate]:
+    lines, state, first = args
+    result: List[str] = [""] if first else []
+    convert2beamer_lines(lines, result, state)
+    return (result, state)
+
+
+def convert2beamer_parallel(
+    lines: List[str],
+    jobs: int,
+    counters: Optional[Dict[str, int]] = None,
+    openings: Optional[Dict[int, List[Tuple[str, str]]]] = None,
+) -> List[str]:
+    """convert to LaTeX beamer, transforming sections in a pool of jobs processes
+
+    The output is the same as the one of convert2beamer_full. If two parts
+    generate colliding defverbs the whole input is converted serially.
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    parts = split_sections(lines, jobs * 4)
+    if len(parts) < 2:
+        return convert2beamer_full(lines, counters=counters, openings=openings)
+
+    settings = Settings()
+    if multiprocessing.get_start_method() != "fork":
+        try:
+            pickle.dumps(settings)
+        except Exception:  # noqa: BLE001 # whatever pickling a plugin function raises
+            # plugins defined in functions only reach forked workers
+            return convert2beamer_full(lines, counters=counters, openings=openings)
+
+    work = [(part, entry, i == 0) for i, (part, entry) in enumerate(parts)]
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=settings.install
+    ) as executor:
+        converted = list(executor.map(_convert_chunk, work))
+
+    result: List[str] = []
+    defverbs: Dict[str, str] = maybe_odict()
+    merged = w2bstate()
+    code_pos = 0
+    autotemplate_opened = False
+    for part_result, part_state in converted:
+        if part_state.autotemplate_opened:
+            code_pos = len(result) + part_state.code_pos
+            autotemplate_opened = True
+        if not merge_defverbs(defverbs, part_state.defverbs):
+            return convert2beamer_full(lines, counters=counters, openings=openings)
+        for counter, n in part_state.counters.items():
+            merged.count(counter, n)
+        for i, the_autotemplate in part_state.openings.items():
+            merged.openings[len(result) + i] = the_autotemplate
+        result.extend(part_result)
+
+    state = converted[-1][1]
+    state.defverbs = defverbs
+    state.code_pos = code_pos
+    state.autotemplate_opened = autotemplate_opened
+    state.counters = merged.counters
+    state.openings = merged.openings
+    convert2beamer_finish(result, state)
+    report_state(state, counters, openings)
+    return result
+
+
+# memoized conversions of included files, see convert_include_block
+_include_cache: Dict[str, Dict[str, Any]] = {}
+_include_cache_enabled = False
+_include_cache_dir: Optional[str] = None
+
+
+def enable_include_cache(directory: Optional[str] = None) -> None:
+    """memoize the output of included files, in memory and, if given, in directory"""
+    global _include_cache_enabled, _include_cache_dir  # noqa: PLW0603
+    _include_cache_enabled = True
+    _include_cache_dir = directory
+    if directory is not None:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+
+def disable_include_cache() -> None:
+    global _include_cache_enabled, _include_cache_dir  # noqa: PLW0603
+    _include_cache_enabled = False
+    _include_cache_dir = None
+
+
+def clear_include_cache() -> None:
+    _include_cache.clear()
+
+
+def get_state_fields(state: w2bstate) -> Dict[str, Any]:
+    """the part of the state copy_entry_state carries over, as plain data"""
+    return {
+        "frame_opened": state.frame_opened,
+        "enum_item_level": state.enum_item_level,
+        "frame_header": state.frame_header,
+        "frame_footer": state.frame_footer,
+        "next_frame_header": state.next_frame_header,
+        "next_frame_footer": state.next_frame_footer,
+        "active_envs": list(state.active_envs),
+    }
+
+
+def set_state_fields(state: w2bstate, fields: Dict[str, Any]) -> None:
+    state.frame_opened = fields["frame_opened"]
+    state.enum_item_level = fields["enum_item_level"]
+    state.frame_header = fields["frame_header"]
+    state.frame_footer = fields["frame_footer"]
+    state.next_frame_header = fields["next_frame_header"]
+    state.next_frame_footer = fields["next_frame_footer"]
+    state.active_envs = dict.fromkeys(fields["active_envs"], 1)
+
+
+def include_cache_key(lines: List[str], state: w2bstate) -> str:
+    """hash of the included lines and the state they are converted in"""
+    h = hashlib.sha256(f"{VERSIONTAG}:{_code_backend}".encode())
+    for plugin in get_plugins():
+        h.update(f":{plugin.key()}".encode())
+    fields = get_state_fields(state)
+    fields["active_envs"] = sorted(fields["active_envs"])
+    h.update(json.dumps(fields, sort_keys=True).encode("utf-8"))
+    for line in lines:
+        data = line.encode("utf-8")
+        h.update(b"%d:" % len(data))
+        h.update(data)
+    return h.hexdigest()
+
+
+def get_include_cache(key: str) -> Optional[Dict[str, Any]]:
+    if key in _include_cache:
+        return _include_cache[key]
+    if _include_cache_dir is None:
+        return None
+    try:
+        with Path(_include_cache_dir, key + ".json").open(encoding="utf-8") as f:
+            entry: Dict[str, Any] = json.load(f)
+    except (OSError, ValueError):
+        return None
+    _include_cache[key] = entry
+    return entry
+
+
+def add_include_cache(key: str, entry: Dict[str, Any]) -> None:
+    _include_cache[key] = entry
+    if _include_cache_dir is not None:
+        data = json.dumps(entry).encode("utf-8")
+        write_file_if_changed(str(Path(_include_cache_dir, key + ".json")), data)
+
+
+def convert_include_block(lines: List[str], result: List[str], state: w2bstate) -> None:
+    """convert the lines of an include, reusing the output of an earlier conversion
+
+    The lines must not leave a nowiki, code or autotemplate block open and
+    may not contain an autotemplate. Their output then only depends on the
+    state carried from line to line. The resource limits are charged for
+    reused output like for output converted again.
+    """
+    limits = _resource_limits
+    key = include_cache_key(lines, state)
+    entry = get_include_cache(key)
+    if entry is not None and limits is not None and "usage" not in entry:
+        # converted without resource limits, what it costs is not known
+        entry = None
+    reused = entry is not None
+    if entry is None:
+        block_state = copy_entry_state(state)
+        block_result: List[str] = []
+        if limits is None:
+            convert2beamer_lines(lines, block_result, block_state)
+            usage = None
+        else:
+            with limits.record() as usage:
+                convert2beamer_lines(lines, block_result, block_state)
+        entry = {
+            "result": block_result,
+            "defverbs": list(block_state.defverbs.items()),
+            "state": get_state_fields(block_state),
+            "counters": block_state.counters,
+        }
+        if usage is not None:
+            entry["usage"] = usage
+        add_include_cache(key, entry)
+
+    defverbs = entry["defverbs"]
+    if any(state.defverbs.get(name, code) != code for name, code in defverbs):
+        # a defverb name collision, the names would differ when converted in place
+        convert2beamer_lines(lines, result, state)
+        return
+    if reused and limits is not None:
+        limits.replay(entry["usage"])
+    result.extend(entry["result"])
+    for name, code in defverbs:
+        state.defverbs[name] = code
+    set_state_fields(state, entry["state"])
+    for counter, n in entry.get("counters", {}).items():
+        state.count(counter, n)
+
+
+def get_idle_lines(lines: List[str]) -> Tuple[List[bool], List[bool]]:
+    """for every index, whether no nowiki/code/autotemplate block is open before that line
+
+    The second list marks the lines that open an autotemplate block.
+    """
+    idle: List[bool] = []
+    autotemplates: List[bool] = []
+    nowikimode = False
+    codemode = False
+    autotemplatemode = False
+    for line in lines:
+        idle.append(not (nowikimode or codemode or autotemplatemode))
+        autotemplates.append(False)
+        (line, nowikimode) = get_nowikimode(line, nowikimode)
+        if nowikimode:
+            continue
+        (line, _codemode) = get_codemode(line, codemode)
+        if codemode or _codemode:
+            codemode = _codemode
+            continue
+        (line, _autotemplatemode) = get_autotemplatemode(line, autotemplatemode)
+        autotemplates[-1] = _autotemplatemode and not autotemplatemode
+        autotemplatemode = _autotemplatemode
+    idle.append(not (nowikimode or codemode or autotemplatemode))
+    return (idle, autotemplates)
+
+
+def munge_input_blocks(
+    lines: List[str], blocks: List[Tuple[str, int, int]]
+) -> Tuple[List[str], List[Tuple[int, int]]]:
+    """munge_input_lines, also moving the (name, start, end) blocks to the munged lines
+
+    Blocks that get joined with a line outside of them are dropped.
+    """
+    new_lines = munge_input_lines(lines)
+    starts: List[Optional[int]] = []
+    munge = False
+    count = 0
+    for line in lines:
+        starts.append(None if munge else count)
+        if munge:
+            munge = line.endswith("\\")
+        else:
+            munge = line.endswith("\\") and not line.endswith("\\\\")
+            count += 1
+    starts.append(None if munge else count)
+
+    moved: List[Tuple[int, int]] = []
+    for _, start, end in blocks:
+        new_start, new_end = starts[start], starts[end]
+        if new_start is not None and new_end is not None and new_start < new_end:
+            moved.append((new_start, new_end))
+    return (new_lines, moved)
+
+
+def convert2beamer_cached(
+    lines: List[str],
+    blocks: List[Tuple[str, int, int]],
+    counters: Optional[Dict[str, int]] = None,
+    openings: Optional[Dict[int, List[Tuple[str, str]]]] = None,
+) -> List[str]:
+    """convert2beamer for unmunged lines, using the include cache for the blocks
+
+    blocks are the top level includes as recorded by include_file_recursive.
+    """
+    if scan_for_selected_frames(lines):
+        return convert2beamer(munge_input_lines(lines), counters=counters, openings=openings)
+
+    (lines, moved) = munge_input_blocks(lines, blocks)
+    (idle, autotemplates) = get_idle_lines(lines)
+
+    state = w2bstate()
+    result: List[str] = [""]  # start with one empty line as line 0
+    pos = 0
+    for start, end in moved:
+        if not (idle[start] and idle[end]) or any(autotemplates[start:end]):
+            continue
+        convert2beamer_lines(lines[pos:start], result, state)
+        convert_include_block(lines[start:end], result, state)
+        pos = end
+    convert2beamer_lines(lines[pos:], result, state)
+    convert2beamer_finish(result, state)
+    report_state(state, counters, openings)
+    return result
+
+
+# counters of w2bstate reported by --stats
+STAT_COUNTERS = (
+    "frames",
+    "sections",
+    "subsections",
+    "code_blocks",
+    "overlays",
+    "defverbs",
+    "defverb_bytes",
+)
+
+
+def get_peak_memory() -> Optional[int]:
+    """peak resident set size of this process and its children in bytes, if known"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # kilobytes everywhere but on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def write_stats(filename: str, stats: Dict[str, Any], lines: List[str]) -> None:
+    """write the stats of convert_files as JSON, lines is the output as printed"""
+    stats["output_bytes"] = sum(len(x.encode("utf-8")) + 1 for x in lines)
+    if stats["input_bytes"]:
+        stats["expansion_ratio"] = stats["output_bytes"] / stats["input_bytes"]
+    with Path(filename).open("w", encoding="utf-8") as f:
+        json.dump(stats, f, indent=2)
+        f.write("\n")
+
+
+def locate_error(e: Wiki2BeamerException, input_files: List[str]) -> None:
+    """find the file and line of e raised converting input_files
+
+    The lines converted are joined and included, so they are checked again
+    like --check does. The other problems found go to e.diagnostics.
+    """
+    message = e.message
+    if isinstance(e, SyntaxErrorException):
+        message = f"{e.message}: {e.code.strip()}"
+    for diagnostic in check_files(input_files):
+        if diagnostic.message != message:
+            e.diagnostics.append(diagnostic)
+        elif e.filename is None and diagnostic.line:
+            (e.filename, e.line) = (diagnostic.filename, diagnostic.line)
+
+
+def convert_files(
+    input_files: List[str],
+    jobs: int = 1,
+    stats: Optional[Dict[str, Any]] = None,
+    openings: Optional[Dict[int, List[Tuple[str, str]]]] = None,
+) -> List[str]:
+    """read, include, munge and convert input_files as one document
+
+    If stats is given, it is filled with the statistics written by --stats,
+    openings like for convert2beamer.
+    """
+    if _resource_limits is not None:
+        _resource_limits.start()
+    start_time = time.perf_counter()
+    lines: List[str] = []
+    blocks: List[Tuple[str, int, int]] = []
+    sources: List[Tuple[str, int, int]] = []
+    counters: Dict[str, int] = {}
+    try:
+        for file_ in input_files:
+            includes: List[Tuple[str, int, int]] = []
+            offset = len(lines)
+            lines += include_file_recursive(file_, includes, sources)
+            blocks += [(name, offset + start, offset + end) for name, start, end in includes]
+
+        if _include_cache_enabled and jobs <= 1 and blocks:
+            result = convert2beamer_cached(lines, blocks, counters, openings)
+        else:
+            result = convert2beamer(munge_input_lines(lines), jobs, counters, openings)
+    except (SyntaxErrorException, InputFileException) as e:
+        locate_error(e, input_files)
+        raise
+
+    if stats is not None:
+        input_bytes = sum(size for _, size, _ in sources)
+        output_bytes = sum(len(x.encode("utf-8")) + 1 for x in result)
+        stats["sources"] = [
+            {"file": name, "bytes": size, "lines": count} for name, size, count in sources
+        ]
+        stats["includes"] = len(sources) - len(input_files)
+        for counter in STAT_COUNTERS:
+            stats[counter] = counters.get(counter, 0)
+        stats["input_bytes"] = input_bytes
+        stats["output_bytes"] = output_bytes
+        stats["expansion_ratio"] = output_bytes / input_bytes if input_bytes else None
+        stats["seconds"] = time.perf_counter() - start_time
+        stats["peak_memory"] = get_peak_memory()
+    return result
+
+
+_verbatimbeginre: Pattern[str] = re.compile(
+    r"\\begin\{((?:verbatim|semiverbatim|lstlisting|[BLS]?Verbatim|minted|alltt|comment)\*?)\}"
+)
+_frametitlere: Pattern[str] = re.compile(r"^ \\frametitle\{.*\}$")
+
+
+def is_macro_safe(text: str) -> bool:
+    """can text be the body of a macro without changing its meaning"""
+    if any(x in text for x in ("#", "%", "@", "\\verb", "verbatim", "{frame}")):
+        return False
+    depth = 0
+    for m in _regex(r"\\.|[{}]").finditer(text):
+        if m.group(0) == "{":
+            depth += 1
+        elif m.group(0) == "}":
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+
+def get_headfoot_macros(lines: List[str]) -> Dict[str, str]:
+    """map repeated frame header/footer lines to the macro names replacing them"""
+    counts: Dict[str, int] = {}
+    for i, line in enumerate(lines):
+        if (
+            0 < i < len(lines) - 1
+            and _frametitlere.match(line)
+            and lines[i - 1].startswith("\\begin{frame}")
+        ):
+            text = lines[i + 1].strip()
+        elif i < len(lines) - 1 and lines[i + 1] == "\\end{frame}" and line.startswith(" "):
+            text = line.strip()
+        else:
+            continue
+        if text and is_macro_safe(text):
+            counts[text] = counts.get(text, 0) + 1
+
+    macros: Dict[str, str] = maybe_odict()
+    names = set()
+    for text, count in counts.items():
+        name = "wbhf" + expand_code_getname(text)[:8]
+        call = f"\\{name}{{}}"
+        definition = f"\\def\\{name}{{{text}}}"
+        if name in names or count * (len(text) - len(call)) <= len(definition):
+            continue
+        names.add(name)
+        macros[text] = name
+    return macros
+
+
+def compact_lines(lines: List[str]) -> List[str]:
+    """shrink the converted output without changing what LaTeX makes of it
+
+    Surrounding whitespace is stripped and runs of blank lines are collapsed,
+    except inside verbatim environments. Frame headers and footers that are
+    repeated often enough are defined once as macros.
+    """
+    lines = "\n".join(lines).split("\n")
+    macros = get_headfoot_macros(lines)
+
+    out: List[str] = []
+    verbatim: Optional[str] = None
+    for line in lines:
+        if verbatim is not None:
+            out.append(line)
+            if f"\\end{{{verbatim}}}" in line:
+                verbatim = None
+            continue
+        m = _verbatimbeginre.search(line)
+        if m is not None and f"\\end{{{m.group(1)}}}" not in line[m.end() :]:
+            verbatim = m.group(1)
+            out.append(line)
+            continue
+
+        line = line.strip()
+        if not line and (not out or not out[-1]):
+            continue
+        if line in macros:
+            line = f"\\{macros[line]}{{}}"
+        out.append(line)
+
+    if macros:
+        definitions = [f"\\def\\{name}{{{text}}}" for text, name in macros.items()]
+        pos = out.index("\\begin{document}") + 1 if "\\begin{document}" in out else 0
+        out[pos:pos] = definitions
+    return out
+
+
+def print_result(lines: List[str]) -> None:
+    """print result to stdout, with a single write"""
+    pprint("".join(line + os.linesep for line in lines), file=sys.stdout, eol=False)
+
+
+def set_bytes_io(enabled: bool) -> None:  # noqa: FBT001
+    """write stdout as UTF-8 bytes instead of text in the encoding of the locale"""
+    global _bytes_stdout  # noqa: PLW0603
+    _bytes_stdout = enabled
+
+
+def read_stdin_bytes() -> List[str]:
+    """the lines of stdin, read as bytes and decoded as UTF-8 like input files"""
+    try:
+        return joinLines(sys.stdin.buffer.read().decode("utf-8").splitlines(keepends=True))
+    except UnicodeDecodeError as e:
+        message = f"cannot read file: stdin: {e}"
+        raise InputFileException(message) from e
+
+
+def print_exception(e: Wiki2BeamerException) -> None:
+    """print e and the other problems found with it to stderr"""
+    pprint(e.describe(), file=sys.stderr)
+    for diagnostic in e.diagnostics:
+        pprint(str(diagnostic), file=sys.stderr)
+
+
+_redirected_stdout_name: Optional[str] = None
+
+
+def redirect_stdout(outfilename: str) -> None:
+    """collect stdout in memory, it is written to outfilename by flush_redirected_stdout"""
+    global _redirected_stdout, _redirected_stdout_name  # noqa: PLW0603
+    _redirected_stdout = io.BytesIO()
+    _redirected_stdout_name = outfilename
+
+
+def flush_redirected_stdout() -> bool:
+    """write collected stdout to the redirection target, returns True if the file changed"""
+    global _redirected_stdout, _redirected_stdout_name  # noqa: PLW0603
+    if _redirected_stdout is None or _redirected_stdout_name is None:
+        return False
+    changed = write_file_if_changed(_redirected_stdout_name, _redirected_stdout.getvalue())
+    _redirected_stdout = None
+    _redirected_stdout_name = None
+    return changed
+
+
+def file_digest(filename: str) -> Optional[str]:
+    """sha256 of a file's content or None if it cannot be read"""
+    h = hashlib.sha256()
+    try:
+        with Path(filename).open("rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def write_file_if_changed(filename: str, data: bytes) -> bool:
+    """atomically replace filename with data unless it already has exactly that content
+
+    Leaving an unchanged file alone keeps its mtime, so make/latexmk do not
+    rebuild. Changed content goes to a temporary file in the same directory
+    first and is renamed over the target, readers never see partial output.
+    Returns True if the file was written.
+    """
+    try:
+        st = Path(filename).stat()
+    except OSError:
+        st = None
+    if (
+        st is not None
+        and st.st_size == len(data)
+        and file_digest(filename) == hashlib.sha256(data).hexdigest()
+    ):
+        return False
+
+    path = Path(filename)
+    tmp = path.with_name(f".{path.name}.{os.urandom(8).hex()}.tmp")
+    # a new file gets the mode of any new file, 0o666 without the bits of the umask
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    fd = os.open(tmp, flags, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        if st is not None:
+            tmp.chmod(st.st_mode & 0o7777)
+        tmp.replace(path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            tmp.unlink()
+        raise
+    return True
+
+
+def make_option_parser() -> optparse.OptionParser:
+    """the parser of the command line options"""
     usage = "%prog [options] [input1.txt [input2.txt ...]] > output.tex"
     version = "%prog (http://wiki2beamer.sf.net), version: " + VERSIONTAG
 
@@ -1197,27 +3384,366 @@ def main(argv: List[str]) -> None:  # noqa: ARG001
         metavar="FILE",
         help="write output to FILE instead of stdout",
     )
-    opts, args = parser.parse_args()
+    parser.add_option(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        metavar="N",
+        type="int",
+        default=1,
+        help="transform sections in N parallel processes",
+    )
+    parser.add_option(
+        "--check",
+        dest="check",
+        action="store_true",
+        default=False,
+        help="only validate the input, report all problems and exit",
+    )
+    parser.add_option(
+        "--spool",
+        dest="spool",
+        metavar="DIR",
+        help="add a job converting the input files to the spool DIR, see --worker",
+    )
+    parser.add_option(
+        "--worker",
+        dest="worker",
+        action="store_true",
+        default=False,
+        help="convert the jobs in the spool given by --spool until none is left",
+    )
+    parser.add_option(
+        "--poll",
+        dest="poll",
+        metavar="SECONDS",
+        type="float",
+        help="with --worker, wait for new jobs, checking every SECONDS",
+    )
+    parser.add_option(
+        "--lease",
+        dest="lease",
+        metavar="SECONDS",
+        type="float",
+        default=300.0,
+        help="jobs of a worker not heard of for SECONDS are given to others",
+    )
+    parser.add_option(
+        "--outline",
+        dest="outline",
+        action="store_true",
+        default=False,
+        help="only print the sections, subsections and frames as JSON",
+    )
+    parser.add_option(
+        "--lsp",
+        dest="lsp",
+        action="store_true",
+        default=False,
+        help="run a language server on stdin and stdout, for editors",
+    )
+    parser.add_option(
+        "--include-cache",
+        dest="include_cache",
+        metavar="DIR",
+        help="reuse the output of included files, cached in DIR",
+    )
+    parser.add_option(
+        "--listing-store",
+        dest="listing_store",
+        metavar="DIR",
+        help="write code listings to DIR, shared between decks, and \\input them",
+    )
+    parser.add_option(
+        "--shared-cache",
+        dest="shared_cache",
+        metavar="DIR",
+        help="share the files read with other processes through DIR",
+    )
+    parser.add_option(
+        "--git-rev",
+        dest="git_rev",
+        metavar="REV",
+        help="read the input files and includes from revision REV of the git repository",
+    )
+    parser.add_option(
+        "--listing-store-gc",
+        dest="listing_store_gc",
+        action="store_true",
+        default=False,
+        help="remove listings from the store that none of the given .tex files uses",
+    )
+    parser.add_option(
+        "--preamble-dir",
+        dest="preamble_dir",
+        metavar="DIR",
+        help="write the autotemplate preamble to a file in DIR named by its hash",
+    )
+    parser.add_option(
+        "--max-include-depth",
+        dest="max_include_depth",
+        metavar="N",
+        type="int",
+        help="fail if includes are nested deeper than N",
+    )
+    parser.add_option(
+        "--max-include-bytes",
+        dest="max_include_bytes",
+        metavar="N",
+        type="int",
+        help="fail if the input with all includes is larger than N bytes of UTF-8",
+    )
+    parser.add_option(
+        "--max-overlays",
+        dest="max_overlays",
+        metavar="N",
+        type="int",
+        help="fail if a code animation uses an overlay above N",
+    )
+    parser.add_option(
+        "--max-output-bytes",
+        dest="max_output_bytes",
+        metavar="N",
+        type="int",
+        help="fail if the output gets larger than N bytes of UTF-8",
+    )
+    parser.add_option(
+        "--max-line-length",
+        dest="max_line_length",
+        metavar="N",
+        type="int",
+        help="fail if an input line is longer than N characters",
+    )
+    parser.add_option(
+        "--timeout",
+        dest="timeout",
+        metavar="SECONDS",
+        type="float",
+        help="fail if the conversion takes longer than SECONDS",
+    )
+    parser.add_option(
+        "--code-backend",
+        dest="code_backend",
+        type="choice",
+        choices=["listings", "verbatim"],
+        default="listings",
+        metavar="BACKEND",
+        help="write code blocks as lstlisting (listings, default) or as "
+        "pre-highlighted fancyvrb Verbatim (verbatim)",
+    )
+    parser.add_option(
+        "--plugin",
+        dest="plugins",
+        metavar="MODULE",
+        action="append",
+        default=[],
+        help="import the python module MODULE, which registers transforms of lines",
+    )
+    parser.add_option(
+        "--bytes",
+        dest="bytes",
+        action="store_true",
+        default=False,
+        help="read stdin and write stdout as UTF-8 bytes, like files, ignoring the locale",
+    )
+    parser.add_option(
+        "--compact",
+        dest="compact",
+        action="store_true",
+        default=False,
+        help="make the output smaller, without changing the result",
+    )
+    parser.add_option(
+        "--stats",
+        dest="stats",
+        metavar="FILE",
+        help="write statistics about the conversion to FILE as JSON",
+    )
+    parser.add_option(
+        "--nav",
+        dest="nav",
+        action="store_true",
+        default=False,
+        help="also write the .nav and .toc files of beamer for the output file, "
+        "so the first LaTeX run has them",
+    )
+    parser.add_option(
+        "--check-nav",
+        dest="check_nav",
+        action="store_true",
+        default=False,
+        help="do not write the output file, exit with 1 if LaTeX has to run on it again",
+    )
+    parser.add_option(
+        "--variant",
+        dest="variants",
+        metavar="NAME[:COMMAND=VALUE...]=FILE",
+        action="append",
+        default=[],
+        help="also write the document to FILE with the autotemplate COMMANDs "
+        "changed, e.g. handout:documentclass=[handout]{beamer}=handout.tex",
+    )
+    return parser
+
+
+def apply_options(parser: optparse.OptionParser, opts: optparse.Values) -> None:
+    """set up the module settings the options ask for"""
+    if opts.listing_store is not None:
+        set_listing_store(opts.listing_store)
+    if opts.shared_cache is not None:
+        set_shared_cache(opts.shared_cache)
+    if opts.git_rev is not None:
+        try:
+            set_git_rev(opts.git_rev)
+        except OSError as e:
+            parser.error(str(e))
+    if opts.preamble_dir is not None:
+        set_preamble_dir(opts.preamble_dir)
+    set_code_backend(opts.code_backend)
+    set_bytes_io(opts.bytes)
+    for module in opts.plugins:
+        load_plugin_option(parser, module)
+    limits = {name: getattr(opts, name) for name in RESOURCE_LIMITS}
+    if any(limit is not None for limit in limits.values()):
+        set_resource_limits(ResourceLimits(**limits))
+
+
+def load_plugin_option(parser: optparse.OptionParser, module: str) -> None:
+    """load_plugin for --plugin, a module that cannot be imported is an option error"""
+    try:
+        load_plugin(module)
+    except ImportError as e:
+        parser.error(f"cannot load plugin {module}: {e}")
+
+
+def run_spool(parser: optparse.OptionParser, opts: optparse.Values, args: List[str]) -> None:
+    """--spool: run a worker or add a job for the input files"""
+    from .spool import Spool
+
+    spool = Spool(opts.spool, opts.lease)
+    if opts.worker:
+        spool.run_worker(opts.poll)
+        return
+    if len(args) == 0:
+        parser.error("You supplied no files to convert!")
+    output = opts.output if opts.output is not None else str(Path(args[0]).with_suffix(".tex"))
+    pprint(spool.submit(args, output), file=sys.stdout)
 
-    if opts.output is not None:
-        redirect_stdout(opts.output)
 
+def read_input_option(
+    parser: optparse.OptionParser, opts: optparse.Values, args: List[str]
+) -> List[str]:
+    """the input files, stdin first if it is not a terminal"""
     input_files: List[str] = []
     if not sys.stdin.isatty():
-        _file_cache["stdin"] = joinLines(sys.stdin.readlines())
+        if opts.bytes:
+            try:
+                add_lines_to_cache("stdin", read_stdin_bytes())
+            except InputFileException as e:
+                print_exception(e)
+                sys.exit(e.exit_code)
+        else:
+            add_lines_to_cache("stdin", joinLines(sys.stdin.readlines()))
         input_files.append("stdin")
     elif len(args) == 0:
         parser.error("You supplied no files to convert!")
+    return input_files + args
+
+
+def run_check(opts: optparse.Values, input_files: List[str]) -> None:
+    """--check and --outline, both exit"""
+    if opts.check:
+        diagnostics = check_files(input_files)
+        for diagnostic in diagnostics:
+            pprint(str(diagnostic), file=sys.stderr)
+        sys.exit(-3 if diagnostics else 0)
+    diagnostics = print_outline(input_files)
+    flush_redirected_stdout()
+    for diagnostic in diagnostics:
+        pprint(str(diagnostic), file=sys.stderr)
+    sys.exit(-2 if diagnostics else 0)
+
+
+def run_navigation(opts: optparse.Values, lines: List[str]) -> None:
+    """--nav and --check-nav, --check-nav exits"""
+    from .navigation import predict_navigation, second_pass_reasons, write_navigation
+
+    navigation = predict_navigation(lines)
+    if opts.check_nav:
+        reasons = second_pass_reasons(opts.output, navigation)
+        for reason in reasons:
+            pprint(f"{opts.output}: {reason}", file=sys.stderr)
+        sys.exit(1 if reasons else 0)
+    write_navigation(opts.output, navigation)
+
+
+# The command line interface is the only code turning Wiki2BeamerException
+# into exit codes and option errors into parser.error(). It stays in this
+# module because wiki2beamer.main.main(argv) is the entry point existing
+# scripts call, cli.cli() is a thin wrapper around it for the console script.
+def main(argv: List[str]) -> None:  # noqa: ARG001
+    """check parameters, start file processing"""
+    parser = make_option_parser()
+    opts, args = parser.parse_args()
 
-    input_files += args
-    lines: List[str] = []
-    for file_ in input_files:
-        lines += include_file_recursive(file_)
+    if opts.listing_store_gc:
+        if opts.listing_store is None:
+            parser.error("--listing-store-gc needs --listing-store")
+        listing_store_gc(opts.listing_store, args)
+        return
+    if opts.lsp:
+        from .lsp import serve
+
+        sys.exit(serve(sys.stdin.buffer, sys.stdout.buffer))
+    apply_options(parser, opts)
+
+    if opts.spool is not None:
+        run_spool(parser, opts, args)
+        return
+    if opts.worker:
+        parser.error("--worker needs --spool")
+    try:
+        variants = [parse_variant(spec) for spec in opts.variants]
+    except ValueError as e:
+        parser.error(str(e))
+    if (opts.nav or opts.check_nav) and opts.output is None:
+        parser.error("--nav and --check-nav need -o")
 
-    lines = munge_input_lines(lines)
+    if opts.output is not None and not opts.check_nav:
+        redirect_stdout(opts.output)
+
+    input_files = read_input_option(parser, opts, args)
+    if opts.check or opts.outline:
+        run_check(opts, input_files)
+
+    if opts.include_cache is not None:
+        enable_include_cache(opts.include_cache)
 
-    lines = convert2beamer(lines)
-    print_result(lines)
+    stats: Optional[Dict[str, Any]] = {} if opts.stats is not None else None
+    try:
+        openings: Dict[int, List[Tuple[str, str]]] = {}
+        lines = convert_files(input_files, opts.jobs, stats, openings)
+        outputs = [
+            render_variant(lines, openings, overrides) for _name, overrides, _filename in variants
+        ]
+    except Wiki2BeamerException as e:
+        print_exception(e)
+        sys.exit(e.exit_code)
+    if opts.nav or opts.check_nav:
+        run_navigation(opts, lines)
+    if opts.compact:
+        lines = compact_lines(lines)
+        outputs = [compact_lines(x) for x in outputs]
+    # with variants, the document itself is only written if -o is given
+    if opts.output is not None or not variants:
+        print_result(lines)
+        flush_redirected_stdout()
+    for (_name, _overrides, filename), output in zip(variants, outputs):
+        redirect_stdout(filename)
+        print_result(output)
+        flush_redirected_stdout()
+    if stats is not None:
+        write_stats(opts.stats, stats, lines)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,281 @@
+"""the .nav and .toc files of beamer, predicted from the converted document.
+
+Beamer writes the sections, subsections and frames of a document with their
+pages to the .nav and .toc files at the end of a LaTeX run and reads them at
+the start of the next one, for the navigation bars, the table of contents
+and the total number of frames. That is why a deck needs two runs. The
+structure is known once the deck is converted, so the files can be written
+before the first run. The pages of a frame are predicted from its overlay
+specifications and pauses. What cannot be predicted (incremental overlays
+like <+->, frames broken automatically, \\againframe, cross references, ...)
+is listed in the reasons of the prediction.
+
+Whether the prediction was right shows after the LaTeX run: if the files it
+wrote are the ones it read, a second run would not change anything.
+"""
+
+import re
+from pathlib import Path
+from typing import List, Match, Optional, Tuple
+
+from .main import write_file_if_changed
+
+_verbatim = re.compile(
+    r"\\begin\{(lstlisting|verbatim|Verbatim|BVerbatim|semiverbatim|minted|comment)\}"
+    r".*?\\end\{\1\}",
+    re.DOTALL,
+)
+_comment = re.compile(r"(?<!\\)%.*")
+_preamble = re.compile(
+    r"\\documentclass\[[^\]]*\b(?:handout|trans)\b"
+    r"|show notes"
+    r"|\\AtBegin(?:Part|Lecture|Section|Subsection)(?![A-Za-z])"
+    r"|\\setcounter\{(?:page|framenumber)\}"
+)
+_token = re.compile(
+    r"""
+    \\begin\{frame\}(?P<frame>(?:<[^<>]*>)?(?:\[[^\]]*\])?)
+    |(?P<endframe>\\end\{frame\})
+    |(?P<titleframe>\\frame(?:\[[^\]]*\])?\{\\titlepage\})
+    |\\(?P<sectioning>section|subsection)(?P<star>\*)?
+        (?:\[(?P<short>[^\]]*)\])?\{(?P<title>(?:[^{}]|\{[^{}]*\})*)\}
+    |\\pause(?:\[(?P<pausenumber>\d+)\])?(?![A-Za-z])
+    |\[<(?P<default>[^<>]*)>\]
+    |(?:\\[A-Za-z]+\*?|\\begin\{[^{}]*\})<(?P<overlay>[^<>]*)>
+    |\\(?P<reference>ref|pageref|eqref|autoref|cref|Cref|cite[a-z]*)(?![A-Za-z])
+    |\\(?P<unpredictable>
+        (?:againframe|appendix|part|lecture|subsubsection|include|input|mode|frame
+        |AtBeginPart|AtBeginLecture|AtBeginSection|AtBeginSubsection)(?![A-Za-z])
+        |tableofcontents\[[^\]]*pause)
+    """,
+    re.VERBOSE,
+)
+
+# the lines beamer writes to the .nav and .toc files for the document structure
+_entry = re.compile(r"\\(?:headcommand|beamer@(?:sub)*sectionintoc)(?![A-Za-z@])")
+
+
+class Navigation:
+    """the .nav and .toc lines beamer is predicted to write for a document"""
+
+    def __init__(self) -> None:
+        self.nav: List[str] = []
+        self.toc: List[str] = []
+        self.pages = 0
+        self.frames = 0
+        # why the pages or entries may be wrong, empty if they can be predicted
+        self.reasons: List[str] = []
+        # cross references need the .aux of the previous run whatever the pages are
+        self.references = False
+
+    @property
+    def certain(self) -> bool:
+        return not self.reasons
+
+    def uncertain(self, reason: str) -> None:
+        if reason not in self.reasons:
+            self.reasons.append(reason)
+
+
+def navigation_files(texfile: str) -> Tuple[str, str]:
+    """the names of the .nav and .toc files LaTeX writes for texfile"""
+    path = Path(texfile)
+    return (str(path.with_suffix(".nav")), str(path.with_suffix(".toc")))
+
+
+class _Predictor:
+    """reads the tokens of a document body and adds its pages to navigation"""
+
+    def __init__(self, navigation: Navigation) -> None:
+        self.navigation = navigation
+        self.page = 1
+        self.part = 0
+        self.section = 0
+        self.subsection = 0
+        self.subsectionslide = 0
+        self.section_start = 1
+        self.subsection_start = 1
+        self.slides: Optional[int] = None  # of the frame being read, None outside of frames
+        self.pauses = 0
+
+    def add_frame(self, count: int) -> None:
+        self.subsectionslide += 1
+        self.navigation.frames += 1
+        last = self.page + count - 1
+        self.navigation.nav.append(
+            f"\\headcommand {{\\slideentry {{{self.section}}}{{{self.subsection}}}"
+            f"{{{self.subsectionslide}}}{{{self.page}/{last}}}{{}}{{{self.part}}}}}"
+        )
+        self.navigation.nav.append(
+            f"\\headcommand {{\\beamer@framepages {{{self.page}}}{{{last}}}}}"
+        )
+        self.page = last + 1
+
+    def token(self, m: Match[str]) -> None:
+        kind = m.lastgroup
+        if kind == "frame":
+            self.frame(m.group("frame"))
+        elif kind == "endframe":
+            if self.slides is None:
+                self.navigation.uncertain("\\end{frame} without a frame")
+                return
+            self.add_frame(self.slides)
+            self.slides = None
+        elif kind == "titleframe":
+            self.add_frame(1)
+        elif kind in {"pausenumber", "default", "overlay"}:
+            self.overlay(kind, m.group(kind))
+        elif m.group(0).startswith("\\pause"):
+            if self.slides is not None:
+                self.pauses += 1
+                self.slides = max(self.slides, self.pauses + 1)
+        elif kind == "title":
+            self.sectioning(m)
+        elif kind == "reference":
+            self.navigation.references = True
+        else:
+            self.navigation.uncertain(f"\\{m.group('unpredictable')}")
+
+    def frame(self, options: str) -> None:
+        if self.slides is not None:
+            self.navigation.uncertain("a frame inside of a frame")
+        if options and (
+            options.startswith("<")
+            or re.search(r"allowframebreaks|noframenumbering|label\s*=", options)
+        ):
+            self.navigation.uncertain(f"frame options {options}")
+        self.slides = 1
+        self.pauses = 0
+
+    def overlay(self, kind: str, spec: str) -> None:
+        if self.slides is None:
+            return
+        if kind == "pausenumber":
+            # the text after \pause[n] is shown from slide n on
+            self.pauses = int(spec) - 1
+            numbers = [int(spec)]
+        else:
+            if re.search(r"[+.]", spec) is not None:
+                self.navigation.uncertain(f"incremental overlay specification <{spec}>")
+            numbers = [int(n) for n in re.findall(r"\d+", spec)]
+        self.slides = max([self.slides, *numbers])
+
+    def sectioning(self, m: Match[str]) -> None:
+        navigation = self.navigation
+        title = m.group("title")
+        short = m.group("short") if m.group("short") is not None else title
+        if m.group("star") is not None:
+            navigation.uncertain(f"\\{m.group('sectioning')}*")
+        if re.search(r"[\\~]", short + title) is not None:
+            navigation.uncertain(f"macros in the title {title}")
+        if self.slides is not None:
+            navigation.uncertain(f"\\{m.group('sectioning')} inside of a frame")
+        pages = f"{{{self.subsection_start}}}{{{self.page - 1}}}"
+        (page, part) = (self.page, self.part)
+        if m.group("sectioning") == "section":
+            navigation.nav.append(
+                f"\\headcommand {{\\beamer@sectionpages {{{self.section_start}}}{{{page - 1}}}}}"
+            )
+            navigation.nav.append(f"\\headcommand {{\\beamer@subsectionpages {pages}}}")
+            self.section += 1
+            self.subsection = 0
+            self.section_start = page
+            section = self.section
+            navigation.nav.append(
+                f"\\headcommand {{\\sectionentry {{{section}}}{{{short}}}{{{page}}}"
+                f"{{{title}}}{{{part}}}}}"
+            )
+            navigation.toc.append(
+                f"\\beamer@sectionintoc {{{section}}}{{{title}}}{{{page}}}{{{part}}}{{{section}}}"
+            )
+        else:
+            navigation.nav.append(f"\\headcommand {{\\beamer@subsectionpages {pages}}}")
+            self.subsection += 1
+            (section, subsection) = (self.section, self.subsection)
+            navigation.nav.append(
+                f"\\headcommand {{\\beamer@subsectionentry {{{part}}}{{{section}}}"
+                f"{{{subsection}}}{{{page}}}{{{short}}}}}"
+            )
+            navigation.toc.append(
+                f"\\beamer@subsectionintoc {{{section}}}{{{subsection}}}{{{title}}}"
+                f"{{{page}}}{{{part}}}{{{section}}}"
+            )
+        self.subsection_start = page
+        self.subsectionslide = 0
+
+    def finish(self) -> None:
+        if self.slides is not None:
+            self.navigation.uncertain("a frame without \\end{frame}")
+            self.add_frame(self.slides)
+        last = self.page - 1
+        self.navigation.pages = last
+        self.navigation.nav += [
+            f"\\headcommand {{\\beamer@partpages {{1}}{{{last}}}}}",
+            f"\\headcommand {{\\beamer@subsectionpages {{{self.subsection_start}}}{{{last}}}}}",
+            f"\\headcommand {{\\beamer@sectionpages {{{self.section_start}}}{{{last}}}}}",
+            f"\\headcommand {{\\beamer@documentpages {{{last}}}}}",
+            f"\\headcommand {{\\gdef \\inserttotalframenumber {{{self.navigation.frames}}}}}",
+        ]
+
+
+def predict_navigation(lines: List[str]) -> Navigation:
+    """the navigation of the converted lines of a document"""
+    navigation = Navigation()
+    text = _verbatim.sub("", "\n".join(lines))
+    text = "\n".join(_comment.sub("", line) for line in text.split("\n"))
+    (preamble, begin, body) = text.partition("\\begin{document}")
+    if not begin:
+        navigation.uncertain("no \\begin{document}, the output is not a document of its own")
+        body = preamble
+    else:
+        m = _preamble.search(preamble)
+        if m is not None:
+            navigation.uncertain(f"the preamble changes the pages: {m.group(0)}")
+    body = body.partition("\\end{document}")[0]
+
+    predictor = _Predictor(navigation)
+    for m in _token.finditer(body):
+        predictor.token(m)
+    predictor.finish()
+    return navigation
+
+
+def write_navigation(texfile: str, navigation: Navigation) -> None:
+    """write the predicted .nav and .toc files for texfile, unchanged files are left alone"""
+    for filename, lines in zip(navigation_files(texfile), (navigation.nav, navigation.toc)):
+        write_file_if_changed(filename, "".join(line + "\n" for line in lines).encode("utf-8"))
+
+
+def normalize_entries(text: str) -> List[str]:
+    """the structure lines of a .nav or .toc file, with the spaces TeX adds removed"""
+    entries = []
+    for line in text.splitlines():
+        line = line.strip()
+        if _entry.match(line) is not None:
+            entries.append(re.sub(r"(\\[A-Za-z@]+) +", r"\1", line))
+    return entries
+
+
+def second_pass_reasons(texfile: str, navigation: Navigation) -> List[str]:
+    """why LaTeX has to run again on texfile, empty if the last run was final
+
+    The .nav and .toc files of texfile are compared with the prediction,
+    they are the ones LaTeX wrote if it ran since write_navigation. If they
+    differ, the reasons the prediction was uncertain are listed too, they
+    explain the difference. If they match, LaTeX wrote what it read and the
+    uncertainty did not matter, so it is not a reason to run again.
+    """
+    reasons = []
+    for filename, lines in zip(navigation_files(texfile), (navigation.nav, navigation.toc)):
+        try:
+            text = Path(filename).read_text(encoding="utf-8", errors="replace")
+        except OSError as e:
+            reasons.append(f"cannot read {filename}: {e.strerror}")
+            continue
+        if normalize_entries(text) != normalize_entries("\n".join(lines)):
+            reasons.append(f"{filename} differs from the prediction")
+    if reasons:
+        reasons.extend(f"uncertain prediction: {reason}" for reason in navigation.reasons)
+    if navigation.references:
+        reasons.append("cross references need the .aux file of the previous run")
+    return reasons
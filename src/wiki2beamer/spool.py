@@ -0,0 +1,171 @@
+"""batch conversion through a spool directory shared by several workers.
+
+The spool has four subdirectories. jobs/ holds the pending jobs, one JSON
+file per job. A worker claims a job by renaming it to claimed/, which only
+one worker can succeed at, and keeps the lease alive by touching the
+claimed file. Finished jobs get a status record in done/ or failed/. A job
+whose lease was not renewed for lease_timeout seconds is moved back to
+jobs/, so the work of a crashed worker is picked up by the others. A job
+that has a status record by then, from a worker that finished after its
+lease ran out, is dropped instead of being run again.
+
+The claimed file is named by the job id and a token of the claim, the
+lease. A worker whose lease was taken away and given to another one only
+ever renews or removes the file of its own lease.
+
+Only a filesystem with atomic renames is needed, all workers can run on
+different hosts.
+"""
+
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from .main import (
+    convert_files,
+    flush_redirected_stdout,
+    print_result,
+    redirect_stdout,
+    write_file_if_changed,
+)
+
+SUBDIRS = ("jobs", "claimed", "done", "failed")
+
+
+def lease_job_id(lease: str) -> str:
+    """the id of the job of a lease, job ids have no dots"""
+    return lease.partition(".")[0]
+
+
+class Spool:
+    """a spool directory, creating it if needed"""
+
+    def __init__(self, directory: str, lease_timeout: float = 300.0) -> None:
+        self.directory = directory
+        self.lease_timeout = lease_timeout
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        for subdir in SUBDIRS:
+            self._path(subdir).mkdir(parents=True, exist_ok=True)
+
+    def _path(self, subdir: str, name: str = "") -> Path:
+        return Path(self.directory, subdir, name)
+
+    def _names(self, subdir: str) -> List[str]:
+        # temporary files of write_file_if_changed start with a dot
+        names = (path.name for path in self._path(subdir).iterdir())
+        return sorted(n for n in names if n.endswith(".json") and not n.startswith("."))
+
+    def submit(self, input_files: List[str], output: str) -> str:
+        """add a job converting input_files to output, returns the job id"""
+        job_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        job = {
+            "id": job_id,
+            "input": [str(Path(f).resolve()) for f in input_files],
+            "output": str(Path(output).resolve()),
+        }
+        write_file_if_changed(str(self._path("jobs", job_id + ".json")), json.dumps(job).encode())
+        return job_id
+
+    def pending(self) -> List[str]:
+        return [name[:-5] for name in self._names("jobs")]
+
+    def reclaim_stale(self) -> List[str]:
+        """move jobs with an expired lease back to jobs/, returns their ids"""
+        reclaimed: List[str] = []
+        deadline = time.time() - self.lease_timeout
+        for name in self._names("claimed"):
+            job_id = lease_job_id(name[:-5])
+            with contextlib.suppress(FileNotFoundError):
+                claimed = self._path("claimed", name)
+                if claimed.stat().st_mtime < deadline:
+                    claimed.rename(self._path("jobs", job_id + ".json"))
+                    reclaimed.append(job_id)
+        return reclaimed
+
+    def claim(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """lease the oldest pending job, (lease, job) or None if there is none"""
+        for name in self._names("jobs"):
+            lease = f"{name[:-5]}.{uuid.uuid4().hex[:12]}"
+            claimed = self._path("claimed", lease + ".json")
+            # touch first, the rename keeps the mtime and the lease must start fresh
+            try:
+                os.utime(self._path("jobs", name))
+                self._path("jobs", name).rename(claimed)
+            except FileNotFoundError:
+                continue  # another worker was faster
+            if any(self._path(status, name).exists() for status in ("done", "failed")):
+                # finished by a worker whose lease had expired
+                claimed.unlink(missing_ok=True)
+                continue
+            with claimed.open(encoding="utf-8") as f:
+                return (lease, json.load(f))
+        return None
+
+    def renew(self, lease: str) -> bool:
+        """extend a lease, False if it was lost"""
+        try:
+            os.utime(self._path("claimed", lease + ".json"))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def finish(self, lease: str, status: str, record: Dict[str, Any]) -> None:
+        """write the status record to done/ or failed/ and give up the lease
+
+        If the lease expired, the job is pending or claimed by another
+        worker under a lease of its own, which is left alone.
+        """
+        data = json.dumps(record, indent=2).encode()
+        write_file_if_changed(str(self._path(status, lease_job_id(lease) + ".json")), data)
+        self._path("claimed", lease + ".json").unlink(missing_ok=True)
+
+    def _keep_alive(self, lease: str, stop: threading.Event) -> None:
+        while not stop.wait(self.lease_timeout / 3):
+            if not self.renew(lease):
+                return
+
+    def process(self, lease: str, job: Dict[str, Any]) -> str:
+        """convert a claimed job, returns "done" or "failed" """
+        record: Dict[str, Any] = dict(job, worker=self.worker, started=time.time())
+        stop = threading.Event()
+        keep_alive = threading.Thread(target=self._keep_alive, args=(lease, stop), daemon=True)
+        keep_alive.start()
+        try:
+            lines = convert_files(job["input"])
+            redirect_stdout(job["output"])
+            print_result(lines)
+            record["changed"] = flush_redirected_stdout()
+            status = "done"
+        except Exception as e:  # noqa: BLE001 # a bad deck must not stop the worker
+            record["error"] = traceback.format_exception_only(type(e), e)[-1].strip()
+            status = "failed"
+        finally:
+            stop.set()
+            keep_alive.join()
+        record["finished"] = time.time()
+        self.finish(lease, status, record)
+        return status
+
+    def run_worker(self, poll: Optional[float] = None) -> int:
+        """process jobs until none is left, returns the number processed
+
+        With poll, wait that many seconds for new jobs instead of returning.
+        """
+        processed = 0
+        while True:
+            self.reclaim_stale()
+            claimed = self.claim()
+            if claimed is None:
+                if poll is None:
+                    return processed
+                time.sleep(poll)
+                continue
+            self.process(*claimed)
+            processed += 1
@@ -14,30 +14,103 @@
 # You should have received a copy of the GNU General Public License
 # along with wiki2beamer.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import bz2
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import multiprocessing
+import os
+import pickle  # noqa: S403 # only our own exceptions are pickled
 import random
 import re
+import shutil
+import subprocess  # noqa: S404 # git and wiki2beamer are run with fixed arguments
+import sys
+import tempfile
+import threading
 import unittest
+import zipfile
 from pathlib import Path
+from typing import ClassVar, Dict, List
+from unittest import mock
 
 import pytest
 
+from wiki2beamer import difftest, lsp, navigation
+from wiki2beamer.aio import AsyncConverter, convert_file_async, convert_text_async
+from wiki2beamer.gitrev import GitRevision
+from wiki2beamer.highlight import make_verbatim, normalize_language, tokenize
 from wiki2beamer.main import (
+    FileCache,
+    IncludeLoopException,
+    InputFileException,
+    ResourceLimitException,
+    ResourceLimits,
+    SharedFileCache,
+    SyntaxErrorException,
+    Wiki2BeamerException,
     add_lines_to_cache,
+    check_files,
     clear_file_cache,
+    clear_include_cache,
+    compact_lines,
     convert2beamer,
+    convert2beamer_full,
+    convert_files,
+    disable_include_cache,
+    enable_include_cache,
     escape_resub,
     expand_code_search_escape_sequences,
     expand_code_tokenize_anims,
+    file_signature,
     filter_selected_lines,
     get_lines_from_cache,
+    get_plugins,
+    include_cache_key,
     include_file,
     include_file_recursive,
+    iter_outline,
+    join_numbered_lines,
     joinLines,
+    listing_store_gc,
+    main,
     make_unique,
     munge_input_lines,
+    parse_variant,
+    read_file_bytes,
+    read_lines,
+    register_plugin,
+    render_variant,
+    resolve_include,
+    set_bytes_io,
+    set_code_backend,
+    set_git_rev,
+    set_listing_store,
+    set_preamble_dir,
+    set_resource_limits,
+    set_shared_cache,
+    split_sections,
     transform,
+    unregister_plugin,
     w2bstate,
+    write_file_if_changed,
 )
+from wiki2beamer.spool import Spool
+
+
+def _shout(line):
+    """a plugin spawned worker processes can import"""
+    return line.upper()
+
+
+class _TTY:
+    """stand-in for an interactive stdin, so main() does not try to read it"""
+
+    def isatty(self):
+        return True
 
 
 class TestBasics(unittest.TestCase):
@@ -48,6 +121,10 @@ def test_join_lines_standard(self):
         assert joined[0] == lines[0]
         assert joined[1] == "foobar"
 
+    def test_join_numbered_lines(self):
+        lines = ["a%", "b", "c", "%", "d"]
+        assert join_numbered_lines(lines) == [(1, "ab"), (3, "c"), (4, "d")]
+
     def test_join_lines_shortlines(self):
         lines = ["%", "%"]
         joined = joinLines(lines)
@@ -521,6 +598,83 @@ def test_autotemplate(self):
         assert expected[1] in received[1]
 
 
+class TestParallel(unittest.TestCase):
+    lines: ClassVar[List[str]] = [
+        "<[autotemplate]",
+        "title={Test}",
+        "[autotemplate]>",
+        "@FRAMEHEADER=head",
+        "== one ==",
+        "==== a ====",
+        "* item",
+        "<[block]{b}",
+        "<[code][language=python]",
+        "x = [<1>1][<2>2]",
+        "[code]>",
+        "[block]>",
+        "@FRAMEFOOTER=foot",
+        "== two ==",
+        "* still open",
+        "==== b ====",
+        "<[nowiki]",
+        "== not a section ==",
+        "[nowiki]>",
+        "=== sub ===",
+        "=! title !=",
+        "<[code]",
+        "y = 1",
+        "[code]>",
+        "== three ==",
+        "==== c ====",
+        "# one",
+        "## two",
+    ]
+
+    def test_split_sections_entry_state(self):
+        parts = split_sections(self.lines, 10)
+        assert [part[0][0] for part in parts] == [
+            "<[autotemplate]",
+            "== one ==",
+            "== two ==",
+            "== three ==",
+        ]
+        assert not parts[1][1].frame_opened
+        entry = parts[2][1]
+        assert entry.frame_opened
+        assert entry.frame_header == "head"
+        assert entry.next_frame_footer == "foot"
+        assert not entry.enum_item_level
+
+    def test_parallel_matches_serial(self):
+        expected = convert2beamer_full(self.lines)
+        assert convert2beamer(self.lines, jobs=2) == expected
+        assert convert2beamer(self.lines * 5, jobs=3) == convert2beamer_full(self.lines * 5)
+
+    def test_spawned_workers(self):
+        # spawned workers do not inherit the settings of this process
+        lines = [*self.lines, "== four ==", "==== d ====", "shout: hey"]
+        start_method = multiprocessing.get_start_method()
+        multiprocessing.set_start_method("spawn", force=True)
+        try:
+            set_code_backend("verbatim")
+            register_plugin("shout", _shout, ["shout:"])
+            set_resource_limits(ResourceLimits(max_line_length=100))
+            expected = convert2beamer_full(lines)
+            assert "\\begin{Verbatim}" in "\n".join(expected)
+            assert "SHOUT: HEY" in expected
+            assert convert2beamer(lines, jobs=2) == expected
+            with pytest.raises(ResourceLimitException):
+                convert2beamer([*lines, "x" * 101], jobs=2)
+            # a plugin that cannot be pickled makes it convert serially
+            register_plugin("shout", lambda line: line.upper(), ["shout:"])
+            assert convert2beamer(lines, jobs=2) == expected
+        finally:
+            multiprocessing.set_start_method(start_method, force=True)
+            set_code_backend("listings")
+            unregister_plugin("shout")
+            set_resource_limits(None)
+
+
 class TestFileCache(unittest.TestCase):
     def setUp(self):
         pass
@@ -535,6 +689,341 @@ def test_file_cache_works(self):
         expected = "Multiple inputs"
         assert expected in out[0]
 
+    def test_file_cache_invalidates_changed_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = str(Path(tmpdir, "file.txt"))
+            Path(filename).write_text("one\n", encoding="utf-8")
+            assert get_lines_from_cache(filename) == ["one"]
+            Path(filename).write_text("two two\n", encoding="utf-8")
+            assert get_lines_from_cache(filename) == ["two two"]
+
+    def test_file_cache_lru(self):
+        cache = FileCache(max_bytes=10)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            names = []
+            for name in "abc":
+                names.append(str(Path(tmpdir, name)))
+                Path(names[-1]).write_text("1234", encoding="utf-8")
+            cache.add("pinned", ["123456"])
+            for name in names:
+                cache.add(name, ["1234"], file_signature(name))
+            assert cache.get(names[0]) is None
+            assert cache.get(names[2]) == ["1234"]
+            assert cache.get("pinned") == ["123456"]
+            assert cache.stats() == {
+                "entries": 2,
+                "bytes": 10,
+                "hits": 2,
+                "misses": 1,
+                "evictions": 2,
+                "invalidations": 0,
+            }
+
+    def test_file_cache_counts_utf8(self):
+        cache = FileCache(max_bytes=10)
+        cache.add("a", ["\u00e4" * 5], (0, 0, 0))
+        assert cache.stats()["bytes"] == 10
+        cache.add("b", ["\u00e4"], (0, 0, 0))
+        assert "a" not in cache
+
+    def test_file_cache_threads(self):
+        cache = FileCache(max_bytes=100)
+        errors = []
+
+        def work(n):
+            try:
+                for i in range(200):
+                    cache.add(__file__ + str(i % 7), [str(n) * 10], (0, 0, 0))
+                    cache.get(__file__ + str((i + n) % 7))
+            except Exception as e:  # noqa: BLE001
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert cache.stats()["bytes"] <= 100
+
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = str(Path(self.tmpdir.name, "cache"))
+        self.filename = str(Path(self.tmpdir.name, "deck.txt"))
+        Path(self.filename).write_text(
+            "==== ä ====\nfoo %\nbar\n<[code]\n  x\n[code]>\n", encoding="utf-8"
+        )
+        set_shared_cache(self.cache_dir)
+
+    def tearDown(self):
+        set_shared_cache(None)
+        clear_file_cache()
+        self.tmpdir.cleanup()
+
+    def entries(self):
+        return list(Path(self.cache_dir).glob("*/*"))
+
+    def test_read_once(self):
+        lines = get_lines_from_cache(self.filename)
+        assert len(self.entries()) == 1
+
+        # another process only has the shared cache
+        clear_file_cache()
+        reader = mock.Mock(side_effect=AssertionError("read again"))
+        assert get_lines_from_cache(self.filename, reader) == lines
+        assert lines == ["==== ä ====", "foo bar", "<[code]\n", "  x\n", "[code]>"]
+
+    def test_changed_file(self):
+        get_lines_from_cache(self.filename)
+        clear_file_cache()
+        Path(self.filename).write_text("==== new ====\n", encoding="utf-8")
+        assert get_lines_from_cache(self.filename) == ["==== new ===="]
+        # the entry of the old version is removed
+        assert len(self.entries()) == 1
+
+    def test_least_recently_used_removed(self):
+        cache = SharedFileCache(self.cache_dir)
+        lines = ["x" * 30]
+        for i, name in enumerate("abc"):
+            cache.add(name, (i, 0, 0), lines)
+            entry = cache._entry(name, (i, 0, 0))  # noqa: SLF001 # the file of the entry
+            os.utime(entry, ns=(i * 10**9, i * 10**9))
+        cache.max_bytes = 3 * Path(entry).stat().st_size
+        # a is used again, b is the least recently used when d is added
+        assert cache.get("a", (0, 0, 0)) == lines
+        cache.add("d", (3, 0, 0), lines)
+        assert cache.get("b", (1, 0, 0)) is None
+        for name, i in (("a", 0), ("c", 2), ("d", 3)):
+            assert cache.get(name, (i, 0, 0)) == lines
+
+    def test_collect_not_on_every_add(self):
+        cache = SharedFileCache(self.cache_dir, max_bytes=16 * 1024)
+        with mock.patch.object(cache, "collect", wraps=cache.collect) as collect:
+            for i in range(400):
+                cache.add(f"file{i}", (i, 0, 0), ["x" * 100])
+        # once every 1 KiB written, every 9 entries of 126 bytes
+        assert collect.call_count == 400 // 9
+        # what was added since the last collect() may be over the limit
+        assert sum(path.stat().st_size for path in self.entries()) <= 17 * 1024
+
+    def test_broken_entry(self):
+        lines = get_lines_from_cache(self.filename)
+        (path,) = self.entries()
+        for data in (b"", b"garbage", Path(path).read_bytes()[:-2]):
+            Path(path).write_bytes(data)
+            clear_file_cache()
+            assert get_lines_from_cache(self.filename) == lines
+
+    def test_pinned_lines_are_not_shared(self):
+        add_lines_to_cache("stdin", ["foo"])
+        assert get_lines_from_cache("stdin") == ["foo"]
+        assert os.listdir(self.cache_dir) == []
+
+
+class TestSources(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.deck = "==== foo ====\n* bar\n>>>inc/part.txt<<<\n"
+        self.part = "==== baz ====\nqux\n"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        clear_file_cache()
+
+    def path(self, name):
+        return str(Path(self.tmpdir.name, name))
+
+    def write_bundle(self, name, members):
+        with zipfile.ZipFile(self.path(name), "w") as archive:
+            for member, text in members.items():
+                archive.writestr(member, text)
+        return self.path(name)
+
+    def test_compressed(self):
+        for suffix, compress in (
+            (".gz", gzip.compress),
+            (".xz", lzma.compress),
+            (".bz2", bz2.compress),
+        ):
+            filename = self.path("deck.txt" + suffix)
+            Path(filename).write_bytes(compress("==== foo ====\nbär%\nbaz\n".encode()))
+            assert read_lines(filename) == ["==== foo ====", "bärbaz"]
+
+    def test_corrupt(self):
+        filename = self.path("deck.txt.xz")
+        Path(filename).write_bytes(b"not xz")
+        with pytest.raises(OSError, match="cannot decompress"):
+            read_lines(filename)
+        assert [d.message for d in check_files([filename])] == [f"cannot read file: {filename}"]
+
+    def test_read_limit(self):
+        set_resource_limits(ResourceLimits(max_include_bytes=1000))
+        try:
+            filename = self.path("bomb.txt.gz")
+            Path(filename).write_bytes(gzip.compress(b"x" * 10000000))
+            read = gzip.GzipFile.read
+            patch = mock.patch.object(gzip.GzipFile, "read", autospec=True, side_effect=read)
+            with patch as spy, pytest.raises(ResourceLimitException) as excinfo:
+                convert_files([filename])
+            assert excinfo.value.limit == "max_include_bytes"
+            assert [call.args[1:] for call in spy.call_args_list] == [(1001,)]
+
+            # a plain file larger than the limit fails on its size
+            filename = self.path("large.txt")
+            Path(filename).write_bytes(b"x" * 1001)
+            with pytest.raises(ResourceLimitException, match="large.txt is larger than"):
+                convert_files([filename])
+            bundle = self.write_bundle("deck.w2b.zip", {"deck.txt": "x" * 1001})
+            with pytest.raises(ResourceLimitException):
+                convert_files([bundle])
+            Path(filename).write_bytes(b"x" * 1000)
+            convert_files([filename])
+        finally:
+            set_resource_limits(None)
+
+    def test_bundle(self):
+        bundle = self.write_bundle(
+            "deck.w2b.zip", {"deck.txt": self.deck, "inc/part.txt": self.part}
+        )
+        lines = include_file_recursive(bundle)
+        assert lines == ["==== foo ====", "* bar", "==== baz ====", "qux"]
+        assert include_file_recursive(bundle + "::deck.txt") == lines
+        assert include_file_recursive(bundle + "::inc/part.txt") == lines[2:]
+        assert convert_files([bundle]) == convert_files([bundle + "::deck.txt"])
+
+    def test_bundle_read_once(self):
+        bundle = self.write_bundle(
+            "deck.w2b.zip", {"deck.txt": self.deck, "inc/part.txt": self.part}
+        )
+        with mock.patch("wiki2beamer.main.read_file_bytes", wraps=read_file_bytes) as read:
+            include_file_recursive(bundle)
+            read_lines(bundle + "::inc/part.txt")
+        assert read.call_count == 1
+
+        # a changed bundle is read again
+        self.write_bundle("deck.w2b.zip", {"deck.txt": "==== new ====\n"})
+        os.utime(bundle, ns=(0, 0))
+        assert read_lines(bundle) == ["==== new ===="]
+
+    def test_bundle_include_cache(self):
+        bundle = self.write_bundle(
+            "deck.w2b.zip", {"deck.txt": self.deck, "inc/part.txt": self.part}
+        )
+        assert include_file_recursive(bundle)[2:] == ["==== baz ====", "qux"]
+        self.write_bundle("deck.w2b.zip", {"deck.txt": self.deck, "inc/part.txt": "* new\n"})
+        os.utime(bundle, ns=(0, 0))
+        # the included members are checked against the signature of the bundle
+        assert include_file_recursive(bundle)[2:] == ["* new"]
+
+    def test_bundle_missing_member(self):
+        bundle = self.write_bundle("deck.w2b.zip", {"deck.txt": self.deck})
+        diagnostics = check_files([bundle])
+        assert [str(d) for d in diagnostics] == [
+            f"{bundle}:3: cannot read file: {bundle}::inc/part.txt"
+        ]
+
+    def test_resolve_include(self):
+        assert resolve_include("deck.txt", "part.txt") == "part.txt"
+        assert resolve_include("deck.zip", "part.txt") == "deck.zip::part.txt"
+        assert resolve_include("deck.zip::a/deck.txt", "part.txt") == "deck.zip::part.txt"
+        assert resolve_include("deck.zip::deck.txt", "other.zip::part.txt") == "other.zip::part.txt"
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+class TestGitRev(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.git("init", "-q")
+        self.commit(
+            {
+                "deck.txt": "==== foo ====\n>>>inc/a.txt<<<\n>>>inc/b.txt<<<\n>>>inc/c.txt<<<\n",
+                "inc/a.txt": "* a\n",
+                "inc/b.txt": "* b\n",
+                "inc/c.txt": "* c\n",
+            }
+        )
+        self.rev = self.git("rev-parse", "HEAD")
+        self.commit({"inc/b.txt": "* changed\n"})
+        Path(self.path("inc/c.txt")).write_text("* not committed\n", encoding="utf-8")
+        # includes are relative to the working directory
+        self.cwd = Path.cwd()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        set_git_rev(None)
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return str(Path(self.tmpdir.name, name))
+
+    def git(self, *args):
+        env = dict(os.environ, GIT_AUTHOR_NAME="w2b", GIT_AUTHOR_EMAIL="w2b@example.org")
+        env.update(GIT_COMMITTER_NAME="w2b", GIT_COMMITTER_EMAIL="w2b@example.org")
+        result = subprocess.run(
+            [shutil.which("git"), *args],
+            cwd=self.tmpdir.name,
+            env=env,
+            capture_output=True,
+            check=True,
+        )
+        return result.stdout.decode("utf-8").strip()
+
+    def commit(self, files):
+        for name, text in files.items():
+            Path(self.path(name)).parent.mkdir(parents=True, exist_ok=True)
+            Path(self.path(name)).write_text(text, encoding="utf-8")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "files")
+
+    def test_convert_revision(self):
+        set_git_rev(self.rev, self.tmpdir.name)
+        lines = include_file_recursive("deck.txt")
+        assert lines == ["==== foo ====", "* a", "* b", "* c"]
+        set_git_rev("HEAD", self.tmpdir.name)
+        assert include_file_recursive("deck.txt")[2:] == ["* changed", "* c"]
+        set_git_rev(None)
+        assert include_file_recursive("deck.txt")[2:] == ["* changed", "* not committed"]
+
+    def test_file_signature(self):
+        set_git_rev(self.rev, self.tmpdir.name)
+        # the files of a revision never change, their cache entries are not pinned
+        assert file_signature("deck.txt") == (self.rev,)
+        assert file_signature("inc/b.txt") == (self.rev,)
+
+    def test_includes_in_one_round_trip(self):
+        revision = GitRevision(self.rev, self.tmpdir.name)
+        with mock.patch("wiki2beamer.main._git_revision", revision):
+            include_file_recursive("deck.txt")
+            assert revision.round_trips == 2
+            include_file_recursive("deck.txt")
+            assert revision.round_trips == 2
+        revision.close()
+
+    def test_missing_file(self):
+        set_git_rev(self.rev, self.tmpdir.name)
+        with pytest.raises(OSError, match="nothing.txt not found in"):
+            read_lines("nothing.txt")
+        with pytest.raises(OSError, match="inc is a tree in"):
+            read_lines("inc")
+        with pytest.raises(OSError, match="is not in the repository"):
+            read_lines(str(Path(self.tmpdir.name).parent))
+
+    def test_unknown_revision(self):
+        with pytest.raises(OSError, match="not a revision of"):
+            set_git_rev("no-such-branch", self.tmpdir.name)
+        with pytest.raises(OSError, match="not a revision of"):
+            set_git_rev(self.rev + ":deck.txt", self.tmpdir.name)
+
+    def test_main(self):
+        outfile = self.path("out.tex")
+        argv = ["wiki2beamer", "--git-rev", self.rev, "-o", outfile, "deck.txt"]
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(sys, "stdin", _TTY()):
+            main(argv)
+        assert "\\item b" in Path(outfile).read_text(encoding="utf-8")
+
 
 class TestFileInclusion(unittest.TestCase):
     def setUp(self):
@@ -613,6 +1102,1189 @@ def test_include_file_after_code(self):
         assert out == expected
 
 
+class TestCheck(unittest.TestCase):
+    def tearDown(self):
+        clear_file_cache()
+
+    def check(self, files):
+        for file_, lines in files.items():
+            add_lines_to_cache(file_, lines)
+        return [str(d) for d in check_files(list(files)[:1])]
+
+    def test_check_valid(self):
+        files = {
+            "deck": [
+                "<[autotemplate]",
+                "titleframe=False",
+                "usepackage=[utf8]{inputenc}",
+                "[autotemplate]>",
+                "<[block]{title}",
+                ">>>inc<<<",
+                "[block]>",
+                "<[code]",
+                "[<1-2>foo][<3>bar]",
+                "[code]>",
+            ],
+            "inc": ["<[nowiki]", "[itemize]>", "[nowiki]>"],
+        }
+        assert self.check(files) == []
+
+    def test_check_reports_all(self):
+        files = {
+            "deck": [
+                "<[autotemplate]",
+                "titleframe=maybe",
+                "[autotemplate]>",
+                ">>>inc<<<",
+                "<[code]",
+                "[<1-x>foo]",
+                "[code]>",
+                "<[block]{title}",
+                "[center]>",
+            ],
+            "inc": ["text", ">>>deck<<<", ">>>missing<<<"],
+        }
+        assert self.check(files) == [
+            "deck:2: Boolean expected (True/true/1 or False/false/0): maybe",
+            "inc:2: include loop: deck->inc->deck",
+            "inc:3: cannot read file: missing",
+            "deck:5: specification does not match [<%d>%s]: [<1-x>foo]",
+            "deck:9: environment 'center' is not open",
+            "deck:8: environment 'block' is not closed",
+        ]
+
+    def test_check_unclosed_block(self):
+        assert self.check({"deck": ["foo", "<[code]", "bar"]}) == [
+            "deck:2: code block is not closed"
+        ]
+
+
+class TestIncludeCache(unittest.TestCase):
+    files: ClassVar[Dict[str, List[str]]] = {
+        "deck": [
+            "<[autotemplate]",
+            "[autotemplate]>",
+            ">>>license<<<",
+            "== one ==",
+            ">>>license<<<",
+            "* item",
+            ">>>license<<<",
+            "<[block]{b}",
+            ">>>license<<<",
+            "[block]>",
+            "continued \\",
+            ">>>license<<<",
+        ],
+        "license": [
+            "==== License ====",
+            "* CC-BY",
+            "<[code]",
+            "[<1>a][<2>b]",
+            "[code]>",
+            "@FRAMEFOOTER=foot",
+        ],
+    }
+
+    def setUp(self):
+        for file_, lines in self.files.items():
+            add_lines_to_cache(file_, lines)
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        disable_include_cache()
+        clear_include_cache()
+        clear_file_cache()
+        self.tmpdir.cleanup()
+
+    def test_include_cache_same_output(self):
+        expected = convert_files(["deck"])
+        enable_include_cache()
+        assert convert_files(["deck"]) == expected
+        assert convert_files(["deck"]) == expected
+
+    def test_include_cache_directory(self):
+        expected = convert_files(["deck"])
+        enable_include_cache(self.tmpdir.name)
+        convert_files(["deck"])
+        assert len(os.listdir(self.tmpdir.name)) > 0
+        clear_include_cache()
+        assert convert_files(["deck"]) == expected
+
+    def test_include_cache_reused(self):
+        enable_include_cache(self.tmpdir.name)
+        convert_files(["deck"])
+        for name in os.listdir(self.tmpdir.name):
+            Path(self.tmpdir.name, name).write_text(
+                '{"result": ["cached"], "defverbs": [], "state": {"frame_opened": false, '
+                '"enum_item_level": "", "frame_header": "", "frame_footer": "", '
+                '"next_frame_header": "", "next_frame_footer": "", "active_envs": []}}',
+                encoding="utf-8",
+            )
+        clear_include_cache()
+        assert "cached" in convert_files(["deck"])
+
+    def test_include_cache_resource_limits(self):
+        add_lines_to_cache("license-deck", ["== one ==", ">>>license<<<"])
+        enable_include_cache(self.tmpdir.name)
+        set_resource_limits(ResourceLimits(max_overlays=2))
+        try:
+            expected = convert_files(["license-deck"])
+            clear_include_cache()
+            assert convert_files(["license-deck"]) == expected
+            # the overlays of the output reused count like those converted
+            set_resource_limits(ResourceLimits(max_overlays=1))
+            with pytest.raises(ResourceLimitException) as excinfo:
+                convert_files(["license-deck"])
+            assert excinfo.value.limit == "max_overlays"
+        finally:
+            set_resource_limits(None)
+
+
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        files = {
+            "deck.txt": "==== foo ====\n>>>inc.txt<<<\n",
+            "inc.txt": "* included\n",
+            "loop.txt": ">>>loop.txt<<<\n",
+        }
+        for name, content in files.items():
+            Path(self.root, name).write_text(content, encoding="utf-8")
+
+    def tearDown(self):
+        clear_file_cache()
+        self.tmpdir.cleanup()
+
+    def test_convert_text_async(self):
+        out = asyncio.run(convert_text_async(">>>inc.txt<<<\n'''bold'''", include_root=self.root))
+        assert "\\item included" in out
+        assert "\\textbf{bold}" in out
+
+    def test_convert_file_async(self):
+        deck = str(Path(self.root, "deck.txt"))
+        out = asyncio.run(convert_file_async(deck, include_root=self.root))
+        assert out == "".join(
+            line + "\n" for line in convert2beamer(["==== foo ====", "* included"])
+        )
+
+    def test_convert_errors_async(self):
+        with pytest.raises(IncludeLoopException):
+            asyncio.run(convert_file_async(str(Path(self.root, "loop.txt")), self.root))
+        with pytest.raises(FileNotFoundError):
+            asyncio.run(convert_text_async(">>>missing.txt<<<", include_root=self.root))
+
+    def test_resource_limits_async(self):
+        deck = str(Path(self.root, "deck.txt"))
+        set_resource_limits(ResourceLimits(max_include_bytes=50))
+        try:
+
+            async def run():
+                return await asyncio.gather(
+                    *(convert_file_async(deck, self.root) for _ in range(5))
+                )
+
+            assert all("\\item included" in out for out in asyncio.run(run()))
+            set_resource_limits(ResourceLimits(max_include_depth=0))
+            with pytest.raises(ResourceLimitException):
+                asyncio.run(convert_file_async(deck, self.root))
+        finally:
+            set_resource_limits(None)
+
+    def test_concurrency_limit(self):
+        converter = AsyncConverter(max_concurrency=2)
+
+        async def run():
+            texts = [f"==== frame {i} ====" for i in range(10)]
+            return await asyncio.gather(*(converter.convert_text(text) for text in texts))
+
+        outs = asyncio.run(run())
+        assert all(f"\\frametitle{{frame {i}}}" in out for i, out in enumerate(outs))
+
+    def test_cancel(self):
+        async def run():
+            task = asyncio.ensure_future(convert_text_async("==== foo ====\n" * 1000))
+            await asyncio.sleep(0)
+            task.cancel()
+            await task
+
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(run())
+
+
+class TestListingStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = str(Path(self.tmpdir.name, "store"))
+        set_listing_store(self.store)
+
+    def tearDown(self):
+        set_listing_store(None)
+        self.tmpdir.cleanup()
+
+    def test_listing_store(self):
+        out = convert2beamer(["<[code]", "[<1>a][<2>b]", "[code]>"])
+        entries = sorted(os.listdir(self.store))
+        assert len(entries) == 2
+        for entry in entries:
+            assert f"\\input{{{self.store}/{entry}}}" in out[0]
+            content = Path(self.store, entry).read_text(encoding="utf-8")
+            assert content.startswith("\\defverbatim[colored]")
+
+        convert2beamer(["<[code]", "[<1>a][<2>c]", "[code]>"])
+        assert len(os.listdir(self.store)) == 3
+
+    def test_listing_store_gc(self):
+        out = convert2beamer(["<[code]", "a", "[code]>"])
+        convert2beamer(["<[code]", "b", "[code]>"])
+        deck = str(Path(self.tmpdir.name, "deck.tex"))
+        Path(deck).write_text("\n".join(out), encoding="utf-8")
+
+        assert listing_store_gc(self.store, [deck]) == []
+        removed = listing_store_gc(self.store, [deck], grace=-1)
+        assert len(removed) == 1
+        (kept,) = os.listdir(self.store)
+        assert kept in out[0]
+
+
+class TestVariant(unittest.TestCase):
+    def setUp(self):
+        self.lines = [
+            "<[autotemplate]",
+            "documentclass={beamer}",
+            "usetheme={Warsaw}",
+            "[autotemplate]>",
+            "==== foo ====",
+        ]
+
+    def test_parse_variant(self):
+        assert parse_variant("presentation=out.tex") == ("presentation", [], "out.tex")
+        assert parse_variant("handout:documentclass=[handout]{beamer}=handout.tex") == (
+            "handout",
+            [("documentclass", "[handout]{beamer}")],
+            "handout.tex",
+        )
+        assert parse_variant("h:hypersetup={pdftitle=a:b}:usetheme=Warsaw=C:\\h\\h.tex") == (
+            "h",
+            [("hypersetup", "{pdftitle=a:b}"), ("usetheme", "Warsaw")],
+            "C:\\h\\h.tex",
+        )
+        for spec in ("out.tex", "a=", "a:documentclass=b.tex", "=out.tex", "a:b=c:d=out.tex"):
+            with pytest.raises(ValueError, match="variant"):
+                parse_variant(spec)
+        for spec in ("a=b=out.tex", "a:documentclass=beamer=out=1.tex"):
+            with pytest.raises(ValueError, match="ambiguous variant"):
+                parse_variant(spec)
+
+    def test_render_variant(self):
+        openings = {}
+        out = convert2beamer(self.lines, openings=openings)
+        assert list(openings) == [1]
+        assert render_variant(out, openings, []) is out
+        handout = render_variant(out, openings, [("documentclass", "[handout]{beamer}")])
+        reference = [*self.lines]
+        reference[1] = "documentclass=[handout]{beamer}"
+        assert handout == convert2beamer(reference)
+        assert "\\documentclass{beamer}" in out[1]
+
+    def test_render_variant_without_autotemplate(self):
+        openings = {}
+        out = convert2beamer(["==== foo ===="], openings=openings)
+        assert not openings
+        assert render_variant(out, openings, [("documentclass", "[handout]{beamer}")]) == out
+
+    def test_main_variants(self):
+        add_lines_to_cache("variant-deck", self.lines)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                presentation = str(Path(tmpdir, "p.tex"))
+                handout = str(Path(tmpdir, "h.tex"))
+                argv = [
+                    "wiki2beamer",
+                    "--variant",
+                    f"presentation={presentation}",
+                    "--variant",
+                    f"handout:documentclass=[handout]{{beamer}}={handout}",
+                    "variant-deck",
+                ]
+                with mock.patch.object(sys, "argv", argv), mock.patch.object(sys, "stdin", _TTY()):
+                    main(argv)
+                p = Path(presentation).read_text(encoding="utf-8")
+                h = Path(handout).read_text(encoding="utf-8")
+        finally:
+            clear_file_cache()
+        assert p.replace("\\documentclass{beamer}", "\\documentclass[handout]{beamer}") == h
+
+
+class TestDifftest(unittest.TestCase):
+    # output of the sequential pipeline for the examples, frozen when the harness was added
+    reference_digests: ClassVar[Dict[str, str]] = {
+        "advanced.wiki": "66c9de84c4e53256ffbf6804b46ba148fa7ed1ca1ce36107123166f04c4cbd2e",
+        "beamer.wiki": "e6014db0df4e14202e7f57140f0d4c1d2bd298657c9a7eff7a0200fadbe274a5",
+        "graphics.wiki": "df02b1eebb198bde82522981946992cd7b915a3b0b6cc1b84f0fe21944b5f926",
+        "version0_4.wiki": "f317bad384d52197311e01ef72195c262221c694fe54486e5e047b8c8dd53f18",
+        "version0_7.wiki": "65c6b102b34a8e51d65c6b3ab5bb4bd94d3ee38cac91a128d331b6957101bbf4",
+    }
+
+    def setUp(self):
+        examples = Path(__file__).parent.parent / "doc" / "examples"
+        self.corpus = [str(examples / name) for name in sorted(self.reference_digests)]
+
+    def test_reference_is_frozen(self):
+        for path in self.corpus:
+            with difftest.registered(difftest.corpus_deck(path)) as filename:
+                output = difftest.reference_engine(filename)
+            digest = hashlib.sha256(output.encode("utf-8")).hexdigest()
+            assert digest == self.reference_digests[Path(path).name], path
+
+    def test_corpus(self):
+        assert difftest.run(0, corpus=self.corpus) == []
+
+    def test_random_decks(self):
+        # output of the sequential pipeline before any of the fast paths, see --write-golden
+        golden = difftest.read_golden(str(Path(__file__).parent / "difftest_golden.json"))
+        assert len(golden) == 30
+        assert difftest.run(30, seed=1, golden=golden) == []
+
+    def test_golden_mismatch(self):
+        deck = {"golden-deck": "==== a ====\n"}
+        mismatch = difftest.compare(deck, [], golden="something else\n")
+        assert mismatch is not None
+        assert mismatch.engine == "reference"
+
+    def test_random_deck(self):
+        deck = difftest.random_deck(random.Random(5))
+        assert deck == difftest.random_deck(random.Random(5))
+        assert all(name.startswith("difftest-") for name in deck)
+
+    def test_shrink(self):
+        def buggy(filename):
+            return difftest.reference_engine(filename).replace("\\textbf", "\\emph")
+
+        deck = {
+            "shrink-deck": "== s ==\n==== a ====\n* x\n* '''y'''\n>>>shrink-include<<<\n",
+            "shrink-include": "==== b ====\nz\n",
+        }
+        with mock.patch.dict(difftest.ENGINES, {"buggy": buggy}):
+            mismatch = difftest.compare(deck, ["files", "buggy"])
+            assert mismatch is not None
+            assert mismatch.engine == "buggy"
+            shrunk = difftest.shrink(mismatch)
+        assert shrunk.deck == {"shrink-deck": "* '''y'''\n"}
+        assert "+  \\item \\emph{y}" in str(shrunk)
+
+
+class TestLsp(unittest.TestCase):
+    text = (
+        "== s ==\n"
+        "==== a ====\n"
+        "<[center]\n"
+        "* '''x'''\n"
+        "==== b ====\n"
+        "<[code]\n"
+        "[<a>x]\n"
+        "[code]>\n"
+        "[center]>\n"
+        "==== c ====\n"
+        "<[nowiki]\n"
+    )
+
+    def tearDown(self):
+        clear_file_cache()
+
+    def expected(self, document):
+        clear_file_cache(document.filename)
+        add_lines_to_cache(document.filename, document.lines)
+        return sorted((d.line - 1, d.message) for d in check_files([document.filename]))
+
+    def test_diagnostics_match_check_files(self):
+        document = lsp.Document("file:///lsp-deck.txt", self.text)
+        assert document.filename == "/lsp-deck.txt"
+        diagnostics = sorted(document.diagnostics())
+        assert len(diagnostics) == 2
+        assert diagnostics == self.expected(document)
+
+    def test_incremental_change(self):
+        document = lsp.Document("file:///lsp-deck.txt", self.text + "==== d ====\nfoo\n" * 20)
+        document.diagnostics()
+        results = list(document.results)
+        change = {
+            "range": {"start": {"line": 3, "character": 2}, "end": {"line": 3, "character": 9}}
+        }
+        document.apply_change(dict(change, text="y\n==== a2 ====\nz"))
+        assert document.rescanned < 10
+        assert document.starts[:5] == [0, 1, 4, 6, 11]
+        assert document.results[:1] == results[:1]
+        assert document.results[3:] == results[2:]
+        assert sorted(document.diagnostics()) == self.expected(document)
+
+        # a block opened in the middle hides the headings up to its end
+        document.apply_change(
+            {
+                "range": {"start": {"line": 2, "character": 0}, "end": {"line": 2, "character": 0}},
+                "text": "<[nowiki]\n",
+            }
+        )
+        assert document.starts == lsp.Document(document.uri, "\n".join(document.lines)).starts
+        assert sorted(document.diagnostics()) == self.expected(document)
+
+    def test_full_change(self):
+        document = lsp.Document("file:///lsp-deck.txt", self.text)
+        document.apply_change({"text": "==== a ====\r\n<[center]\r\n"})
+        assert document.lines == ["==== a ====", "<[center]", ""]
+        assert document.diagnostics() == [(1, "environment 'center' is not closed")]
+
+    def test_frame_latex(self):
+        document = lsp.Document("file:///lsp-deck.txt", "==== a ====\nx\n==== b ====\n* '''y'''\n")
+        latex = document.frame_latex(3)
+        assert "\\frametitle{b}" in latex
+        assert "\\textbf{y}" in latex
+        assert "\\frametitle{a}" not in latex
+
+    def test_frame_latex_keeps_entry_states(self):
+        text = "".join(f"==== f{i} ====\n@FRAMEFOOTER=foot{i}\n* x\n" for i in range(6))
+        document = lsp.Document("file:///lsp-deck.txt", text)
+        latex = document.frame_latex(12)
+        assert "foot3" in latex
+        with mock.patch.object(document, "resolve", wraps=document.resolve) as resolve:
+            assert document.frame_latex(12) == latex
+            # only the lines of the frame itself, the state at its start is kept
+            assert [len(call.args[0]) for call in resolve.call_args_list] == [3]
+            document.apply_change(
+                {
+                    "range": {
+                        "start": {"line": 7, "character": 0},
+                        "end": {"line": 7, "character": 0},
+                    },
+                    "text": "y",
+                }
+            )
+            resolve.reset_mock()
+            assert document.frame_latex(12) == latex
+            # the states from the changed chunk on are computed again
+            assert [len(call.args[0]) for call in resolve.call_args_list] == [3, 3, 3]
+        assert document.frame_latex(12) == lsp.Document(
+            document.uri, "\n".join(document.lines)
+        ).frame_latex(12)
+
+    def test_utf16(self):
+        assert lsp.utf16_to_index("a\U0001f600b", 3) == 2
+        assert lsp.utf16_length("a\U0001f600b") == 4
+
+    def test_serve(self):
+        def frame(message):
+            body = json.dumps(message).encode("utf-8")
+            return b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+
+        uri = "file:///lsp-deck.txt"
+        document = {"uri": uri}
+        messages = [
+            {"id": 1, "method": "initialize", "params": {}},
+            {"method": "initialized", "params": {}},
+            {
+                "method": "textDocument/didOpen",
+                "params": {"textDocument": dict(document, text=self.text)},
+            },
+            {
+                "method": "textDocument/didChange",
+                "params": {
+                    "textDocument": document,
+                    "contentChanges": [
+                        {
+                            "range": {
+                                "start": {"line": 10, "character": 0},
+                                "end": {"line": 10, "character": 9},
+                            },
+                            "text": "",
+                        }
+                    ],
+                },
+            },
+            {
+                "id": 2,
+                "method": "textDocument/documentSymbol",
+                "params": {"textDocument": document},
+            },
+            {
+                "id": 3,
+                "method": "wiki2beamer/frameLatex",
+                "params": {"textDocument": document, "position": {"line": 1}},
+            },
+            {"id": 4, "method": "unknown/method"},
+            b"Content-Length: 5\r\n\r\n{oops",
+            [1, 2],
+            {"id": 5, "method": "shutdown"},
+            {"method": "exit"},
+        ]
+        output = io.BytesIO()
+        stream = b"".join(m if isinstance(m, bytes) else frame(m) for m in messages)
+        assert lsp.serve(io.BytesIO(stream), output) == 0
+
+        replies = []
+        stream = io.BytesIO(output.getvalue())
+        while True:
+            message = lsp.read_message(stream)
+            if message is None:
+                break
+            replies.append(message)
+        assert replies[0]["result"]["capabilities"]["documentSymbolProvider"]
+        published = [r["params"]["diagnostics"] for r in replies if r.get("method")]
+        assert [len(diagnostics) for diagnostics in published] == [2, 1]
+        symbols = next(r["result"] for r in replies if r.get("id") == 2)
+        assert [s["name"] for s in symbols] == ["s"]
+        assert [s["name"] for s in symbols[0]["children"]] == ["a", "b", "c"]
+        latex = next(r["result"]["latex"] for r in replies if r.get("id") == 3)
+        assert "\\frametitle{a}" in latex
+        assert next(r for r in replies if r.get("id") == 4)["error"]["code"] == -32601
+        errors = [r["error"]["code"] for r in replies if "id" in r and r["id"] is None]
+        assert errors == [-32700, -32600]
+        assert next(r for r in replies if r.get("id") == 5)["result"] is None
+
+    def test_serve_broken_header(self):
+        body = json.dumps({"id": 1, "method": "initialize", "params": {}}).encode("utf-8")
+        stream = b"\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        assert lsp.read_message(io.BytesIO(stream))["id"] == 1
+        assert lsp.read_message(io.BytesIO(stream[:-1])) is None
+        output = io.BytesIO()
+        # the body of the broken message must not be taken for the next header
+        stream = b"Content-Type: x\r\n\r\n" + stream
+        assert lsp.serve(io.BytesIO(stream), output) == 1
+        (reply,) = [lsp.read_message(io.BytesIO(output.getvalue()))]
+        assert reply["id"] is None
+        assert reply["error"]["code"] == -32700
+        assert "Content-Length" in reply["error"]["message"]
+
+    def test_includes_read_once(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            part = Path(tmpdir, "part.txt")
+            part.write_text("==== inc ====\n* x\n", encoding="utf-8")
+            document = lsp.Document("file:///lsp-deck.txt", f"== s ==\n>>>{part}<<<\n")
+            with mock.patch.object(lsp, "read_source", wraps=lsp.read_source) as read_source:
+                assert "\\frametitle{inc}" in document.frame_latex(1)
+                document.apply_change({"text": f"== t ==\n>>>{part}<<<\n"})
+                document.diagnostics()
+                assert "\\frametitle{inc}" in document.frame_latex(1)
+                assert read_source.call_count == 1
+                part.write_text("==== changed ====\n* x\n", encoding="utf-8")
+                os.utime(part, ns=(0, 0))
+                assert "\\frametitle{changed}" in document.frame_latex(1)
+                assert read_source.call_count == 2
+
+
+class TestPreamble(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        set_preamble_dir(self.tmpdir.name)
+
+    def tearDown(self):
+        set_preamble_dir(None)
+        self.tmpdir.cleanup()
+
+    def test_preamble_file(self):
+        lines = ["<[autotemplate]", "title={A}", "[autotemplate]>", "==== foo ===="]
+        set_preamble_dir(None)
+        inlined = convert2beamer(lines)
+        set_preamble_dir(self.tmpdir.name)
+        out = convert2beamer(lines)
+        (name,) = os.listdir(self.tmpdir.name)
+        preamble = Path(self.tmpdir.name, name).read_text(encoding="utf-8")
+        assert name.startswith("w2b-preamble-")
+        assert "\\title{A}" in preamble
+        assert "\\begin{document}" not in preamble
+        assert out[1].startswith(f"\\input{{{self.tmpdir.name}/{name[:-4]}}}\n")
+        assert out[1].replace(out[1].split("\n", 1)[0], preamble[:-1]) == inlined[1]
+        assert out[2:] == inlined[2:]
+
+    def test_preamble_shared(self):
+        convert2beamer(["<[autotemplate]", "title={A}", "[autotemplate]>", "==== foo ===="])
+        convert2beamer(["<[autotemplate]", "title={A}", "[autotemplate]>", "==== bar ===="])
+        convert2beamer(["<[autotemplate]", "title={B}", "[autotemplate]>", "==== bar ===="])
+        assert len(os.listdir(self.tmpdir.name)) == 2
+
+
+class TestHighlight(unittest.TestCase):
+    def tearDown(self):
+        set_code_backend("listings")
+
+    def test_normalize_language(self):
+        assert normalize_language("Python") == "python"
+        assert normalize_language("{[GNU]C++}") == "c++"
+        assert normalize_language("bash") == "sh"
+
+    def test_tokenize(self):
+        tokens = tokenize('def f(x): return "d\\"ef" # def', "python")
+        assert tokens == [
+            ("keyword", "def"),
+            (None, " f(x): "),
+            ("keyword", "return"),
+            (None, " "),
+            ("string", '"d\\"ef"'),
+            (None, " "),
+            ("comment", "# def"),
+        ]
+
+    def test_tokenize_unknown_language(self):
+        assert tokenize("int x;", "cobol") == [(None, "int x;")]
+
+    def test_make_verbatim(self):
+        out = make_verbatim(
+            "/* a\n b */ int x = f{y};\n", "[style=basic,language=C,numbers=left]\n"
+        )
+        assert out == (
+            "\\begin{Verbatim}[commandchars=\\\\\\{\\},fontsize=\\footnotesize,numbers=left]\n"
+            "\\wbcodecm{/* a}\n\\wbcodecm{ b */} \\wbcodekw{int} x = f\\char123{}y\\char125{};\n"
+            "\\end{Verbatim}"
+        )
+
+    def test_verbatim_backend(self):
+        set_code_backend("verbatim")
+        lines = [
+            "<[autotemplate]",
+            "[autotemplate]>",
+            "<[code][language=java]",
+            "class A {}",
+            "[code]>",
+        ]
+        out = "\n".join(convert2beamer(lines))
+        assert "\\usepackage{fancyvrb}" in out
+        assert "\\providecommand{\\wbcodekw}" in out
+        assert "\\wbcodekw{class} A" in out
+        assert "lstlisting" not in out
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError, match="unknown code backend"):
+            set_code_backend("pygments")
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spooldir = str(Path(self.tmpdir.name, "spool"))
+
+    def tearDown(self):
+        clear_file_cache()
+        self.tmpdir.cleanup()
+
+    def make_deck(self, name, lines):
+        filename = str(Path(self.tmpdir.name, name))
+        Path(filename).write_text("\n".join(lines) + "\n", encoding="utf-8")
+        return filename
+
+    def test_worker(self):
+        spool = Spool(self.spooldir)
+        deck = self.make_deck("deck.wiki", ["==== foo ====", "* bar"])
+        output = str(Path(self.tmpdir.name, "deck.tex"))
+        job_id = spool.submit([deck], output)
+        assert spool.pending() == [job_id]
+        assert spool.run_worker() == 1
+
+        expected = "".join(line + os.linesep for line in convert_files([deck]))
+        assert Path(output).read_bytes() == expected.encode("utf-8")
+        record = json.loads(
+            Path(self.spooldir, "done", job_id + ".json").read_text(encoding="utf-8")
+        )
+        assert record["output"] == output
+        assert record["changed"]
+        assert spool.pending() == []
+        assert os.listdir(Path(self.spooldir, "claimed")) == []
+
+    def test_failed_job(self):
+        spool = Spool(self.spooldir)
+        deck = self.make_deck("broken.wiki", [">>>missing.wiki<<<"])
+        job_id = spool.submit([deck], str(Path(self.tmpdir.name, "broken.tex")))
+        spool.run_worker()
+        record = json.loads(
+            Path(self.spooldir, "failed", job_id + ".json").read_text(encoding="utf-8")
+        )
+        assert "InputFileException: cannot read file: missing.wiki" in record["error"]
+
+    def test_stale_lease(self):
+        spool = Spool(self.spooldir, lease_timeout=60)
+        deck = self.make_deck("deck.wiki", ["==== foo ===="])
+        job_id = spool.submit([deck], str(Path(self.tmpdir.name, "deck.tex")))
+        (lease, job) = spool.claim()
+        assert job["id"] == job_id
+        assert spool.claim() is None
+        assert spool.reclaim_stale() == []
+
+        os.utime(Path(self.spooldir, "claimed", lease + ".json"), (0, 0))
+        assert spool.reclaim_stale() == [job_id]
+        (new_lease, job) = spool.claim()
+        assert job["id"] == job_id
+
+        # the first worker finishing late leaves the new lease alone
+        assert not spool.renew(lease)
+        spool.finish(lease, "done", {})
+        assert os.listdir(Path(self.spooldir, "claimed")) == [new_lease + ".json"]
+        assert spool.renew(new_lease)
+
+    def test_claim_finished(self):
+        spool = Spool(self.spooldir)
+        deck = self.make_deck("deck.wiki", ["==== foo ===="])
+        job_id = spool.submit([deck], str(Path(self.tmpdir.name, "deck.tex")))
+        # a slow worker finished it after its lease ran out and it was requeued
+        spool.finish(job_id + ".expired", "done", {})
+        assert spool.claim() is None
+        assert spool.pending() == []
+        assert os.listdir(Path(self.spooldir, "claimed")) == []
+
+    def test_claim_failed(self):
+        spool = Spool(self.spooldir)
+        deck = self.make_deck("deck.wiki", ["==== foo ===="])
+        job_id = spool.submit([deck], str(Path(self.tmpdir.name, "deck.tex")))
+        spool.finish(job_id + ".expired", "failed", {"error": "first run"})
+        assert spool.claim() is None
+        assert spool.pending() == []
+        record = Path(self.spooldir, "failed", job_id + ".json").read_text(encoding="utf-8")
+        assert json.loads(record) == {"error": "first run"}
+
+    def test_several_workers(self):
+        spool = Spool(self.spooldir)
+        job_ids = []
+        for i in range(20):
+            deck = self.make_deck(f"deck{i}.wiki", [f"==== frame {i} ====", "text"])
+            job_ids.append(spool.submit([deck], str(Path(self.tmpdir.name, f"deck{i}.tex"))))
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        argv = [sys.executable, "-m", "wiki2beamer.cli", "--spool", self.spooldir, "--worker"]
+        workers = [subprocess.Popen(argv, env=env, stdin=subprocess.DEVNULL) for _ in range(3)]
+        for worker in workers:
+            assert worker.wait(timeout=60) == 0
+
+        done = sorted(name[:-5] for name in os.listdir(Path(self.spooldir, "done")))
+        assert done == job_ids
+        for i in range(20):
+            content = Path(self.tmpdir.name, f"deck{i}.tex").read_text(encoding="utf-8")
+            assert f"\\frametitle{{frame {i}}}" in content
+
+    def test_main_submit(self):
+        deck = self.make_deck("deck.wiki", ["==== foo ===="])
+        argv = ["wiki2beamer", "--spool", self.spooldir, deck]
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(sys, "stdin", _TTY()):
+            main(argv)
+        (name,) = os.listdir(Path(self.spooldir, "jobs"))
+        job = json.loads(Path(self.spooldir, "jobs", name).read_text(encoding="utf-8"))
+        assert job["output"] == str(Path(self.tmpdir.name, "deck.tex"))
+
+
+class TestErrors(unittest.TestCase):
+    def setUp(self):
+        add_lines_to_cache("errors-deck", ["==== a ====", "<[center]", ">>>errors-code<<<"])
+        add_lines_to_cache("errors-code", ["<[code]", "[<a>x]", "[code]>"])
+        add_lines_to_cache("errors-missing", ["==== a ====", ">>>errors-nothing<<<"])
+        add_lines_to_cache("errors-good", ["==== b ====", "* '''x'''"])
+
+    def tearDown(self):
+        clear_file_cache()
+
+    def test_syntax_error_raises(self):
+        with pytest.raises(SyntaxErrorException) as excinfo:
+            convert2beamer(["<[code]", "[<a>x]", "[code]>"])
+        assert isinstance(excinfo.value, Wiki2BeamerException)
+        assert excinfo.value.message == "specification does not match [<%d>%s]"
+        assert excinfo.value.code == "[<a>x]"
+        assert excinfo.value.exit_code == -3
+
+    def test_located(self):
+        with pytest.raises(SyntaxErrorException) as excinfo:
+            convert_files(["errors-deck"])
+        e = excinfo.value
+        assert (e.filename, e.line) == ("errors-code", 1)
+        assert e.describe().startswith("errors-code:1: syntax error: specification")
+        assert [str(d) for d in e.diagnostics] == [
+            "errors-deck:2: environment 'center' is not closed"
+        ]
+
+        with pytest.raises(InputFileException) as excinfo:
+            convert_files(["errors-missing"])
+        assert excinfo.value.describe() == "errors-missing:2: cannot read file: errors-nothing"
+        assert excinfo.value.exit_code == -2
+
+    def test_worker_goes_on(self):
+        expected = convert_files(["errors-good"])
+        for deck in ("errors-deck", "errors-missing", "errors-good"):
+            try:
+                lines = convert_files([deck])
+            except Wiki2BeamerException:
+                continue
+            assert lines == expected
+
+    def test_parallel(self):
+        with pytest.raises(SyntaxErrorException) as excinfo:
+            convert2beamer(["== s ==", "<[code]", "[<a>x]", "[code]>", "== t =="], jobs=2)
+        assert excinfo.value.code == "[<a>x]"
+
+        e = pickle.loads(pickle.dumps(SyntaxErrorException("message", "code", "file", 3)))  # noqa: S301
+        assert (str(e), e.message, e.code, e.filename, e.line) == (
+            "message",
+            "message",
+            "code",
+            "file",
+            3,
+        )
+
+    def test_main_exit_code(self):
+        argv = ["wiki2beamer", "errors-deck"]
+        stderr = io.StringIO()
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(
+            sys, "stdin", _TTY()
+        ), mock.patch.object(sys, "stderr", stderr), pytest.raises(SystemExit) as excinfo:
+            main(argv)
+        assert excinfo.value.code == -3
+        assert stderr.getvalue().splitlines() == [
+            "errors-code:1: syntax error: specification does not match [<%d>%s]",
+            "\tcode:",
+            "[<a>x]",
+            "errors-deck:2: environment 'center' is not closed",
+        ]
+
+
+class TestPlugins(unittest.TestCase):
+    def tearDown(self):
+        for plugin in get_plugins():
+            unregister_plugin(plugin.name)
+        sys.modules.pop("w2b_test_plugin", None)
+
+    def test_inline(self):
+        calls = []
+
+        def glossary(line):
+            calls.append(line)
+            return re.sub(r"gls:(\w+)", r"\\gls{\1}", line)
+
+        register_plugin("glossary", glossary, ["gls:"])
+        lines = ["==== a ====", "* see gls:api", "plain", "<[nowiki]", "gls:raw", "[nowiki]>"]
+        lines += ["<[code]", "gls:code", "[code]>"]
+        result = "\n".join(convert2beamer(lines))
+        assert "\\item see \\gls{api}" in result
+        assert "gls:raw" in result
+        assert "gls:code" in result
+        assert calls == ["* see gls:api"]
+
+    def test_line_with_state(self):
+        def logo(line, state):
+            return line.replace("@@logo@@", "\\includegraphics{logo}" if state.frame_opened else "")  # noqa: RUF027
+
+        register_plugin("logo", logo, ["@@logo@@"], stage="line", needs_state=True)
+        result = convert2beamer(["@@logo@@", "==== a ====", "'''@@logo@@'''"])
+        assert not result[1]
+        assert "\\textbf{\\includegraphics{logo}}" in result
+
+    def test_order_and_replace(self):
+        register_plugin("a", lambda line: line.replace("x", "y"), ["x"])
+        register_plugin("b", lambda line: line.replace("y", "z"), ["y"])
+        assert "z" in convert2beamer(["x"])
+        register_plugin("a", lambda line: line.replace("x", "w"), ["x"])
+        assert [p.name for p in get_plugins()] == ["b", "a"]
+        assert "w" in convert2beamer(["x"])
+
+    def test_invalid(self):
+        with pytest.raises(ValueError, match="needs non-empty trigger substrings"):
+            register_plugin("empty", str.upper, [])
+        with pytest.raises(ValueError, match="unknown plugin stage"):
+            register_plugin("stage", str.upper, ["x"], stage="output")
+
+    def test_include_cache_key(self):
+        key = include_cache_key(["foo"], w2bstate())
+        register_plugin("units", lambda line: line, ["km"], version="1")
+        assert include_cache_key(["foo"], w2bstate()) != key
+        assert include_cache_key(["foo"], w2bstate()) == include_cache_key(["foo"], w2bstate())
+
+    def test_parallel(self):
+        register_plugin("units", lambda line: line.replace("km", "\\si{km}"), ["km"])
+        lines = [f"== s{i} ==\n==== f ====\n{i} km".split("\n") for i in range(4)]
+        lines = [line for section in lines for line in section]
+        assert convert2beamer(lines, jobs=2) == convert2beamer_full(lines)
+        assert "3 \\si{km}" in convert2beamer_full(lines)
+
+    def test_parallel_line_plugin_state(self):
+        environments = {"eq:open": "<[equation]", "eq:close": "[equation]>"}
+        register_plugin(
+            "equation", lambda line: environments.get(line, line), ["eq:"], stage="line"
+        )
+        lines = [f"== s{i} ==\n==== f ====\nx{i}".split("\n") for i in range(4)]
+        lines = [line for section in lines for line in section]
+        lines[2:2] = ["eq:open"]
+        lines.append("eq:close")
+        expected = convert2beamer_full(lines)
+        assert "\\end{equation}" in expected
+        assert convert2beamer(lines, jobs=4) == expected
+
+        document = lsp.Document("file:///lsp-deck.txt", "\n".join(lines))
+        assert "\\end{equation}" in document.frame_latex(len(lines) - 1)
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            Path(tmpdir, "w2b_test_plugin.py").write_text(
+                "from wiki2beamer.main import register_plugin\n"
+                "register_plugin('shout', lambda line: line.upper(), ['shout:'])\n",
+                encoding="utf-8",
+            )
+            deck = str(Path(tmpdir, "deck.txt"))
+            Path(deck).write_text("==== a ====\nshout: hey\n", encoding="utf-8")
+            outfile = str(Path(tmpdir, "out.tex"))
+            argv = ["wiki2beamer", "--plugin", "w2b_test_plugin", "-o", outfile, deck]
+            with mock.patch.object(sys, "argv", argv), mock.patch.object(
+                sys, "stdin", _TTY()
+            ), mock.patch.object(sys, "path", [tmpdir, *sys.path]):
+                main(argv)
+            assert "SHOUT: HEY" in Path(outfile).read_text(encoding="utf-8")
+
+
+class TestOutline(unittest.TestCase):
+    def setUp(self):
+        add_lines_to_cache(
+            "outline-deck",
+            [
+                "<[autotemplate]",
+                "== not a section ==",
+                "[autotemplate]>",
+                "=! Welcome !=",
+                "== Intro ==",
+                "=== Details ===",
+                "==== First ''frame'' ====[fragile]",
+                "<[code]",
+                "==== not a frame ====",
+                "[code]>",
+                "<[nowiki]",
+                "==== not a frame ====",
+                "[nowiki]>",
+                ">>>outline-include<<<",
+                "!==== Selected ====",
+            ],
+        )
+        add_lines_to_cache("outline-include", ["==== Included \\", "frame ===="])
+
+    def tearDown(self):
+        clear_file_cache()
+
+    def test_outline(self):
+        entries = [(e.kind, e.title, e.filename, e.line) for e in iter_outline(["outline-deck"])]
+        assert entries == [
+            ("titleslide", "Welcome", "outline-deck", 4),
+            ("section", "Intro", "outline-deck", 5),
+            ("subsection", "Details", "outline-deck", 6),
+            ("frame", "First ''frame''", "outline-deck", 7),
+            ("frame", "Included frame", "outline-include", 1),
+            ("frame", "Selected", "outline-deck", 15),
+        ]
+
+    def test_outline_missing_include(self):
+        add_lines_to_cache("outline-broken", ["==== a ====", ">>>outline-missing<<<"])
+        diagnostics = []
+        assert [e.title for e in iter_outline(["outline-broken"], diagnostics)] == ["a"]
+        assert [str(d) for d in diagnostics] == [
+            "outline-broken:2: cannot read file: outline-missing"
+        ]
+
+    def test_main_outline(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = str(Path(tmpdir, "outline.json"))
+            argv = ["wiki2beamer", "--outline", "-o", outfile, "outline-deck"]
+            with mock.patch.object(sys, "argv", argv), mock.patch.object(
+                sys, "stdin", _TTY()
+            ), pytest.raises(SystemExit) as excinfo:
+                main(argv)
+            assert excinfo.value.code == 0
+            outline = json.loads(Path(outfile).read_text(encoding="utf-8"))
+        assert len(outline) == 6
+        assert outline[0] == {
+            "kind": "titleslide",
+            "title": "Welcome",
+            "file": "outline-deck",
+            "line": 4,
+        }
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        add_lines_to_cache(
+            "stats-deck",
+            [
+                "== Section ==",
+                "=== Subsection ===",
+                "==== Code ====",
+                "<[code][language=C]",
+                "[<1-2>int a;]",
+                "[<3>int b;]",
+                "[code]>",
+                ">>>stats-include<<<",
+            ],
+        )
+        add_lines_to_cache("stats-include", ["==== Included ====", "<[code]", "x", "[code]>"])
+
+    def tearDown(self):
+        clear_file_cache()
+
+    def check_stats(self, stats):
+        assert stats["sources"] == [
+            {"file": "stats-deck", "bytes": 114, "lines": 8},
+            {"file": "stats-include", "bytes": 33, "lines": 4},
+        ]
+        assert stats["includes"] == 1
+        assert stats["frames"] == 2
+        assert stats["sections"] == 1
+        assert stats["subsections"] == 1
+        assert stats["code_blocks"] == 2
+        assert stats["overlays"] == 4
+        assert stats["defverbs"] == 3  # overlays 1 and 2 are the same
+        assert stats["input_bytes"] == 147
+        assert stats["expansion_ratio"] == stats["output_bytes"] / 147
+
+    def test_stats(self):
+        stats = {}
+        lines = convert_files(["stats-deck"], stats=stats)
+        self.check_stats(stats)
+        assert stats["output_bytes"] == len("\n".join(lines)) + 1
+        assert stats["defverb_bytes"] > 0
+        assert stats["seconds"] >= 0
+
+    def test_stats_parallel(self):
+        stats = {}
+        convert_files(["stats-deck"], jobs=2, stats=stats)
+        self.check_stats(stats)
+
+    def test_stats_include_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            enable_include_cache(tmpdir)
+            try:
+                for _ in range(2):
+                    stats = {}
+                    convert_files(["stats-deck"], stats=stats)
+                    self.check_stats(stats)
+            finally:
+                disable_include_cache()
+                clear_include_cache()
+
+    def test_main_stats(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = str(Path(tmpdir, "out.tex"))
+            statsfile = str(Path(tmpdir, "stats.json"))
+            argv = ["wiki2beamer", "-o", outfile, "--stats", statsfile, "stats-deck"]
+            with mock.patch.object(sys, "argv", argv), mock.patch.object(sys, "stdin", _TTY()):
+                main(argv)
+            stats = json.loads(Path(statsfile).read_text(encoding="utf-8"))
+            assert stats["output_bytes"] == Path(outfile).stat().st_size
+        self.check_stats(stats)
+
+
+class TestResourceLimits(unittest.TestCase):
+    def setUp(self):
+        add_lines_to_cache("limits-a", ["==== a ====", ">>>limits-b<<<"])
+        add_lines_to_cache("limits-b", ["==== b ====", ">>>limits-c<<<"])
+        add_lines_to_cache("limits-c", ["==== c ====", "text"])
+
+    def tearDown(self):
+        set_resource_limits(None)
+        clear_file_cache()
+
+    def assert_exceeds(self, limit, func, *args):
+        with pytest.raises(ResourceLimitException) as excinfo:
+            func(*args)
+        assert excinfo.value.limit == limit
+
+    def test_include_depth(self):
+        set_resource_limits(ResourceLimits(max_include_depth=2))
+        convert_files(["limits-a"])
+        set_resource_limits(ResourceLimits(max_include_depth=1))
+        self.assert_exceeds("max_include_depth", convert_files, ["limits-a"])
+
+    def test_include_bytes(self):
+        set_resource_limits(ResourceLimits(max_include_bytes=65))
+        convert_files(["limits-a"])
+        convert_files(["limits-a"])
+        set_resource_limits(ResourceLimits(max_include_bytes=64))
+        self.assert_exceeds("max_include_bytes", convert_files, ["limits-a"])
+
+    def test_bytes_are_utf8(self):
+        add_lines_to_cache("limits-utf8", ["\u00e4" * 10])
+        set_resource_limits(ResourceLimits(max_include_bytes=20, max_line_length=10))
+        convert_files(["limits-utf8"])
+        set_resource_limits(ResourceLimits(max_include_bytes=19))
+        self.assert_exceeds("max_include_bytes", convert_files, ["limits-utf8"])
+        limits = ResourceLimits(max_output_bytes=len("\u00e4" * 50))
+        set_resource_limits(limits)
+        limits.start()
+        self.assert_exceeds("max_output_bytes", convert2beamer, ["\u00e4" * 50])
+
+    def test_overlays(self):
+        set_resource_limits(ResourceLimits(max_overlays=10))
+        convert2beamer(["<[code]", "[<1-10>x]", "[code]>"])
+        self.assert_exceeds(
+            "max_overlays", convert2beamer, ["<[code]", "[<1-1000000>x]", "[code]>"]
+        )
+        self.assert_exceeds("max_overlays", convert2beamer, ["<[code]", "[<1000000>x]", "[code]>"])
+
+    def test_output_bytes(self):
+        limits = ResourceLimits(max_output_bytes=1000)
+        set_resource_limits(limits)
+        limits.start()
+        self.assert_exceeds("max_output_bytes", convert2beamer, ["==== a ===="] * 100)
+        limits.start()
+        self.assert_exceeds(
+            "max_output_bytes", convert2beamer, ["<[code]", "[<1-9>x]" * 20, "[code]>"]
+        )
+
+    def test_line_length(self):
+        set_resource_limits(ResourceLimits(max_line_length=100))
+        convert2beamer(["x" * 100])
+        self.assert_exceeds("max_line_length", convert2beamer, ["x" * 101])
+
+    def test_timeout(self):
+        limits = ResourceLimits(timeout=-1)
+        set_resource_limits(limits)
+        convert2beamer(["text"])
+        limits.start()
+        self.assert_exceeds("timeout", convert2beamer, ["text"])
+
+    def test_parallel(self):
+        set_resource_limits(ResourceLimits(max_line_length=100))
+        lines = [f"== s{i} ==" for i in range(8)] + ["x" * 101]
+        self.assert_exceeds("max_line_length", convert2beamer, lines, 2)
+
+    def test_main_exit_code(self):
+        argv = ["wiki2beamer", "--max-include-depth", "1", "limits-a"]
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(
+            sys, "stdin", _TTY()
+        ), pytest.raises(SystemExit) as excinfo:
+            main(argv)
+        assert excinfo.value.code == -4
+
+
+class TestCompact(unittest.TestCase):
+    def test_whitespace(self):
+        lines = ["", "  foo  ", "", "", " ", "bar", "", "\\begin{verbatim}", "  x  ", "", ""]
+        lines += ["\\end{verbatim}", "", ""]
+        expected = ["foo", "", "bar", "", "\\begin{verbatim}", "  x  ", "", ""]
+        expected += ["\\end{verbatim}", ""]
+        assert compact_lines(lines) == expected
+
+    def test_inline_verbatim(self):
+        lines = ["\\begin{verbatim} x \\end{verbatim}  ", "", "", "y"]
+        assert compact_lines(lines) == ["\\begin{verbatim} x \\end{verbatim}", "", "y"]
+
+    def test_headfoot_macros(self):
+        lines = ["@FRAMEHEADER=\\textbf{some header material}", "@FRAMEFOOTER=\\tiny footer % no"]
+        for i in range(5):
+            lines += [f"==== Frame {i} ====", "text"]
+        out = compact_lines(convert2beamer(lines))
+        (definition,) = (line for line in out if line.startswith("\\def"))
+        name = definition[len("\\def\\") : definition.index("{")]
+        assert definition == f"\\def\\{name}{{\\textbf{{some header material}}}}"
+        assert out.count(f"\\{name}{{}}") == 5
+        assert out.count("\\tiny footer % no") == 5
+        assert out.index(definition) < out.index(f"\\{name}{{}}")
+
+    def test_code(self):
+        lines = ["==== Frame ====", "<[code]", "  a  ", "", "", "  b", "[code]>", "", "", "end"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = str(Path(tmpdir, "deck.wiki"))
+            Path(filename).write_text("\n".join(lines) + "\n", encoding="utf-8")
+            out = compact_lines(convert_files([filename]))
+        assert "\n  a  \n\n\n  b\n" in "\n".join(out)
+        assert "\n\n\n" not in "\n".join(out).replace("  a  \n\n\n", "")
+
+
 class TestMunge(unittest.TestCase):
     def test_basic_munge(self):
         in_ = ["* one\\", "  two", "* three", "* four"]
@@ -681,5 +2353,292 @@ def test_selected_frames_autotemplate(self):
         assert out == expected
 
 
+class TestStartup(unittest.TestCase):
+    """importing wiki2beamer must stay cheap, the CLI runs for every keystroke in editors"""
+
+    # compiling and running the module itself is cheap next to the modules it imports
+    budget = 1.5
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.env = dict(
+            os.environ, PYTHONPATH=os.pathsep.join(sys.path), PYTHONPYCACHEPREFIX=self.tmpdir.name
+        )
+        self.env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_python(self, code, *options):
+        argv = [sys.executable, *options, "-c", code]
+        return subprocess.run(argv, env=self.env, capture_output=True, text=True, check=True)
+
+    def import_time(self, modules):
+        """microseconds -X importtime reports for importing modules, with bytecode cached"""
+        code = "; ".join(f"import {module}" for module in modules) or "pass"
+        self.run_python(code)
+        times = []
+        for _ in range(5):
+            stderr = self.run_python(code, "-X", "importtime").stderr
+            # top level imports, including the ones done at startup
+            toplevel = [line.split("|") for line in stderr.splitlines()[1:]]
+            times.append(sum(int(cumulative) for _, cumulative, name in toplevel if name[1] != " "))
+        return min(times)
+
+    def test_no_heavy_imports(self):
+        code = "import sys; before = set(sys.modules); import wiki2beamer.main; print(sorted(set(sys.modules) - before))"
+        imported = self.run_python(code).stdout
+        for module in ("concurrent", "gzip", "zipfile", "wiki2beamer.highlight"):
+            assert f"'{module}'" not in imported
+
+    def test_import_time(self):
+        stdlib = [
+            "contextlib",
+            "functools",
+            "hashlib",
+            "importlib",
+            "io",
+            "itertools",
+            "json",
+            "optparse",
+            "os",
+            "pathlib",
+            "random",
+            "re",
+            "struct",
+            "sys",
+            "tempfile",
+            "threading",
+            "time",
+            "typing",
+        ]
+        startup = self.import_time([])
+        baseline = self.import_time(stdlib) - startup
+        own = self.import_time(["wiki2beamer.main"]) - startup
+        assert own < baseline * self.budget, (own, baseline)
+
+
+class TestOutput(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.outfile = str(Path(self.tmpdir.name, "out.tex"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        clear_file_cache()
+
+    def test_write_file_if_changed_creates(self):
+        assert write_file_if_changed(self.outfile, b"foo\n")
+        assert Path(self.outfile).read_bytes() == b"foo\n"
+        assert os.listdir(self.tmpdir.name) == ["out.tex"]
+
+    @pytest.mark.skipif(os.name != "posix", reason="file modes are POSIX")
+    def test_write_file_if_changed_umask(self):
+        umask = os.umask(0o027)
+        try:
+            write_file_if_changed(self.outfile, b"foo\n")
+        finally:
+            os.umask(umask)
+        assert Path(self.outfile).stat().st_mode & 0o777 == 0o640
+
+    def test_write_file_if_changed_keeps_identical(self):
+        write_file_if_changed(self.outfile, b"foo\n")
+        os.utime(self.outfile, (1000000000, 1000000000))
+        assert not write_file_if_changed(self.outfile, b"foo\n")
+        assert Path(self.outfile).stat().st_mtime == 1000000000
+
+    def test_write_file_if_changed_replaces(self):
+        write_file_if_changed(self.outfile, b"foo\n")
+        Path(self.outfile).chmod(0o640)
+        assert write_file_if_changed(self.outfile, b"bar\n")
+        assert Path(self.outfile).read_bytes() == b"bar\n"
+        assert Path(self.outfile).stat().st_mode & 0o777 == 0o640
+        assert os.listdir(self.tmpdir.name) == ["out.tex"]
+
+    def test_main_output_option(self):
+        infile = str(Path(self.tmpdir.name, "in.txt"))
+        Path(infile).write_text("==== foo ====\nbar\n", encoding="utf-8")
+        argv = ["wiki2beamer", "-o", self.outfile, infile]
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(sys, "stdin", _TTY()):
+            main(argv)
+        content = Path(self.outfile).read_text(encoding="utf-8")
+        assert "\\frametitle{foo}" in content
+
+        os.utime(self.outfile, (1000000000, 1000000000))
+        clear_file_cache()
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(sys, "stdin", _TTY()):
+            main(argv)
+        assert Path(self.outfile).stat().st_mtime == 1000000000
+
+    def run_main(self, argv, stdin_bytes):
+        stdin = io.TextIOWrapper(io.BytesIO(stdin_bytes), encoding="latin-1")
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding="ascii")
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(
+            sys, "stdin", stdin
+        ), mock.patch.object(sys, "stdout", stdout):
+            main(argv)
+            stdout.flush()
+        return stdout.buffer.getvalue()
+
+    def test_bytes_io(self):
+        deck = "==== ä ====\n<[code]\nx = 'ß'\n[code]>\n".encode()
+        try:
+            output = self.run_main(["wiki2beamer", "--bytes"], deck)
+        finally:
+            set_bytes_io(False)
+        expected = convert2beamer(
+            munge_input_lines(joinLines(deck.decode("utf-8").splitlines(keepends=True)))
+        )
+        assert output == "".join(line + os.linesep for line in expected).encode("utf-8")
+
+        argv = ["wiki2beamer", "--bytes", "-o", self.outfile]
+        try:
+            self.run_main(argv, deck)
+        finally:
+            set_bytes_io(False)
+        with_bytes = Path(self.outfile).read_bytes()
+        # stdin in bytes mode is read like a file
+        infile = str(Path(self.tmpdir.name, "in.txt"))
+        Path(infile).write_bytes(deck)
+        clear_file_cache()
+        argv = ["wiki2beamer", "-o", self.outfile, infile]
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(sys, "stdin", _TTY()):
+            main(argv)
+        assert Path(self.outfile).read_bytes() == with_bytes
+
+    def test_bytes_invalid_utf8(self):
+        try:
+            with pytest.raises(SystemExit) as excinfo:
+                self.run_main(["wiki2beamer", "--bytes"], b"==== \xff ====\n")
+        finally:
+            set_bytes_io(False)
+        assert excinfo.value.code == -2
+
+
+class TestNavigation(unittest.TestCase):
+    deck: ClassVar[List[str]] = [
+        "<[autotemplate]",
+        "titleframe=True",
+        "[autotemplate]>",
+        "== Intro ==",
+        "==== one ====",
+        "+<2->{a} -<3>{b}",
+        "=== Details ===[Det]",
+        "==== two ====",
+        "<[nowiki]",
+        "a \\pause b \\pause c",
+        "[nowiki]>",
+        "==== three ====",
+        "c",
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.outfile = str(Path(self.tmpdir.name, "deck.tex"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        clear_file_cache()
+
+    def convert(self, lines):
+        return convert2beamer(munge_input_lines(joinLines([line + "\n" for line in lines])))
+
+    def test_predict(self):
+        nav = navigation.predict_navigation(self.convert(self.deck))
+        assert nav.certain
+        assert not nav.references
+        assert (nav.pages, nav.frames) == (8, 4)
+        assert nav.nav == [
+            "\\headcommand {\\slideentry {0}{0}{1}{1/1}{}{0}}",
+            "\\headcommand {\\beamer@framepages {1}{1}}",
+            "\\headcommand {\\beamer@sectionpages {1}{1}}",
+            "\\headcommand {\\beamer@subsectionpages {1}{1}}",
+            "\\headcommand {\\sectionentry {1}{Intro}{2}{Intro}{0}}",
+            "\\headcommand {\\slideentry {1}{0}{1}{2/4}{}{0}}",
+            "\\headcommand {\\beamer@framepages {2}{4}}",
+            "\\headcommand {\\beamer@subsectionpages {2}{4}}",
+            "\\headcommand {\\beamer@subsectionentry {0}{1}{1}{5}{Det}}",
+            "\\headcommand {\\slideentry {1}{1}{1}{5/7}{}{0}}",
+            "\\headcommand {\\beamer@framepages {5}{7}}",
+            "\\headcommand {\\slideentry {1}{1}{2}{8/8}{}{0}}",
+            "\\headcommand {\\beamer@framepages {8}{8}}",
+            "\\headcommand {\\beamer@partpages {1}{8}}",
+            "\\headcommand {\\beamer@subsectionpages {5}{8}}",
+            "\\headcommand {\\beamer@sectionpages {2}{8}}",
+            "\\headcommand {\\beamer@documentpages {8}}",
+            "\\headcommand {\\gdef \\inserttotalframenumber {4}}",
+        ]
+        assert nav.toc == [
+            "\\beamer@sectionintoc {1}{Intro}{2}{0}{1}",
+            "\\beamer@subsectionintoc {1}{1}{Details}{5}{0}{1}",
+        ]
+
+    def test_uncertain(self):
+        # listings and comments are not looked into
+        deck = ["==== a ====", "<[code]", "\\begin{frame}", "[code]>"]
+        lines = self.convert([*deck, "<[nowiki]", "% \\pause", "[nowiki]>"])
+        nav = navigation.predict_navigation(lines)
+        assert (nav.pages, nav.frames) == (1, 1)
+        assert nav.reasons == ["no \\begin{document}, the output is not a document of its own"]
+
+        deck = ["==== a ====", "*[<+->] x", "==== b ====", "<[nowiki]", "\\ref{a}", "[nowiki]>"]
+        lines = self.convert(deck)
+        nav = navigation.predict_navigation(["\\begin{document}", *lines, "\\end{document}"])
+        assert nav.reasons == ["incremental overlay specification <+->"]
+        assert nav.references
+
+    def test_second_pass(self):
+        nav = navigation.predict_navigation(self.convert(self.deck))
+        reasons = navigation.second_pass_reasons(self.outfile, nav)
+        assert [r.split(":")[0] for r in reasons] == [
+            f"cannot read {Path(self.tmpdir.name, 'deck.nav')}",
+            f"cannot read {Path(self.tmpdir.name, 'deck.toc')}",
+        ]
+        navigation.write_navigation(self.outfile, nav)
+        assert navigation.second_pass_reasons(self.outfile, nav) == []
+        # LaTeX writes a version check, babel lines and spaces of its own
+        (_navfile, tocfile) = navigation.navigation_files(self.outfile)
+        toc = Path(tocfile).read_text(encoding="utf-8").replace("intoc {", "intoc{")
+        Path(tocfile).write_text("\\babel@toc {english}{}\n" + toc, encoding="utf-8")
+        assert navigation.second_pass_reasons(self.outfile, nav) == []
+        nav.toc[0] = nav.toc[0].replace("Intro", "Introduction")
+        reasons = navigation.second_pass_reasons(self.outfile, nav)
+        assert reasons == [f"{tocfile} differs from the prediction"]
+        # an uncertain prediction explains a difference, a match is final anyway
+        nav.uncertain("incremental overlay specification <+->")
+        reasons = navigation.second_pass_reasons(self.outfile, nav)
+        assert reasons == [
+            f"{tocfile} differs from the prediction",
+            "uncertain prediction: incremental overlay specification <+->",
+        ]
+        nav.toc[0] = nav.toc[0].replace("Introduction", "Intro")
+        assert navigation.second_pass_reasons(self.outfile, nav) == []
+
+    def test_main(self):
+        infile = str(Path(self.tmpdir.name, "in.txt"))
+        Path(infile).write_text("\n".join(self.deck) + "\n", encoding="utf-8")
+        (navfile, tocfile) = navigation.navigation_files(self.outfile)
+        argv = ["wiki2beamer", "--check-nav", "-o", self.outfile, infile]
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(
+            sys, "stdin", _TTY()
+        ), pytest.raises(SystemExit) as excinfo:
+            main(argv)
+        assert excinfo.value.code == 1
+        assert not Path(self.outfile).exists()
+
+        argv = ["wiki2beamer", "--nav", "-o", self.outfile, infile]
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(sys, "stdin", _TTY()):
+            main(argv)
+        assert "\\sectionentry {1}{Intro}" in Path(navfile).read_text(encoding="utf-8")
+        assert "\\beamer@sectionintoc {1}{Intro}" in Path(tocfile).read_text(encoding="utf-8")
+
+        argv = ["wiki2beamer", "--check-nav", "-o", self.outfile, infile]
+        with mock.patch.object(sys, "argv", argv), mock.patch.object(
+            sys, "stdin", _TTY()
+        ), pytest.raises(SystemExit) as excinfo:
+            main(argv)
+        assert excinfo.value.code == 0
+
+
 if __name__ == "__main__":
     unittest.main()